@@ -10,9 +10,13 @@ from __future__ import print_function
 from dicom_to_sql import dicom_to_sql
 from utilities import Temp_DICOM_FileSet
 from sql_connector import DVH_SQL
+from sql_stats import read_slow_queries, clear_slow_queries
+from recalc import recalculate_geometry, RECALC_TYPES
+from options import RECALC_WORKERS
 from analysis_tools import DVH
 from utilities import is_import_settings_defined, is_sql_connection_defined,\
-    write_import_settings, write_sql_connection_settings, validate_import_settings, validate_sql_connection
+    write_import_settings, write_sql_connection_settings, validate_import_settings, validate_sql_connection,\
+    convert_dvh_strings_to_bytes, convert_roi_coord_strings_to_bytes
 from get_settings import get_settings
 import os
 from getpass import getpass
@@ -173,6 +177,56 @@ def print_mrns():
             print(current_mrn)
 
 
+def print_slow_queries(clear=False):
+    if clear:
+        clear_slow_queries()
+        print("Slow query log cleared")
+        return
+
+    slow_queries = read_slow_queries()
+    if not slow_queries:
+        print("No statements have exceeded the slow query threshold")
+
+    for slow_query in slow_queries:
+        print("%0.2f sec, %s rows, %s bytes, %s on %s" % (slow_query['seconds'], slow_query['rows'],
+                                                         slow_query['bytes'], slow_query['time_stamp'],
+                                                         slow_query['dbname']))
+        print("    %s" % slow_query['statement'])
+        if slow_query.get('plan'):
+            for line in slow_query['plan'].splitlines():
+                print("        %s" % line)
+        print('')
+
+
+def recalc(what, condition=None, workers=None):
+    """
+    Recalculate ROI geometry of the DVHs table, printing the progress after each study
+    :param what: comma separated RECALC_TYPES
+    :param condition: SQL condition selecting the DVHs to recalculate
+    :param workers: number of worker processes, RECALC_WORKERS by default
+    """
+    what = [calculation.strip() for calculation in what.split(',') if calculation.strip()]
+    invalid = [calculation for calculation in what if calculation not in RECALC_TYPES]
+    if invalid or not what:
+        print("ERROR: --what must be a comma separated list of: %s" % ', '.join(RECALC_TYPES))
+        return
+
+    if workers is None:
+        workers = RECALC_WORKERS
+    elif workers < 1:
+        workers = 1
+
+    def report_progress(progress):
+        print(str(progress))
+
+    progress = recalculate_geometry(what, condition=condition, workers=workers, report_progress=report_progress)
+    print("Recalculated %s of %d ROIs in %d studies" % (', '.join(what), progress.rois, progress.studies))
+    if progress.failed_studies:
+        print("%d studies failed:" % len(progress.failed_studies))
+        for uid in progress.failed_studies:
+            print("    %s" % uid)
+
+
 def initialize_default_import_settings_file():
     # Create default import settings file
     import_settings_path = get_settings('import')
@@ -209,6 +263,21 @@ def main():
                         help='Import will add to SQL DB even if DB already contains data from dicom files',
                         default=False,
                         action='store_true')
+    parser.add_argument('--workers',
+                        dest='workers',
+                        help='Number of processes used to read DICOM files and calculate DVHs during import '
+                             '(default 1), or to recalculate ROI geometry (recalc command, default RECALC_WORKERS)',
+                        type=int,
+                        default=None)
+    parser.add_argument('--what',
+                        dest='what',
+                        help='Comma separated calculations of the recalc command: %s (default all)'
+                             % ','.join(RECALC_TYPES),
+                        default=','.join(RECALC_TYPES))
+    parser.add_argument('--condition',
+                        dest='condition',
+                        help='SQL condition selecting the DVHs of the recalc command, all DVHs by default',
+                        default=None)
     parser.add_argument('--allow-websocket-origin',
                         dest='allow_websocket_origin',
                         help='Allows Bokeh server to accept a non-default origin',
@@ -222,6 +291,10 @@ def main():
                         dest='bypass_sql_test',
                         default=False,
                         action='store_true')
+    parser.add_argument('--clear',
+                        help='Clear the slow query log (slow_queries command)',
+                        default=False,
+                        action='store_true')
     parser.add_argument('command', nargs='+', help='bar help')
     args = parser.parse_args()
 
@@ -245,6 +318,9 @@ def main():
         elif args.command[0] == 'print_mrns':
             print_mrns()
 
+        elif args.command[0] == 'slow_queries':
+            print_slow_queries(clear=args.clear)
+
         elif args.command[0] == 'import':
 
             # Set defaults
@@ -260,7 +336,12 @@ def main():
                 force_update = True
 
             dicom_to_sql(start_path=start_path,
-                         force_update=force_update)
+                         force_update=force_update,
+                         workers=max(1, args.workers or 1))
+
+        elif args.command[0] == 'recalc':
+            recalc(args.what, condition=args.condition, workers=args.workers)
+
         elif args.command[0] == 'run':
 
             command = ["bokeh", "serve"]
@@ -338,6 +419,16 @@ def main():
 
             DVH_SQL().initialize_database()
 
+        elif args.command[0] == 'convert_dvhs':
+
+            DVH_SQL().initialize_database()
+            convert_dvh_strings_to_bytes()
+
+        elif args.command[0] == 'convert_rois':
+
+            DVH_SQL().initialize_database()
+            convert_roi_coord_strings_to_bytes()
+
 
 if __name__ == '__main__':
     main()
@@ -8,16 +8,19 @@ Created on Fri Mar 24 13:43:28 2017
 from __future__ import print_function
 from future.utils import listvalues
 from utilities import is_import_settings_defined, is_sql_connection_defined, validate_sql_connection, \
-    recalculate_ages, update_min_distances_in_db, update_treatment_volume_overlap_in_db, update_volumes_in_db, \
-    update_surface_area_in_db
+    recalculate_ages
 import os
 from os.path import dirname, join
 from datetime import datetime
 from roi_name_manager import DatabaseROIs, clean_name
 from sql_connector import DVH_SQL
+from async_sql import AsyncDVH_SQL, run_async, on_result
+from sql_stats import read_slow_queries, clear_slow_queries
+from recalc import recalculate_geometry, RecalcProgress
+from functools import partial
 from dicom_to_sql import dicom_to_sql, rebuild_database
 from bokeh.models.widgets import Select, Button, Tabs, Panel, TextInput, RadioButtonGroup,\
-    Div, MultiSelect, TableColumn, DataTable, CheckboxGroup, PasswordInput
+    Div, MultiSelect, TableColumn, DataTable, CheckboxGroup, PasswordInput, NumberFormatter, PreText
 from bokeh.layouts import layout, row, column
 from bokeh.plotting import figure
 from bokeh.io import curdoc
@@ -38,6 +41,15 @@ ACCESS_GRANTED = not AUTH_USER_REQ
 # Create empty Bokeh data sources
 query_source = ColumnDataSource(data=dict())
 baseline_source = ColumnDataSource(data=dict(mrn=[]))
+slow_query_source = ColumnDataSource(data=dict(time_stamp=[], dbname=[], seconds=[], rows=[], bytes=[],
+                                               statement=[], plan=[]))
+statement_stats_source = ColumnDataSource(data=dict(statement=[], count=[], seconds=[], max_seconds=[], rows=[],
+                                                    bytes=[]))
+
+# Document of this session, needed to apply results of work done on worker threads
+bokeh_doc = curdoc()
+roi_remap_running = False
+geometry_recalc_running = False
 
 directories = {}
 config = {}
@@ -607,21 +619,58 @@ def unignore_dvh():
         select_uncategorized_variation.value = to_be_unignored
 
 
-def remap_rois(cursor_rtn, button, *physician):
+def remap_rois(condition, button, *physician):
+    """
+    Remap ROIs on a worker thread, the button label shows the progress
+    :param condition: SQL condition selecting the DVHs to remap, None for all DVHs
+    :param button: the Button that started the remap
+    :param physician: optionally, only remap ROIs of this physician
+    """
+    global roi_remap_running
+    if roi_remap_running:
+        return
+    roi_remap_running = True
+
+    initial_label = button.label
+
+    def set_label(label):
+        button.label = label
+
+    def report_progress(label):
+        # called from the worker thread
+        bokeh_doc.add_next_tick_callback(partial(set_label, label))
+
+    def finish(*result):
+        global roi_remap_running
+        roi_remap_running = False
+        button.label = initial_label
+        db.write_to_file()
+        update_uncategorized_variation_select()
+        update_ignored_variations_select()
+
+    run_async(bokeh_doc, calculate_roi_remap, args=(condition, report_progress) + physician,
+              callback=finish, errback=finish)
+
+
+def calculate_roi_remap(condition, report_progress, *physician):
+    # Runs on a worker thread, Bokeh models may only be changed through report_progress
     if physician:
         physician = physician[0]
     else:
         physician = False
 
-    initial_label = button.label
     cnx = DVH_SQL()
+    cursor_rtn = cnx.query('dvhs', 'roi_name, study_instance_uid', condition)
+    physicians = {str(row[0]): row[1] for row in cnx.query('plans', 'study_instance_uid, physician')}
+    new_values = {'roi_name': [], 'study_instance_uid': [], 'physician_roi': [], 'institutional_roi': []}
     progress = 0
+    last_percent = None
     complete = len(cursor_rtn)
     for row in cursor_rtn:
         progress += 1
         variation = str(row[0])
         study_instance_uid = str(row[1])
-        current_physician = cnx.query('plans', 'physician', "study_instance_uid = '" + study_instance_uid + "'")[0][0]
+        current_physician = physicians.get(study_instance_uid)
 
         if not physician or physician == current_physician:
 
@@ -635,32 +684,31 @@ def remap_rois(cursor_rtn, button, *physician):
             else:
                 new_institutional_roi = db.get_institutional_roi(current_physician, new_physician_roi)
 
-            condition_str = "roi_name = '" + variation + "' and study_instance_uid = '" + study_instance_uid + "'"
-            cnx.update('dvhs', 'physician_roi', new_physician_roi, condition_str)
-            cnx.update('dvhs', 'institutional_roi', new_institutional_roi, condition_str)
+            new_values['roi_name'].append(variation)
+            new_values['study_instance_uid'].append(study_instance_uid)
+            new_values['physician_roi'].append(new_physician_roi)
+            new_values['institutional_roi'].append(new_institutional_roi)
 
             percent = int(float(100) * (float(progress) / float(complete)))
-            button.label = "Remap progress: " + str(percent) + "%"
-    button.label = initial_label
+            if percent != last_percent:
+                report_progress("Remap progress: " + str(percent) + "%")
+                last_percent = percent
 
-    db.write_to_file()
-    update_uncategorized_variation_select()
-    update_ignored_variations_select()
+    report_progress("Writing remapped ROIs to DB")
+    cnx.bulk_update('dvhs', ['study_instance_uid', 'roi_name'], new_values)
+    cnx.close()
 
 
 def update_uncategorized_rois_in_db():
-    cursor_rtn = DVH_SQL().query('dvhs', 'roi_name, study_instance_uid', "physician_roi = 'uncategorized'")
-    remap_rois(cursor_rtn, update_uncategorized_rois_button)
+    remap_rois("physician_roi = 'uncategorized'", update_uncategorized_rois_button)
 
 
 def remap_all_rois_in_db():
-    cursor_rtn = DVH_SQL().query('dvhs', 'roi_name, study_instance_uid')
-    remap_rois(cursor_rtn, remap_all_rois_button)
+    remap_rois(None, remap_all_rois_button)
 
 
 def remap_all_rois_for_selected_physician():
-    cursor_rtn = DVH_SQL().query('dvhs', 'roi_name, study_instance_uid')
-    remap_rois(cursor_rtn, remap_all_rois_for_selected_physician_button, select_physician.value)
+    remap_rois(None, remap_all_rois_for_selected_physician_button, select_physician.value)
 
 
 def update_save_button_status():
@@ -679,6 +727,9 @@ def update_query_columns():
     if query_table.value.lower() == 'dvhs':
         new_options.pop(new_options.index('dvh_string'))
         new_options.pop(new_options.index('roi_coord_string'))
+        for binary_column in ['dvh_bytes', 'roi_coord_bytes']:
+            if binary_column in new_options:
+                new_options.pop(new_options.index(binary_column))
     options_tuples = []
     for option in new_options:
         options_tuples.append(tuple([option, option]))
@@ -696,6 +747,9 @@ def update_update_db_column():
     if update_db_table.value.lower() == 'dvhs':
         new_options.pop(new_options.index('dvh_string'))
         new_options.pop(new_options.index('roi_coord_string'))
+        for binary_column in ['dvh_bytes', 'roi_coord_bytes']:
+            if binary_column in new_options:
+                new_options.pop(new_options.index(binary_column))
 
     update_db_column.options = new_options
     update_db_column.value = new_options[0]
@@ -716,11 +770,33 @@ def update_query_source():
         new_data[column] = []
         table_columns.append(TableColumn(field=column, title=column))
     columns_str = ','.join(columns).strip()
+    query_button.label = 'Querying...'
+    query_button.button_type = 'warning'
     if query_condition.value:
-        query_cursor = DVH_SQL().query(query_table.value, columns_str, query_condition.value)
+        query_future = AsyncDVH_SQL().query(query_table.value, columns_str, query_condition.value)
     else:
-        query_cursor = DVH_SQL().query(query_table.value, columns_str)
+        query_future = AsyncDVH_SQL().query(query_table.value, columns_str)
 
+    on_result(bokeh_doc, query_future, callback=partial(apply_query_source, columns, new_data, table_columns),
+              errback=query_source_failed)
+
+
+def query_source_failed(exception):
+    # Runs on the event loop if the query started by update_query_source failed, e.g., an invalid condition
+    print(str(datetime.now()), 'Query failed: %s' % exception, sep=' ')
+    query_button.label = 'Query Failed'
+    query_button.button_type = 'danger'
+    bokeh_doc.add_timeout_callback(restore_query_button, 2500)
+
+
+def restore_query_button():
+    query_button.label = 'Query'
+    query_button.button_type = 'primary'
+
+
+def apply_query_source(columns, new_data, table_columns, query_cursor):
+    # Runs on the event loop with the results of the query started by update_query_source
+    restore_query_button()
     for row in query_cursor:
         for i in range(len(columns)):
             new_data[columns[i]].append(str(row[i]))
@@ -741,10 +817,27 @@ def update_db():
         update_value = update_db_value.value
         if update_db_column.value in {'birth_date', 'sim_study_date'}:
             update_value = update_value + "::date"
-        DVH_SQL().update(update_db_table.value, update_db_column.value, update_value, update_db_condition.value)
-        update_query_source()
-        update_db_button.label = 'Update'
-        update_db_button.button_type = 'warning'
+        update_future = AsyncDVH_SQL().update(update_db_table.value, update_db_column.value, update_value,
+                                              update_db_condition.value)
+        on_result(bokeh_doc, update_future, callback=update_db_complete, errback=update_db_failed)
+
+
+def update_db_complete(*result):
+    update_query_source()
+    restore_update_db_button()
+
+
+def update_db_failed(exception):
+    # Runs on the event loop if the update started by update_db failed, e.g., an invalid condition or date
+    print(str(datetime.now()), 'Update failed: %s' % exception, sep=' ')
+    update_db_button.label = 'Update Failed'
+    update_db_button.button_type = 'danger'
+    bokeh_doc.add_timeout_callback(restore_update_db_button, 2500)
+
+
+def restore_update_db_button():
+    update_db_button.label = 'Update'
+    update_db_button.button_type = 'warning'
 
 
 def delete_from_db():
@@ -973,59 +1066,50 @@ def restore_preferences():
 
 
 def calculate_ptv_distances():
-    start_time = datetime.now()
-    print(str(start_time), 'Beginning PTV distance calculations', sep=' ')
-    calculate_ptv_dist_button.label = 'Calculating...'
-    calculate_ptv_dist_button.button_type = 'warning'
-    if calculate_condition.value:
-        update_all_min_distances_in_db(calculate_condition.value)
-    else:
-        update_all_min_distances_in_db()
-    update_query_source()
-    calculate_ptv_dist_button.label = 'Calc PTV Distances'
-    calculate_ptv_dist_button.button_type = 'primary'
-
-    end_time = datetime.now()
-    print(str(end_time), 'Calculations complete', sep=' ')
-
-    total_time = end_time - start_time
-    seconds = total_time.seconds
-    m, s = divmod(seconds, 60)
-    h, m = divmod(m, 60)
-    if h:
-        print("These calculations took %dhrs %02dmin %02dsec to complete" % (h, m, s))
-    elif m:
-        print("These calculations took %02dmin %02dsec to complete" % (m, s))
-    else:
-        print("These calculations took %02dsec to complete" % s)
+    recalculate_geometry_in_background(['distances'], calculate_ptv_dist_button)
 
 
 def calculate_ptv_overlap():
-    start_time = datetime.now()
-    print(str(start_time), 'Beginning PTV overlap calculations', sep=' ')
-    calculate_tv_overlap_button.label = 'Calculating...'
-    calculate_tv_overlap_button.button_type = 'warning'
-    if calculate_condition.value:
-        update_all_tv_overlaps_in_db(calculate_condition.value)
-    else:
-        update_all_tv_overlaps_in_db()
-    update_query_source()
-    calculate_tv_overlap_button.label = 'Calc PTV Overlap'
-    calculate_tv_overlap_button.button_type = 'primary'
-
-    end_time = datetime.now()
-    print(str(end_time), 'Calculations complete', sep=' ')
-
-    total_time = end_time - start_time
-    seconds = total_time.seconds
-    m, s = divmod(seconds, 60)
-    h, m = divmod(m, 60)
-    if h:
-        print("These calculations took %dhrs %02dmin %02dsec to complete" % (h, m, s))
-    elif m:
-        print("These calculations took %02dmin %02dsec to complete" % (m, s))
-    else:
-        print("These calculations took %02dsec to complete" % s)
+    recalculate_geometry_in_background(['overlap'], calculate_tv_overlap_button)
+
+
+def recalculate_geometry_in_background(what, button):
+    """
+    Recalculate ROI geometry with the batch geometry runner on a worker thread, the button label shows the progress
+    :param what: a list of RECALC_TYPES
+    :param button: the Button that started the calculations
+    """
+    global geometry_recalc_running
+    if geometry_recalc_running:
+        return
+    geometry_recalc_running = True
+
+    initial_label = button.label
+    button.label = 'Calculating...'
+    button.button_type = 'warning'
+    print(str(datetime.now()), 'Beginning %s calculations' % ', '.join(what), sep=' ')
+
+    def set_label(label):
+        button.label = label
+
+    def report_progress(progress):
+        # called from the worker thread
+        print(str(progress))
+        bokeh_doc.add_next_tick_callback(partial(set_label, progress.get_label()))
+
+    def finish(progress):
+        global geometry_recalc_running
+        geometry_recalc_running = False
+        button.label = initial_label
+        button.button_type = 'primary'
+        if isinstance(progress, RecalcProgress):
+            print(str(datetime.now()), 'Calculations complete: %s' % progress, sep=' ')
+        update_query_source()
+
+    condition = calculate_condition.value or None
+    run_async(bokeh_doc, recalculate_geometry,
+              args=(what, condition, RECALC_WORKERS, RECALC_BATCH_SIZE, report_progress),
+              callback=finish, errback=finish)
 
 
 def calculate_ages_click():
@@ -1170,71 +1254,23 @@ def source_selection_ticker(attr, old, new):
 
 
 def update_all_min_distances_in_db(*condition):
-    if condition:
-        condition = " AND (" + condition[0] + ")"
-    else:
-        condition = ''
-    condition = "(LOWER(roi_type) IN ('organ', 'ctv', 'gtv') AND (" \
-                "LOWER(roi_name) NOT IN ('external', 'skin') OR " \
-                "LOWER(physician_roi) NOT IN ('uncategorized', 'ignored', 'external', 'skin')))" + condition
-    rois = DVH_SQL().query('dvhs', 'study_instance_uid, roi_name, physician_roi', condition)
-    counter = 0.
-    total_rois = float(len(rois))
-    for roi in rois:
-        calculate_ptv_dist_button.label = str(int((counter / total_rois) * 100)) + '%'
-        counter += 1.
-        if roi[1].lower() not in {'external', 'skin'} and \
-                        roi[2].lower() not in {'uncategorized', 'ignored', 'external', 'skin'}:
-            print('updating dist to ptv:', roi[1], sep=' ')
-            update_min_distances_in_db(roi[0], roi[1])
-        else:
-            print('skipping dist to ptv:', roi[1], sep=' ')
-    calculate_ptv_dist_button.label = 'Calc PTV Distances'
+    recalculate_geometry(['distances'], *condition)
 
 
 def update_all_tv_overlaps_in_db(*condition):
-    if condition:
-        rois = DVH_SQL().query('dvhs', 'study_instance_uid, roi_name, physician_roi', condition[0])
-    else:
-        rois = DVH_SQL().query('dvhs', 'study_instance_uid, roi_name, physician_roi')
-    counter = 0.
-    total_rois = float(len(rois))
-    for roi in rois:
-        calculate_tv_overlap_button.label = str(int((counter / total_rois) * 100)) + '%'
-        counter += 1.
-        print('updating ptv_overlap:', roi[1], sep=' ')
-        update_treatment_volume_overlap_in_db(roi[0], roi[1])
-    calculate_tv_overlap_button.label = 'Calc PTV Overlap'
+    recalculate_geometry(['overlap'], *condition)
 
 
 # Calculates volumes using Shapely, not dicompyler
 # This function is not in the GUI
 def recalculate_roi_volumes(*condition):
-    if condition:
-        rois = DVH_SQL().query('dvhs', 'study_instance_uid, roi_name, physician_roi', condition[0])
-    else:
-        rois = DVH_SQL().query('dvhs', 'study_instance_uid, roi_name, physician_roi')
-    counter = 0.
-    total_rois = float(len(rois))
-    for roi in rois:
-        counter += 1.
-        print('updating volume:', roi[1], int(100. * counter / total_rois), sep=' ')
-        update_volumes_in_db(roi[0], roi[1])
+    recalculate_geometry(['volume'], *condition)
 
 
 # Calculates surface area using Shapely
 # This function is not in the GUI
 def recalculate_surface_areas(*condition):
-    if condition:
-        rois = DVH_SQL().query('dvhs', 'study_instance_uid, roi_name, physician_roi', condition[0])
-    else:
-        rois = DVH_SQL().query('dvhs', 'study_instance_uid, roi_name, physician_roi')
-    counter = 0.
-    total_rois = float(len(rois))
-    for roi in rois:
-        counter += 1.
-        print('updating surface area:', roi[1], int(100. * counter / total_rois), sep=' ')
-        update_surface_area_in_db(roi[0], roi[1])
+    recalculate_geometry(['surface'], *condition)
 
 
 def auth_button_click():
@@ -1323,6 +1359,35 @@ def backup_location_ticker(attr, old, new):
     update_backup_select(new)
 
 
+def update_query_log():
+    # slow statements logged by every process, e.g., the main view's query builder
+    slow_queries = read_slow_queries()
+    slow_query_source.data = {key: [slow_query.get(key) for slow_query in slow_queries]
+                              for key in ['time_stamp', 'dbname', 'seconds', 'rows', 'bytes', 'statement', 'plan']}
+    slow_query_plan.text = ''
+
+    # all statements executed by this admin server
+    with DVH_SQL() as cnx:
+        summary = cnx.get_query_stats().get_summary()[:SQL_SLOW_QUERY_COUNT]
+    statement_stats_source.data = {key: [totals[key] for totals in summary]
+                                   for key in ['statement', 'count', 'seconds', 'max_seconds', 'rows', 'bytes']}
+
+
+def clear_query_log():
+    clear_slow_queries()
+    with DVH_SQL() as cnx:
+        cnx.get_query_stats().clear()
+    update_query_log()
+
+
+def slow_query_selection_ticker(attr, old, new):
+    indices = slow_query_source.selected.indices
+    if indices:
+        index = indices[0]
+        plan = slow_query_source.data['plan'][index] or 'No plan captured'
+        slow_query_plan.text = "%s\n\n%s" % (slow_query_source.data['statement'][index], plan)
+
+
 ######################################################
 # Layout objects
 ######################################################
@@ -1676,6 +1741,47 @@ backup_layout = layout([[backup_select, delete_backup_button, restore_db_button,
                         [port_div],
                         [db_div]])
 
+# !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+# Query Log
+# !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+slow_query_title = Div(text="<b>Slowest Statements</b> (over %s sec, all processes)" % SQL_SLOW_QUERY_SECONDS,
+                       width=1000)
+query_log_refresh_button = Button(label='Refresh', button_type='primary', width=100)
+query_log_clear_button = Button(label='Clear Log', button_type='warning', width=100)
+slow_query_columns = [TableColumn(field='time_stamp', title='Time', width=150),
+                      TableColumn(field='dbname', title='Database', width=80),
+                      TableColumn(field='seconds', title='Seconds', width=70, formatter=NumberFormatter(format="0.00")),
+                      TableColumn(field='rows', title='Rows', width=70),
+                      TableColumn(field='bytes', title='Bytes', width=90, formatter=NumberFormatter(format="0,0")),
+                      TableColumn(field='statement', title='Statement', width=540)]
+slow_query_table = DataTable(source=slow_query_source, columns=slow_query_columns, width=1000, height=300)
+slow_query_plan = PreText(text='', width=1000)
+statement_stats_title = Div(text="<b>Statements Executed by this Server</b> (most total time first)", width=1000)
+statement_stats_columns = [TableColumn(field='statement', title='Statement', width=560),
+                           TableColumn(field='count', title='Count', width=60),
+                           TableColumn(field='seconds', title='Total Seconds', width=90,
+                                       formatter=NumberFormatter(format="0.00")),
+                           TableColumn(field='max_seconds', title='Max Seconds', width=90,
+                                       formatter=NumberFormatter(format="0.00")),
+                           TableColumn(field='rows', title='Rows', width=80),
+                           TableColumn(field='bytes', title='Bytes', width=120,
+                                       formatter=NumberFormatter(format="0,0"))]
+statement_stats_table = DataTable(source=statement_stats_source, columns=statement_stats_columns, width=1000,
+                                  height=300)
+
+query_log_refresh_button.on_click(update_query_log)
+query_log_clear_button.on_click(clear_query_log)
+slow_query_source.on_change('selected', slow_query_selection_ticker)
+
+update_query_log()
+
+query_log_layout = layout([[slow_query_title],
+                           [query_log_refresh_button, query_log_clear_button],
+                           [slow_query_table],
+                           [slow_query_plan],
+                           [statement_stats_title],
+                           [statement_stats_table]])
+
 # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 # Tabs and document
 # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
@@ -1683,11 +1789,12 @@ roi_tab = Panel(child=roi_layout, title='ROI Name Manager')
 db_tab = Panel(child=db_editor_layout, title='Database Editor')
 backup_tab = Panel(child=backup_layout, title='Backup & Restore')
 baseline_tab = Panel(child=baseline_layout, title='Baseline Plans')
+query_log_tab = Panel(child=query_log_layout, title='Query Log')
 
 if DISABLE_BACKUP_TAB:
-    tabs = Tabs(tabs=[db_tab, roi_tab, baseline_tab])
+    tabs = Tabs(tabs=[db_tab, roi_tab, baseline_tab, query_log_tab])
 else:
-    tabs = Tabs(tabs=[db_tab, roi_tab, baseline_tab, backup_tab])
+    tabs = Tabs(tabs=[db_tab, roi_tab, baseline_tab, backup_tab, query_log_tab])
 
 # Create the document Bokeh server will use to generate the webpage
 if ACCESS_GRANTED:
@@ -8,19 +8,32 @@ Created on Thu Mar  9 18:48:19 2017
 from __future__ import print_function
 import numpy as np
 from sql_connector import DVH_SQL
-from sql_to_python import QuerySQL
+from sql_cache import get_query_tables
+from sql_to_python import QuerySQL, LAZY_COLUMNS
+from utilities import bytes_to_dvh, dvh_string_to_array
 from options import RESAMPLED_DVH_BIN_COUNT
 
 
+# DVH calculations require these DVHs table columns regardless of the requested columns
+REQUIRED_COLUMNS = ['mrn', 'study_instance_uid', 'roi_name', 'volume']
+
+# Plans columns selected with the DVHs, see RELATED_COLUMNS in sql_to_python
+PLAN_COLUMNS = ['rx_dose']
+
+
 # This class retrieves DVH data from the SQL database and calculates statistical DVHs (min, max, quartiles)
 # It also provides some inspection tools of the retrieved data
 class DVH:
-    def __init__(self, uid=None, dvh_condition=None):
+    def __init__(self, uid=None, dvh_condition=None, columns=None):
         """
         This class will retrieve DVHs and other data in the DVH SQL table meeting the given constraints,
         it will also parse the DVH_string into python lists and retrieve the associated Rx dose
         :param uid: a list of allowed study_instance_uids in data set
-        :param dvh_condition: a string in SQL syntax applied to a DVH Table query
+        :param dvh_condition: a string in SQL syntax applied to a DVH Table query,
+        may include semi-joins on other tables (see utilities.get_study_instance_uid_condition)
+        :param columns: a list of DVHs table columns to fetch, defaults to all but LAZY_COLUMNS,
+        other columns are fetched when first accessed. DVHs are streamed and decoded separately.
+        PLAN_COLUMNS (e.g., rx_dose) are selected in the same query
         """
 
         if uid:
@@ -39,38 +52,69 @@ class DVH:
         cnx = DVH_SQL()
 
         # Get DVH data from SQL
-        dvh_data = QuerySQL('DVHs', constraints_str)
+        if columns is not None:
+            columns = [c for c in REQUIRED_COLUMNS if c not in columns] + list(columns)
+        else:
+            columns = [c for c in cnx.get_column_names('dvhs') if c not in LAZY_COLUMNS['dvhs']]
+        columns += [c for c in PLAN_COLUMNS if c not in columns]
+        dvh_data = QuerySQL('DVHs', constraints_str, columns=columns)
+        self._dvh_data = dvh_data
         for key, value in dvh_data.__dict__.items():
             if not key.startswith("__"):
                 setattr(self, key, value)
 
         # Add these properties to dvh_data since they aren't in the DVHs SQL table
         self.count = len(self.mrn)
-        self.rx_dose = []
-
-        self.bin_count = 0
-        for value in self.dvh_string:
-            current_dvh_str = np.array(str(value).split(','))
-            current_size = np.size(current_dvh_str)
-            if current_size > self.bin_count:
-                self.bin_count = current_size
+
+        dvhs = self.fetch_dvhs(cnx, constraints_str)
+
+        self.bin_count = max([len(dvh) for dvh in dvhs] or [0])
         self.dvh = np.zeros([self.bin_count, self.count])
 
-        # Get needed values not in DVHs table
         for i in range(self.count):
-            # Get Rx Doses
-            condition = "mrn = '%s' and study_instance_uid = '%s'" % (self.mrn[i], self.study_instance_uid[i])
-            rx_dose_cursor = cnx.query('Plans', 'rx_dose', condition)
-            self.rx_dose.append(rx_dose_cursor[0][0])
-
-            # Process dvh_string to numpy array, and pad with zeros at the end
-            # so that all dvhs are the same length
-            current_dvh = np.array(self.dvh_string[i].split(','), dtype='|S4').astype(np.float)
-            current_dvh_max = np.max(current_dvh)
+            # Normalize each DVH, zero padding is already in place so that all dvhs are the same length
+            current_dvh = dvhs[i]
+            current_dvh_max = np.max(current_dvh) if len(current_dvh) else 0
             if current_dvh_max > 0:
-                current_dvh = np.divide(current_dvh, current_dvh_max)
-            zero_fill = np.zeros(self.bin_count - len(current_dvh))
-            self.dvh[:, i] = np.concatenate((current_dvh, zero_fill))
+                self.dvh[:len(current_dvh), i] = np.divide(current_dvh, current_dvh_max)
+            else:
+                self.dvh[:len(current_dvh), i] = current_dvh
+
+    def fetch_dvhs(self, cnx, constraints_str):
+        """
+        Stream DVHs from SQL, decoding each batch so that only itersize raw DVHs are in memory at once
+        Rows are selected by their row identity (see QuerySQL.stream_by_row_id), so duplicate rows of a study and ROI
+        each get their own DVH and the condition isn't run again. DVHs imported before dvh_bytes existed fall back to
+        dvh_string
+        :param cnx: a DVH_SQL object
+        :param constraints_str: the condition used to query the other DVHs columns
+        :return: a DVH per row of this object, as numpy 1D arrays
+        :rtype: list
+        """
+        def stream_dvhs():
+            decoded = {}
+            columns = "dvh_bytes, CASE WHEN dvh_bytes IS NULL THEN dvh_string END"
+            for rows in self._dvh_data.stream_by_row_id(cnx, columns):
+                for row_id, dvh_bytes, dvh_string in rows:
+                    if dvh_bytes is None:
+                        decoded[row_id] = dvh_string_to_array(dvh_string)
+                    else:
+                        decoded[row_id] = bytes_to_dvh(dvh_bytes)
+            return decoded
+
+        # decoded DVHs are cached, the same query is repeated whenever the main view's selections change
+        decoded = cnx.cached(('dvhs', constraints_str), get_query_tables("from DVHs where %s" % constraints_str),
+                             stream_dvhs)
+
+        return [decoded.get(row_id, np.zeros(0)) for row_id in self._dvh_data.get_row_ids()]
+
+    def __getattr__(self, name):
+        # Columns not fetched initially (e.g., roi_coord_string) are fetched from SQL on first access
+        if not name.startswith('_') and '_dvh_data' in self.__dict__:
+            value = getattr(self._dvh_data, name)
+            setattr(self, name, value)
+            return value
+        raise AttributeError(name)
 
     def get_percentile_dvh(self, percentile):
         """
@@ -0,0 +1,104 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Run database work on worker threads so that the Tornado IOLoop serving the Bokeh apps is never blocked
+"""
+
+from __future__ import print_function
+import threading
+import traceback
+import types
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from sql_connector import DVH_SQL
+from options import SQL_ASYNC_WORKERS
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    :return: the process-wide worker pool, created on first use
+    :rtype: ThreadPoolExecutor
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=SQL_ASYNC_WORKERS)
+        return _executor
+
+
+class AsyncDVH_SQL:
+    def __init__(self, *config):
+        """
+        Same methods as DVH_SQL, but each call runs on a worker thread with its own pooled connection
+        and returns a concurrent.futures.Future of the result
+        :param config: optional dict of connection settings, sql_connection.cnf is used by default
+        """
+        self.config = config
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not callable(getattr(DVH_SQL, name, None)):
+            raise AttributeError(name)
+        return partial(self.submit, name)
+
+    def submit(self, method_name, *args, **kwargs):
+        return get_executor().submit(self.call, method_name, *args, **kwargs)
+
+    def call(self, method_name, *args, **kwargs):
+        try:
+            with DVH_SQL(*self.config) as cnx:
+                result = getattr(cnx, method_name)(*args, **kwargs)
+                if isinstance(result, types.GeneratorType):
+                    result = list(result)  # streams must be read before the connection is returned to the pool
+            return result
+        except Exception:
+            traceback.print_exc()
+            raise
+
+
+def run_async(doc, function, args=(), callback=None, errback=None):
+    """
+    Call function(*args) on a worker thread, then callback(result) on doc's event loop with the document locked.
+    Only callback and errback may modify Bokeh models.
+    :param doc: the Bokeh Document of the session, i.e., curdoc() captured on the event loop
+    :param function: function doing the blocking (e.g., database) work, must not modify Bokeh models
+    :param args: arguments passed to function
+    :param callback: called with the return value of function
+    :param errback: called with the exception if function raises, the traceback is printed either way
+    :return: the future of function's result
+    :rtype: Future
+    """
+    def run():
+        try:
+            return function(*args)
+        except Exception:
+            traceback.print_exc()
+            raise
+
+    return on_result(doc, get_executor().submit(run), callback=callback, errback=errback)
+
+
+def on_result(doc, future, callback=None, errback=None):
+    """
+    Schedule callback(result) on doc's event loop once future is done, e.g., a future from AsyncDVH_SQL
+    :param doc: the Bokeh Document of the session, i.e., curdoc() captured on the event loop
+    :param future: a concurrent.futures.Future
+    :param callback: called with the result of future
+    :param errback: called with the exception if future failed
+    :return: future
+    :rtype: Future
+    """
+    def done(completed_future):
+        # runs on the worker thread, add_next_tick_callback is the thread-safe way back to the document
+        exception = completed_future.exception()
+        if exception is not None:
+            if errback is not None:
+                doc.add_next_tick_callback(partial(errback, exception))
+        elif callback is not None:
+            doc.add_next_tick_callback(partial(callback, completed_future.result()))
+
+    future.add_done_callback(done)
+    return future
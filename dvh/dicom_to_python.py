@@ -9,12 +9,17 @@ Created on Sun Feb 26 11:06:28 2017
 
 from __future__ import print_function
 from future.utils import listitems
-from dicompylercore import dicomparser, dvhcalc
+from dicompylercore import dicomparser, dvhcalc, dvh as dicompyler_dvh
 from dateutil.relativedelta import relativedelta  # python-dateutil
 from roi_name_manager import DatabaseROIs, clean_name
 from utilities import datetime_str_to_obj, dicompyler_roi_coord_to_db_string, change_angle_origin,\
-    surface_area_of_roi, date_str_to_obj
+    surface_area_of_roi, date_str_to_obj, dvh_to_bytes, dicompyler_roi_coord_to_bytes
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+from options import DVH_CALC_WORKERS, DVH_CALC_ENGINE
+from dose_grid import DoseGrid
+from voxel_geometry import fill_polygon_edges
 try:
     import pydicom as dicom  # for pydicom >= 1.0
 except:
@@ -23,7 +28,8 @@ except:
 
 class DVHRow:
     def __init__(self, mrn, study_instance_uid, institutional_roi, physician_roi,
-                 roi_name, roi_type, volume, min_dose, mean_dose, max_dose, dvh_str, roi_coord, surface_area):
+                 roi_name, roi_type, volume, min_dose, mean_dose, max_dose, dvh_str, roi_coord, surface_area,
+                 dvh_bytes, roi_coord_bytes):
 
         for key, value in listitems(locals()):
             if key != 'self':
@@ -57,15 +63,91 @@ class RxRow:
                 setattr(self, key, value)
 
 
+class StudyBundle:
+    def __init__(self, plan_files, structure_file, dose_file):
+        """
+        The DICOM files of a study, each read and parsed at most once no matter how many of PlanRow, BeamTable,
+        DVHTable, and RxTable use it. Files are read on first use, the dose grid is memory mapped (see dose_grid)
+        :param plan_files: a list of RT Plan file paths
+        :param structure_file: RT Structure file path, or None
+        :param dose_file: RT Dose file path, or None
+        """
+        self.plan_files = list(plan_files)
+        self.structure_file = structure_file
+        self.dose_file = dose_file
+        self.datasets = {}
+        self.parsers = {}
+        self.plans = {}
+        self._dose_grid = None
+        self._dose = None
+
+    def get_dataset(self, file_path):
+        """
+        :return: the pydicom dataset of file_path, without PixelData for the dose file (see dose_grid and dose)
+        """
+        if file_path not in self.datasets:
+            if file_path == self.dose_file:
+                self.datasets[file_path] = self.dose_grid.header
+            else:
+                self.datasets[file_path] = dicom.read_file(file_path)
+        return self.datasets[file_path]
+
+    def get_parser(self, file_path):
+        """
+        :return: a dicompyler DicomParser sharing the dataset of file_path
+        """
+        if file_path not in self.parsers:
+            self.parsers[file_path] = dicomparser.DicomParser(self.get_dataset(file_path))
+        return self.parsers[file_path]
+
+    def get_plan(self, plan_file):
+        """
+        :return: dicompyler's summary of plan_file (e.g., rxdose, brachy)
+        :rtype: dict
+        """
+        if plan_file not in self.plans:
+            self.plans[plan_file] = self.get_parser(plan_file).GetPlan()
+        return self.plans[plan_file]
+
+    @property
+    def structure(self):
+        return self.get_dataset(self.structure_file)
+
+    @property
+    def dose_grid(self):
+        """
+        :return: the dose grid of dose_file, whose planes are read from the file as requested
+        :rtype: DoseGrid
+        """
+        if self._dose_grid is None:
+            self._dose_grid = DoseGrid(self.dose_file)
+        return self._dose_grid
+
+    @property
+    def dose(self):
+        """
+        :return: the whole RT Dose dataset, as needed by dvhcalc.get_dvh, its dose grid is decoded once
+        """
+        if self._dose is None:
+            self._dose = dicom.read_file(self.dose_file)
+        return self._dose
+
+
 # Each Plan class object contains data to fill an entire row of the SQL table 'Plans'
 # There will be a Plan class per structure of a Plan
 class PlanRow:
-    def __init__(self, plan_file, structure_file, dose_file):
+    def __init__(self, plan_file, structure_file, dose_file, bundle=None):
+        """
+        :param bundle: a StudyBundle with these files, avoids reading files already read for the other tables
+        """
+        if bundle is None:
+            bundle = StudyBundle([plan_file], structure_file, dose_file)
+
         # Read DICOM files
-        rt_plan = dicom.read_file(plan_file)
-        dicompyler_plan = dicomparser.DicomParser(plan_file).GetPlan()
-        rt_structure = dicom.read_file(structure_file)
-        rt_dose = dicom.read_file(dose_file)
+        rt_plan = bundle.get_dataset(plan_file)
+        dicompyler_plan = bundle.get_plan(plan_file)
+        rt_structure = bundle.get_dataset(structure_file)
+        rt_dose = bundle.get_dataset(dose_file)
 
         # Heterogeneity
         if hasattr(rt_dose, 'TissueHeterogeneityCorrection'):
@@ -295,17 +377,25 @@ class PlanRow:
 
 
 class DVHTable:
-    def __init__(self, structure_file, dose_file):
+    def __init__(self, structure_file, dose_file, workers=DVH_CALC_WORKERS, bundle=None):
+        """
+        :param structure_file: absolute path of an RT Structure file
+        :param dose_file: absolute path of an RT Dose file
+        :param workers: number of processes calculating ROI DVHs, None uses one per CPU
+        :param bundle: a StudyBundle with these files, used when DVHs are calculated in this process
+        """
+        if bundle is None:
+            bundle = StudyBundle([], structure_file, dose_file)
+
         # Get ROI Category Map
         database_rois = DatabaseROIs()
 
         # Import RT Structure and RT Dose files using dicompyler
-        rt_structure_dicom = dicom.read_file(structure_file)
+        rt_structure_dicom = bundle.get_dataset(structure_file)
         mrn = rt_structure_dicom.PatientID
         study_instance_uid = rt_structure_dicom.StudyInstanceUID
 
-        rt_structure = dicomparser.DicomParser(structure_file)
-        rt_structures = rt_structure.GetStructures()
+        rt_structures = bundle.get_parser(structure_file).GetStructures()
 
         if hasattr(rt_structure_dicom, 'PhysiciansOfRecord'):
             physician = rt_structure_dicom.PhysiciansOfRecord.upper()
@@ -314,61 +404,52 @@ class DVHTable:
         else:
             physician = '(NULL)'
 
+        keys = [key for key in rt_structures if rt_structures[key]['type'] != 'MARKER']
+
         values = {}
         row_counter = 0
         self.dvhs = {}
-        for key in rt_structures:
-            # Import DVH from RT Structure and RT Dose files
-            if rt_structures[key]['type'] != 'MARKER':
-
-                current_dvh_calc = dvhcalc.get_dvh(structure_file, dose_file, key)
-                self.dvhs[row_counter] = current_dvh_calc.counts
-                if current_dvh_calc.volume > 0:
-                    print('Importing', current_dvh_calc.name, sep=' ')
-                    if rt_structures[key]['name'].lower().find('itv') == 0:
-                        roi_type = 'ITV'
-                    else:
-                        roi_type = rt_structures[key]['type']
-                    current_roi_name = clean_name(rt_structures[key]['name'])
+        for key, roi in zip(keys, calculate_roi_dvhs(structure_file, dose_file, keys, workers, bundle)):
+            if roi['volume'] > 0:
+                print('Importing', roi['name'], sep=' ')
+                if rt_structures[key]['name'].lower().find('itv') == 0:
+                    roi_type = 'ITV'
+                else:
+                    roi_type = rt_structures[key]['type']
+                current_roi_name = clean_name(rt_structures[key]['name'])
 
-                    if database_rois.is_roi(current_roi_name):
-                        if database_rois.is_physician(physician):
-                            physician_roi = database_rois.get_physician_roi(physician, current_roi_name)
-                            institutional_roi = database_rois.get_institutional_roi(physician, physician_roi)
-                        else:
-                            if current_roi_name in database_rois.institutional_rois:
-                                institutional_roi = current_roi_name
-                            else:
-                                institutional_roi = 'uncategorized'
-                            physician_roi = 'uncategorized'
+                if database_rois.is_roi(current_roi_name):
+                    if database_rois.is_physician(physician):
+                        physician_roi = database_rois.get_physician_roi(physician, current_roi_name)
+                        institutional_roi = database_rois.get_institutional_roi(physician, physician_roi)
                     else:
-                        institutional_roi = 'uncategorized'
+                        if current_roi_name in database_rois.institutional_rois:
+                            institutional_roi = current_roi_name
+                        else:
+                            institutional_roi = 'uncategorized'
                         physician_roi = 'uncategorized'
-
-                    coord = rt_structure.GetStructureCoordinates(key)
-                    roi_coord_str = dicompyler_roi_coord_to_db_string(rt_structure.GetStructureCoordinates(key))
-                    try:
-                        surface_area = surface_area_of_roi(coord)
-                    except:
-                        print("Surface area calculation failed for key, name: %s, %s" % (key, current_dvh_calc.name))
-                        surface_area = '(NULL)'
-                    # volume = calc_volume(get_planes_from_string(roi_coord_str))
-
-                    current_dvh_row = DVHRow(mrn,
-                                             study_instance_uid,
-                                             institutional_roi,
-                                             physician_roi,
-                                             current_roi_name,
-                                             roi_type,
-                                             current_dvh_calc.volume,
-                                             current_dvh_calc.min,
-                                             current_dvh_calc.mean,
-                                             current_dvh_calc.max,
-                                             ','.join(['%.2f' % num for num in current_dvh_calc.counts]),
-                                             roi_coord_str,
-                                             surface_area)
-                    values[row_counter] = current_dvh_row
-                    row_counter += 1
+                else:
+                    institutional_roi = 'uncategorized'
+                    physician_roi = 'uncategorized'
+
+                current_dvh_row = DVHRow(mrn,
+                                         study_instance_uid,
+                                         institutional_roi,
+                                         physician_roi,
+                                         current_roi_name,
+                                         roi_type,
+                                         roi['volume'],
+                                         roi['min'],
+                                         roi['mean'],
+                                         roi['max'],
+                                         ','.join(['%.2f' % num for num in roi['counts']]),
+                                         roi['roi_coord_str'],
+                                         roi['surface_area'],
+                                         roi['dvh_bytes'],
+                                         roi['roi_coord_bytes'])
+                self.dvhs[row_counter] = roi['counts']
+                values[row_counter] = current_dvh_row
+                row_counter += 1
 
         self.count = row_counter
         dvh_range = range(self.count)
@@ -378,13 +459,246 @@ class DVHTable:
                 setattr(self, attr, [getattr(values[x], attr) for x in dvh_range])
 
 
+def calculate_roi_dvhs(structure_file, dose_file, keys, workers=DVH_CALC_WORKERS, bundle=None,
+                       engine=DVH_CALC_ENGINE):
+    """
+    Calculate the DVH, coordinates, and surface area of each ROI
+    :param structure_file: absolute path of an RT Structure file
+    :param dose_file: absolute path of an RT Dose file
+    :param keys: ROI numbers of the structure set
+    :param workers: number of processes used by the 'dicompyler' engine, None uses one per CPU
+    :param bundle: a StudyBundle with these files, used if calculated in this process
+    :param engine: 'numpy', 'dicompyler', or 'validate', see DVH_CALC_ENGINE in options.py
+    :return: the results of calculate_roi_dvh, in the order of keys
+    :rtype: list
+    """
+    if engine in {'numpy', 'validate'}:
+        if bundle is None:
+            bundle = StudyBundle([], structure_file, dose_file)
+        dvhs = calculate_study_dvhs(bundle, keys)
+        if engine == 'validate':
+            reference_dvhs = [dvhcalc.get_dvh(bundle.structure, bundle.dose, key) for key in keys]
+            print_dvh_differences(compare_dvhs(dvhs, reference_dvhs))
+            dvhs = reference_dvhs
+        return [get_roi_dvh_data(bundle, key, dvh) for key, dvh in zip(keys, dvhs)]
+
+    if workers is None:
+        workers = cpu_count()
+    workers = min(workers, len(keys))
+    if workers <= 1:
+        return [calculate_roi_dvh(structure_file, dose_file, key, bundle) for key in keys]
+
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        count = len(keys)
+        # map returns results in the order of keys, regardless of which finishes first
+        return list(executor.map(calculate_roi_dvh, [structure_file] * count, [dose_file] * count, keys))
+    finally:
+        executor.shutdown()
+
+
+def calculate_roi_dvh(structure_file, dose_file, key, bundle=None):
+    """
+    The CPU bound part of importing an ROI with dicompyler, run by worker processes of calculate_roi_dvhs
+    :param structure_file: absolute path of an RT Structure file
+    :param dose_file: absolute path of an RT Dose file
+    :param key: ROI number
+    :param bundle: a StudyBundle with these files, by default one shared by calls in this process
+    :return: see get_roi_dvh_data
+    :rtype: dict
+    """
+    if bundle is None:
+        bundle = get_worker_bundle(structure_file, dose_file)
+    # datasets rather than file names, so neither file is read again and the dose grid is decoded once
+    return get_roi_dvh_data(bundle, key, dvhcalc.get_dvh(bundle.structure, bundle.dose, key))
+
+
+def get_roi_dvh_data(bundle, key, dvh):
+    """
+    :param bundle: the StudyBundle of the ROI
+    :param key: ROI number
+    :param dvh: the cumulative dicompyler DVH of the ROI
+    :return: name, volume, min, mean, max, counts, plus roi_coord_str, surface_area, dvh_bytes, and
+    roi_coord_bytes for ROIs with a volume
+    :rtype: dict
+    """
+    roi = {'name': dvh.name, 'volume': dvh.volume, 'min': dvh.min, 'mean': dvh.mean, 'max': dvh.max,
+           'counts': dvh.counts}
+    if dvh.volume > 0:
+        coord = bundle.get_parser(bundle.structure_file).GetStructureCoordinates(key)
+        roi['roi_coord_str'] = dicompyler_roi_coord_to_db_string(coord)
+        try:
+            roi['surface_area'] = surface_area_of_roi(coord)
+        except:
+            print("Surface area calculation failed for key, name: %s, %s" % (key, dvh.name))
+            roi['surface_area'] = '(NULL)'
+        roi['dvh_bytes'] = dvh_to_bytes(dvh.counts)
+        roi['roi_coord_bytes'] = dicompyler_roi_coord_to_bytes(coord)
+    return roi
+
+
+def calculate_study_dvhs(bundle, keys):
+    """
+    Calculate the DVHs of every ROI in one pass over the dose planes, rather than one pass per ROI.
+    Each dose plane is read once (and only if an ROI has contours on it), the contours of every ROI on that plane
+    are rasterised together (see get_plane_masks), and the dose of every ROI is histogrammed by a single np.bincount.
+    Equivalent to dvhcalc.get_dvh with its default arguments, but dose grid points lying exactly on
+    a contour may be classified differently.
+    :param bundle: a StudyBundle with structure_file and dose_file
+    :param keys: ROI numbers of the structure set
+    :return: the cumulative dicompyler DVH of each ROI, in the order of keys
+    :rtype: list
+    """
+    structure_parser = bundle.get_parser(bundle.structure_file)
+    structures = structure_parser.GetStructures()
+    names = [structures[key]['name'] for key in keys]
+
+    # contours of each ROI by plane: {z: [(roi index, contours)]}, where z is the plane key of dicompyler
+    planes = {}
+    thickness = np.zeros(len(keys))
+    for i, key in enumerate(keys):
+        roi_planes = structure_parser.GetStructureCoordinates(key)
+        if roi_planes:
+            thickness[i] = structure_parser.CalculatePlaneThickness(roi_planes)
+            for z, contours in roi_planes.items():
+                planes.setdefault(z, []).append((i, contours))
+
+    dose_grid = bundle.dose_grid
+    if not planes or not dose_grid.has_pixel_data:
+        return [get_cumulative_dvh(np.array([0]), 0., name) for name in names]
+
+    col_lut, row_lut = [np.array(lut, dtype=np.float64) for lut in dose_grid.lut]
+    pixel_area = abs(np.mean(np.diff(col_lut))) * abs(np.mean(np.diff(row_lut)))
+
+    # 1 cGy bins as dvhcalc, which has a bin up to the maximum dose of the grid, grown here up to the maximum dose
+    # of the planes read instead, the difference being trailing empty bins which get_cumulative_dvh removes
+    histograms = np.zeros((len(keys), 1))
+    voxel_counts = np.zeros(len(keys))
+    for z, plane_rois in planes.items():
+        roi_indices = np.array([i for i, _ in plane_rois])
+        masks = get_plane_masks([contours for _, contours in plane_rois], col_lut, row_lut, dose_grid.x_lut_index)
+        masks = masks.reshape(len(plane_rois), -1)
+
+        dose_plane = dose_grid.get_plane(z)
+        if dose_plane.size:
+            mask_rows, mask_pixels = np.nonzero(masks)
+            pixel_bins = np.floor(dose_plane.ravel()[mask_pixels] * 100).astype(np.intp)
+            in_range = pixel_bins >= 0
+            mask_rows, pixel_bins = mask_rows[in_range], pixel_bins[in_range]
+            if pixel_bins.size and pixel_bins.max() >= histograms.shape[1]:
+                histograms = np.hstack((histograms, np.zeros((len(keys), pixel_bins.max() + 1 - histograms.shape[1]))))
+            bin_count = histograms.shape[1]
+            plane_histograms = np.bincount(mask_rows * bin_count + pixel_bins, minlength=len(plane_rois) * bin_count)
+            plane_histograms = plane_histograms.reshape(len(plane_rois), bin_count)
+            histograms[roi_indices] += plane_histograms
+            voxel_counts[roi_indices] += np.sum(plane_histograms, axis=1)
+        else:
+            # as dvhcalc, contours outside the dose grid count towards the volume only
+            voxel_counts[roi_indices] += np.sum(masks, axis=1)
+
+    volumes = voxel_counts * pixel_area * thickness / 1000.  # cm^3
+    return [get_cumulative_dvh(histogram, volume, name)
+            for histogram, volume, name in zip(histograms, volumes, names)]
+
+
+def get_plane_masks(roi_contours, col_lut, row_lut, x_lut_index):
+    """
+    Rasterise the contours of several ROIs on one dose plane with the even-odd rule, so that contours
+    inside another contour of the same ROI are holes (as the XOR of contour masks in dvhcalc), see fill_polygon_edges
+    :param roi_contours: for each ROI, a list of contours from GetStructureCoordinates for this plane
+    :param col_lut: patient coordinates of the dose grid columns
+    :param row_lut: patient coordinates of the dose grid rows
+    :param x_lut_index: 0 if patient x is across the dose grid columns, 1 for decubitus dose grids
+    :return: boolean masks of the dose grid points inside each ROI, shape (ROI count, rows, columns)
+    :rtype: np.ndarray
+    """
+    # every contour edge of every ROI, as (u, v) where u is along the columns and v along the rows
+    edges, labels = [], []
+    for i, contours in enumerate(roi_contours):
+        for contour in contours:
+            points = np.array([point[0:2] for point in contour['data']], dtype=np.float64)
+            if len(points) > 2:
+                points = points[:, [x_lut_index, 1 - x_lut_index]]
+                edges.append(np.hstack((points, np.roll(points, -1, axis=0))))  # closes the contour
+                labels.append(np.full(len(points), i, dtype=np.intp))
+    if not edges:
+        return np.zeros((len(roi_contours), len(row_lut), len(col_lut)), dtype=bool)
+
+    return fill_polygon_edges(np.vstack(edges), np.concatenate(labels), len(roi_contours), col_lut, row_lut)
+
+
+def get_cumulative_dvh(histogram, volume, name):
+    """
+    :param histogram: voxel counts of each 1 cGy dose bin
+    :param volume: ROI volume in cm^3
+    :param name: ROI name
+    :return: the cumulative DVH, scaled to volume, as built by dvhcalc.get_dvh
+    :rtype: dicompyler_dvh.DVH
+    """
+    if histogram.max() > 0:
+        histogram = np.trim_zeros(histogram * volume / np.sum(histogram), trim='b')
+    else:
+        histogram = np.array([0])
+    bins = np.arange(0, 2) if histogram.size == 1 else np.arange(0, histogram.size + 1) / 100.
+    return dicompyler_dvh.DVH(counts=histogram, bins=bins, dvh_type='differential', dose_units='Gy',
+                              name=name).cumulative
+
+
+def compare_dvhs(dvhs, reference_dvhs):
+    """
+    Validation of calculate_study_dvhs against dvhcalc.get_dvh
+    :param dvhs: cumulative DVHs to validate
+    :param reference_dvhs: cumulative DVHs of the same ROIs, e.g., calculated by dicompyler
+    :return: for each ROI, its name, both volumes (cm^3), the largest difference of min, mean, and max dose (Gy),
+    and the largest difference of the cumulative DVHs as a fraction of the reference volume
+    :rtype: list of dict
+    """
+    differences = []
+    for dvh, reference in zip(dvhs, reference_dvhs):
+        counts = np.zeros(max(dvh.counts.size, reference.counts.size))
+        reference_counts = counts.copy()
+        counts[:dvh.counts.size] = dvh.counts
+        reference_counts[:reference.counts.size] = reference.counts
+        dvh_difference = np.max(np.abs(counts - reference_counts))
+        differences.append({'name': reference.name,
+                            'volume': dvh.volume,
+                            'reference_volume': reference.volume,
+                            'dose': max([abs(getattr(dvh, stat) - getattr(reference, stat))
+                                         for stat in ['min', 'mean', 'max']]),
+                            'dvh': dvh_difference / reference.volume if reference.volume else dvh_difference})
+    return differences
+
+
+def print_dvh_differences(differences):
+    print('DVH validation: ROI, volume (cm^3), reference volume, max dose difference (Gy), max DVH difference (%)')
+    for roi in differences:
+        print('    %s, %0.3f, %0.3f, %0.2f, %0.2f' %
+              (roi['name'], roi['volume'], roi['reference_volume'], roi['dose'], roi['dvh'] * 100))
+
+
+_worker_bundle = {}
+
+
+def get_worker_bundle(structure_file, dose_file):
+    # each worker process reads a study's files once, rather than once per ROI
+    if _worker_bundle.get('files') != (structure_file, dose_file):
+        _worker_bundle['bundle'] = StudyBundle([], structure_file, dose_file)
+        _worker_bundle['files'] = (structure_file, dose_file)
+    return _worker_bundle['bundle']
+
+
 class BeamTable:
-    def __init__(self, plan_file):
+    def __init__(self, plan_file, bundle=None):
+        """
+        :param bundle: a StudyBundle with plan_file, avoids reading files already read for the other tables
+        """
+        if bundle is None:
+            bundle = StudyBundle([plan_file], None, None)
 
         beam_num = 0
         values = {}
         # Import RT Dose files using dicompyler
-        rt_plan = dicom.read_file(plan_file)
+        rt_plan = bundle.get_dataset(plan_file)
 
         mrn = rt_plan.PatientID
         study_instance_uid = rt_plan.StudyInstanceUID
@@ -586,11 +900,17 @@ class BeamTable:
 
 
 class RxTable:
-    def __init__(self, plan_file, structure_file):
+    def __init__(self, plan_file, structure_file, bundle=None):
+        """
+        :param bundle: a StudyBundle with these files, avoids reading files already read for the other tables
+        """
+        if bundle is None:
+            bundle = StudyBundle([plan_file], structure_file, None)
+
         values = {}
-        rt_plan = dicom.read_file(plan_file)
-        dicompyler_plan = dicomparser.DicomParser(plan_file).GetPlan()
-        rt_structure = dicom.read_file(structure_file)
+        rt_plan = bundle.get_dataset(plan_file)
+        dicompyler_plan = bundle.get_plan(plan_file)
+        rt_structure = bundle.get_dataset(structure_file)
         fx_grp_seq = rt_plan.FractionGroupSequence
 
         # Record Medical Record Number
@@ -699,10 +1019,11 @@ class RxTable:
 
 
 def get_tables(structure_file, dose_file, plan_file):
-    dvh_table = DVHTable(structure_file, dose_file)
-    plan_table = PlanRow(plan_file, structure_file, dose_file)
-    rx_table = RxTable(plan_file, structure_file)
-    beam_table = BeamTable(plan_file)
+    bundle = StudyBundle([plan_file], structure_file, dose_file)
+    dvh_table = DVHTable(structure_file, dose_file, bundle=bundle)
+    plan_table = PlanRow(plan_file, structure_file, dose_file, bundle=bundle)
+    rx_table = RxTable(plan_file, structure_file, bundle=bundle)
+    beam_table = BeamTable(plan_file, bundle=bundle)
 
     return dvh_table, plan_table, rx_table, beam_table
 
@@ -7,16 +7,16 @@ Created on Thu Mar  2 22:15:52 2017
 """
 
 from __future__ import print_function
+from future.utils import listitems
 from sql_connector import DVH_SQL
-from dicom_to_python import DVHTable, PlanRow, BeamTable, RxTable
+from dicom_to_python import DVHTable, PlanRow, BeamTable, RxTable, StudyBundle
+from utilities import scan_dicom_headers
 import os
 import shutil
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
-from options import IMPORT_LATEST_PLAN_ONLY, SETTINGS_PATHS
-try:
-    import pydicom as dicom  # for pydicom >= 1.0
-except:
-    import dicom
+from options import IMPORT_LATEST_PLAN_ONLY, SETTINGS_PATHS, DVH_CALC_WORKERS
 from get_settings import get_settings, parse_settings_file
 
 
@@ -24,12 +24,22 @@ FILE_TYPES = {'rtplan', 'rtstruct', 'rtdose'}
 SCRIPT_DIR = os.path.dirname(__file__)
 
 
-def dicom_to_sql(start_path=None, force_update=False, move_files=True, update_dicom_catalogue_table=True):
+def dicom_to_sql(start_path=None, force_update=False, move_files=True, update_dicom_catalogue_table=True, workers=1):
+    """
+    Import every study in the inbox (or start_path) into the database
+    :param start_path: directory to import instead of the inbox, relative to this directory
+    :param force_update: import studies already in the database and studies without a plan, struct, and dose file
+    :param move_files: move imported files from the inbox into the imported directory
+    :param update_dicom_catalogue_table: add a row to DICOM_Files for each imported study
+    :param workers: number of processes reading DICOM files and calculating DVHs, studies are written to the
+    database one at a time by this process
+    """
 
     start_time = datetime.now()
     print(str(start_time), 'Beginning import', sep=' ')
 
     dicom_catalogue_update = []
+    failed_imports = {}
 
     # Read SQL configuration file
     abs_file_path = get_settings('import')
@@ -43,6 +53,7 @@ def dicom_to_sql(start_path=None, force_update=False, move_files=True, update_di
 
     file_paths = get_file_paths(import_settings['inbox'])
 
+    uids = []
     for uid in list(file_paths):
 
         if is_uid_imported(uid):
@@ -59,81 +70,41 @@ def dicom_to_sql(start_path=None, force_update=False, move_files=True, update_di
                 print("Force Update set to True. Processing with import.")
                 print("WARNING: This import may contain duplicate data already in the database.")
 
-        dicom_catalogue_update.append(uid)
+        uids.append(uid)
 
-        # Collect and print the file paths
-        plan_file = file_paths[uid]['rtplan']['latest_file']
-        struct_file = file_paths[uid]['rtstruct']['latest_file']
-        dose_file = file_paths[uid]['rtdose']['latest_file']
-        if IMPORT_LATEST_PLAN_ONLY:
-            print("plan file: %s" % plan_file)
-        else:
-            for f in file_paths[uid]['rtplan']['file_path']:
-                print("plan file: %s" % f)
-        print("struct file: %s" % struct_file)
-        print("dose file: %s" % dose_file)
-
-        # Process DICOM files into Python objects
-        plan, beams, dvhs, rxs = [], [], [], []
-        mp, ms, md = [], [], []
-        if plan_file:
-            mp = dicom.read_file(plan_file).ManufacturerModelName.lower()
-        if struct_file:
-            ms = dicom.read_file(struct_file).ManufacturerModelName.lower()
-        if dose_file:
-            md = dicom.read_file(dose_file).ManufacturerModelName.lower()
+    for uid, study, error in process_studies(uids, file_paths, force_update, workers):
+
+        dicom_catalogue_update.append(uid)
 
-        if 'gammaplan' in "%s %s %s" % (mp, ms, md):
-            print("Leksell Gamma Plan is not currently supported. Skipping import.")
+        if error:
+            print("ERROR: Import of uid %s failed\n%s" % (uid, error))
+            failed_imports[uid] = error
+            continue
+        if study is None:
             continue
 
-        if plan_file and struct_file and dose_file:
-            if IMPORT_LATEST_PLAN_ONLY:
-                plan = PlanRow(plan_file, struct_file, dose_file)
-                sqlcnx.insert_plan(plan)
-            else:
-                for f in file_paths[uid]['rtplan']['file_path']:
-                    plan = PlanRow(f, struct_file, dose_file)
+        # All inserts for this study are committed together, and rolled back together on failure
+        try:
+            with sqlcnx.transaction():
+                for plan in study['plans']:
                     sqlcnx.insert_plan(plan)
-        else:
-            print('WARNING: Missing complete set of plan, struct, and dose files for uid %s' % uid)
-            if not force_update:
-                print('WARNING: Skipping this import. If you wish to import an incomplete DICOM set, use Force Update')
-                print('WARNING: The current file will be moved to the misc folder with in your imported folder')
-                continue
-
-        if plan_file:
-            if not hasattr(dicom.read_file(plan_file), 'BrachyTreatmentType'):
-                if IMPORT_LATEST_PLAN_ONLY:
-                    beams = BeamTable(plan_file)
+                for beams in study['beams']:
                     sqlcnx.insert_beams(beams)
-                else:
-                    for f in file_paths[uid]['rtplan']['file_path']:
-                        sqlcnx.insert_beams(BeamTable(f))
-        if struct_file and dose_file:
-            dvhs = DVHTable(struct_file, dose_file)
-            setattr(dvhs, 'ptv_number', rank_ptvs_by_D95(dvhs))
-            sqlcnx.insert_dvhs(dvhs)
-        if plan_file and struct_file:
-            if IMPORT_LATEST_PLAN_ONLY:
-                rxs = RxTable(plan_file, struct_file)
-                sqlcnx.insert_rxs(rxs)
-            else:
-                for f in file_paths[uid]['rtplan']['file_path']:
-                    sqlcnx.insert_rxs(RxTable(f, struct_file))
+                if study['dvhs']:
+                    sqlcnx.insert_dvhs(study['dvhs'])
+                for rxs in study['rxs']:
+                    sqlcnx.insert_rxs(rxs)
+        except Exception:
+            error = traceback.format_exc()
+            print("ERROR: Could not write uid %s to the database\n%s" % (uid, error))
+            failed_imports[uid] = error
+            continue
 
-        # get mrn for folder name, can't assume a complete set of dose, plan, struct files
-        mrn = []
-        if dose_file:
-            mrn = dicom.read_file(dose_file).PatientID
-        elif plan_file:
-            mrn = dicom.read_file(plan_file).PatientID
-        elif struct_file:
-            mrn = dicom.read_file(struct_file).PatientID
-        if mrn:
-            mrn = "".join(x for x in mrn if x.isalnum())  # remove any special characters
-        else:
-            mrn = 'NoMRN'
+        plan_file = file_paths[uid]['rtplan']['latest_file']
+        struct_file = file_paths[uid]['rtstruct']['latest_file']
+        dose_file = file_paths[uid]['rtdose']['latest_file']
+        mrn = study['mrn']
+        new_folder = os.path.join(import_settings['imported'], mrn)
 
         # convert file_paths[uid] into a list of file paths
         if move_files:
@@ -142,7 +113,6 @@ def dicom_to_sql(start_path=None, force_update=False, move_files=True, update_di
             for file_type in move_types:
                 files_to_move.extend(file_paths[uid][file_type]['file_path'])
 
-            new_folder = os.path.join(import_settings['imported'], mrn)
             move_files_to_new_path(files_to_move, new_folder)
 
         if plan_file:
@@ -162,11 +132,20 @@ def dicom_to_sql(start_path=None, force_update=False, move_files=True, update_di
         move_all_files(import_settings['imported'], import_settings['inbox'])
         remove_empty_folders(import_settings['inbox'])
 
+    # Refresh planner statistics after a bulk import
+    if dicom_catalogue_update:
+        sqlcnx.analyze()
+
     sqlcnx.close()
 
     end_time = datetime.now()
     print(str(end_time), 'Import complete', sep=' ')
 
+    if failed_imports:
+        print("%d of %d studies failed to import:" % (len(failed_imports), len(uids)))
+        for uid, error in listitems(failed_imports):
+            print("    %s: %s" % (uid, error.strip().splitlines()[-1]))
+
     total_time = end_time - start_time
     seconds = total_time.seconds
     m, s = divmod(seconds, 60)
@@ -179,6 +158,118 @@ def dicom_to_sql(start_path=None, force_update=False, move_files=True, update_di
         print("This import took %02dsec to complete" % s)
 
 
+def process_studies(uids, file_paths, force_update, workers=1):
+    """
+    Read DICOM files and calculate DVHs for each study, in worker processes if workers > 1
+    :param uids: study instance uids to process
+    :param file_paths: file paths by uid, from get_file_paths
+    :param force_update: process studies without a plan, struct, and dose file
+    :param workers: number of worker processes, studies are processed in this process if 1
+    :return: a generator of (uid, study, error) in order of completion, see process_study for study,
+    error is the traceback if processing failed
+    """
+    if workers > 1 and len(uids) > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        try:
+            # studies processed in parallel each calculate their ROIs in a single process
+            futures = [executor.submit(process_study_safely, uid, file_paths[uid], force_update, 1) for uid in uids]
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()  # only studies not yet started, if the caller stopped early
+            executor.shutdown(wait=False)
+    else:
+        for uid in uids:
+            yield process_study_safely(uid, file_paths[uid], force_update)
+
+
+def process_study_safely(uid, study_file_paths, force_update, roi_workers=DVH_CALC_WORKERS):
+    # tracebacks are formatted here, since they are lost when an exception is returned from a worker process
+    try:
+        return uid, process_study(uid, study_file_paths, force_update, roi_workers), None
+    except Exception:
+        return uid, None, traceback.format_exc()
+
+
+def process_study(uid, study_file_paths, force_update, roi_workers=DVH_CALC_WORKERS):
+    """
+    Read the DICOM files of a study into the python objects inserted by DVH_SQL, no database access is needed
+    :param uid: study instance uid
+    :param study_file_paths: file_paths[uid] from get_file_paths
+    :param force_update: process the study even without a plan, struct, and dose file
+    :param roi_workers: number of processes calculating ROI DVHs, see DVHTable
+    :return: dict of plans, beams, and rxs (lists), dvhs (a DVHTable or None), and mrn (for the folder name),
+    or None if the study should be skipped
+    :rtype: dict
+    """
+
+    # Collect and print the file paths
+    plan_file = study_file_paths['rtplan']['latest_file']
+    struct_file = study_file_paths['rtstruct']['latest_file']
+    dose_file = study_file_paths['rtdose']['latest_file']
+    if IMPORT_LATEST_PLAN_ONLY:
+        plan_files = [plan_file] if plan_file else []
+        print("plan file: %s" % plan_file)
+    else:
+        plan_files = study_file_paths['rtplan']['file_path']
+        for f in plan_files:
+            print("plan file: %s" % f)
+    print("struct file: %s" % struct_file)
+    print("dose file: %s" % dose_file)
+
+    # Process DICOM files into Python objects, each file is read once and shared by all tables
+    bundle = StudyBundle(plan_files, struct_file, dose_file)
+    study = {'plans': [], 'beams': [], 'dvhs': None, 'rxs': []}
+    mp, ms, md = [], [], []
+    if plan_file:
+        mp = bundle.get_dataset(plan_file).ManufacturerModelName.lower()
+    if struct_file:
+        ms = bundle.get_dataset(struct_file).ManufacturerModelName.lower()
+    if dose_file:
+        md = bundle.get_dataset(dose_file).ManufacturerModelName.lower()
+
+    if 'gammaplan' in "%s %s %s" % (mp, ms, md):
+        print("Leksell Gamma Plan is not currently supported. Skipping import.")
+        return None
+
+    if plan_file and struct_file and dose_file:
+        study['plans'] = [PlanRow(f, struct_file, dose_file, bundle=bundle) for f in plan_files]
+    else:
+        print('WARNING: Missing complete set of plan, struct, and dose files for uid %s' % uid)
+        if not force_update:
+            print('WARNING: Skipping this import. '
+                  'If you wish to import an incomplete DICOM set, use Force Update')
+            print('WARNING: The current file will be moved to the misc folder with in your imported folder')
+            return None
+
+    if plan_file:
+        if not hasattr(bundle.get_dataset(plan_file), 'BrachyTreatmentType'):
+            study['beams'] = [BeamTable(f, bundle=bundle) for f in plan_files]
+    if struct_file and dose_file:
+        dvhs = DVHTable(struct_file, dose_file, workers=roi_workers, bundle=bundle)
+        setattr(dvhs, 'ptv_number', rank_ptvs_by_D95(dvhs))
+        study['dvhs'] = dvhs
+    if plan_file and struct_file:
+        study['rxs'] = [RxTable(f, struct_file, bundle=bundle) for f in plan_files]
+
+    # get mrn for folder name, can't assume a complete set of dose, plan, struct files
+    mrn = []
+    if dose_file:
+        mrn = bundle.get_dataset(dose_file).PatientID
+    elif plan_file:
+        mrn = bundle.get_dataset(plan_file).PatientID
+    elif struct_file:
+        mrn = bundle.get_dataset(struct_file).PatientID
+    if mrn:
+        mrn = "".join(x for x in mrn if x.isalnum())  # remove any special characters
+    else:
+        mrn = 'NoMRN'
+    study['mrn'] = mrn
+
+    return study
+
+
 def get_file_paths(start_path):
     print('Collecting DICOM file paths')
     f = []
@@ -187,16 +278,12 @@ def get_file_paths(start_path):
             f.append(os.path.join(root, name))
 
     # Collect all dicom files by UID, separate non-dicom files into misc
+    # Only the header of each file is read, pixel data (e.g., CT slices, dose grids) is skipped
     file_paths = {}
-    for file_path in f:
-        try:
-            dicom_file = dicom.read_file(file_path)
-        except:
-            dicom_file = False
-
-        if dicom_file:
-            uid = dicom_file.StudyInstanceUID
-            file_type = dicom_file.Modality.lower()  # (rtplan, rtstruct, rtdose)
+    for file_path, header in zip(f, scan_dicom_headers(f)):
+        if header:
+            uid = header['study_instance_uid']
+            file_type = header['modality']  # (rtplan, rtstruct, rtdose)
             timestamp = os.path.getmtime(file_path)
 
             if uid not in list(file_paths):
@@ -225,22 +312,23 @@ def get_file_paths(start_path):
     return file_paths
 
 
-def rebuild_database(start_path):
+def rebuild_database(start_path, workers=1):
     print('connecting to SQL DB')
     sqlcnx = DVH_SQL()
     print('connection established')
 
     sqlcnx.reinitialize_database()
     print('DB reinitialized with no data')
-    dicom_to_sql(start_path=start_path, force_update=True)
-    sqlcnx.cnx.close()
+    dicom_to_sql(start_path=start_path, force_update=True, workers=workers)
+    sqlcnx.close()
 
 
 def is_uid_imported(uid):
 
-    for table in {'DVHs', 'Plans', 'Beams', 'Rxs'}:
-        if DVH_SQL().is_study_instance_uid_in_table(table, uid):
-            return True
+    with DVH_SQL() as cnx:
+        for table in {'DVHs', 'Plans', 'Beams', 'Rxs'}:
+            if cnx.is_study_instance_uid_in_table(table, uid):
+                return True
     return False
 
 
@@ -277,11 +365,9 @@ def move_files_to_new_path(files, new_dir):
     for file_path in files:
         file_name = os.path.basename(file_path)
         new = os.path.join(new_dir, file_name)
-        try:
-            shutil.move(file_path, new)
-        except:
-            os.mkdir(new_dir)
-            shutil.move(file_path, new)
+        if not os.path.isdir(new_dir):
+            os.makedirs(new_dir)
+        shutil.move(file_path, new)
 
 
 def remove_empty_folders(start_path):
@@ -326,9 +412,9 @@ def move_all_files(new_dir, old_dir):
 def update_dicom_catalogue(mrn, uid, dir_path, plan_file, struct_file, dose_file):
     if not plan_file:
         plan_file = "(NULL)"
-    if not plan_file:
+    if not struct_file:
         struct_file = "(NULL)"
-    if not plan_file:
+    if not dose_file:
         dose_file = "(NULL)"
     DVH_SQL().insert_dicom_file_row(mrn, uid, dir_path, plan_file, struct_file, dose_file)
 
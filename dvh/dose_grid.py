@@ -0,0 +1,146 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Memory mapped access to the dose grid of an RT Dose file
+Only the header is read into memory, dose planes are paged in from the file as they are requested, so DVHs of
+ROIs intersecting a few planes of a large (e.g., 1 mm VMAT or SRS) dose grid never load the whole grid
+"""
+
+from __future__ import print_function
+from dicompylercore import dicomparser
+import numpy as np
+import struct
+try:
+    import pydicom as dicom  # for pydicom >= 1.0
+except:
+    import dicom
+
+
+# Transfer syntaxes whose pixel data is stored as is, and can therefore be memory mapped
+UNCOMPRESSED_TRANSFER_SYNTAXES = {'1.2.840.10008.1.2': '<',  # Implicit VR Little Endian
+                                  '1.2.840.10008.1.2.1': '<',  # Explicit VR Little Endian
+                                  '1.2.840.10008.1.2.2': '>'}  # Explicit VR Big Endian
+
+
+class DoseGrid:
+    def __init__(self, dose_file):
+        """
+        :param dose_file: absolute path of an RT Dose file
+        """
+        self.dose_file = dose_file
+
+        # pydicom stops reading at the start of the PixelData element, whose header is parsed here
+        with open(dose_file, 'rb') as document:
+            self.header = dicom.read_file(document, stop_before_pixels=True)
+            self.has_pixel_data, self.pixel_data_offset = read_pixel_data_header(document, self.header)
+
+        self.parser = dicomparser.DicomParser(self.header)
+        self.scaling = float(getattr(self.header, 'DoseGridScaling', 1.))
+        self._frames = None
+
+    @property
+    def lut(self):
+        """
+        :return: patient coordinates of the columns and of the rows of the dose grid, see GetPatientToPixelLUT
+        :rtype: tuple
+        """
+        return self.parser.GetPatientToPixelLUT()
+
+    @property
+    def x_lut_index(self):
+        """
+        :return: 0 if patient x is across the dose grid columns, 1 for decubitus dose grids
+        """
+        return self.parser.x_lut_index()
+
+    @property
+    def plane_positions(self):
+        """
+        :return: z of each dose plane in patient coordinates (mm), or None if the grid is not multi-frame
+        :rtype: np.ndarray
+        """
+        if 'GridFrameOffsetVector' not in self.header:
+            return None
+        z_sign = 1 if self.parser.is_head_first_orientation() else -1
+        return z_sign * np.array(self.header.GridFrameOffsetVector, dtype=np.float64) + \
+            float(self.header.ImagePositionPatient[2])
+
+    @property
+    def frames(self):
+        """
+        :return: the stored (unscaled) dose values, shape (frames, rows, columns), memory mapped when possible
+        :rtype: np.ndarray
+        """
+        if self._frames is None and self.has_pixel_data:
+            self._frames = self.map_frames()
+        return self._frames
+
+    def map_frames(self):
+        transfer_syntax = str(self.header.file_meta.TransferSyntaxUID)
+        byte_order = UNCOMPRESSED_TRANSFER_SYNTAXES.get(transfer_syntax)
+        shape = (int(getattr(self.header, 'NumberOfFrames', 1)), int(self.header.Rows), int(self.header.Columns))
+
+        if byte_order is None or self.pixel_data_offset is None or \
+                int(getattr(self.header, 'SamplesPerPixel', 1)) != 1 or \
+                int(self.header.BitsAllocated) not in {8, 16, 32}:
+            # e.g., compressed or small pixel data, decoded into memory as dicompyler would
+            pixel_array = dicom.read_file(self.dose_file).pixel_array
+            return pixel_array.reshape(shape)
+
+        signed = int(getattr(self.header, 'PixelRepresentation', 0)) == 1
+        dtype = np.dtype('%s%s%d' % (byte_order, 'i' if signed else 'u', int(self.header.BitsAllocated) // 8))
+        return np.memmap(self.dose_file, dtype=dtype, mode='r', offset=self.pixel_data_offset, shape=shape)
+
+    def get_plane(self, z, threshold=0.5):
+        """
+        The dose plane at z in Gy, only the frames needed are read from the file.
+        Same planes as dicompyler's GetDoseGrid (scaled by DoseGridScaling)
+        :param z: plane position in patient coordinates (mm)
+        :param threshold: largest distance (mm) to a frame used without interpolation
+        :return: the dose plane, interpolated between frames if needed, empty if z is outside the grid
+        :rtype: np.ndarray
+        """
+        positions = self.plane_positions
+        if positions is None or self.frames is None:
+            return np.array([])
+        z = float(z)
+
+        distances = np.fabs(positions - z)
+        frame = np.argmin(distances)
+        if distances[frame] < threshold:
+            return self.frames[frame] * self.scaling
+        if z < np.amin(positions) or z > np.amax(positions):
+            return np.array([])
+
+        # linear interpolation between the two closest frames, as dicompyler's InterpolateDosePlanes
+        upper = frame
+        distances[upper] = np.amax(distances)
+        lower = np.argmin(distances)
+        fz = (z - positions[lower]) / (positions[upper] - positions[lower])
+        plane = fz * self.frames[upper] + (1.0 - fz) * self.frames[lower]
+        return plane * self.scaling
+
+    def close(self):
+        """
+        Release the memory map, the header remains available
+        """
+        self._frames = None
+
+
+def read_pixel_data_header(document, header):
+    """
+    :param document: a DICOM file, positioned after the elements read with stop_before_pixels
+    :param header: the dataset read from document
+    :return: whether document has PixelData, and the file offset of its value (None if encapsulated)
+    :rtype: tuple
+    """
+    byte_order = '<' if header.is_little_endian else '>'
+    tag = document.read(4)
+    if len(tag) < 4 or struct.unpack(byte_order + 'HH', tag) != (0x7fe0, 0x0010):
+        return False, None
+    if not header.is_implicit_VR:
+        document.read(4)  # VR (OB or OW) and 2 reserved bytes
+    length = struct.unpack(byte_order + 'L', document.read(4))[0]
+    if length == 0xffffffff:  # undefined length, i.e., encapsulated (compressed) frames
+        return True, None
+    return True, document.tell()
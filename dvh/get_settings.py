@@ -1,5 +1,11 @@
 from options import SETTINGS_PATHS
 import os
+import threading
+
+
+# Parsed settings files keyed by absolute path, each entry is (mtime, size, settings)
+_settings_cache = {}
+_settings_cache_lock = threading.Lock()
 
 
 def get_settings(settings_type):
@@ -15,6 +21,26 @@ def get_settings(settings_type):
 
 
 def parse_settings_file(abs_file_path):
+    """
+    :param abs_file_path: absolute path to a settings file
+    :return: settings from the file, re-parsed only if the file has been modified since the last call
+    :rtype: dict
+    """
+    stat = os.stat(abs_file_path)
+    with _settings_cache_lock:
+        cached = _settings_cache.get(abs_file_path)
+        if cached and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+            return dict(cached[2])
+
+    settings = read_settings_file(abs_file_path)
+
+    with _settings_cache_lock:
+        _settings_cache[abs_file_path] = (stat.st_mtime, stat.st_size, settings)
+
+    return dict(settings)
+
+
+def read_settings_file(abs_file_path):
     with open(abs_file_path, 'r') as document:
         settings = {}
         for line in document:
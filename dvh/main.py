@@ -10,11 +10,13 @@ Created on Sun Apr 21 2017
 from __future__ import print_function
 from future.utils import listitems
 from analysis_tools import DVH, calc_eud
-from utilities import Temp_DICOM_FileSet, get_planes_from_string, get_union,\
-    collapse_into_single_dates, moving_avg, calc_stats, get_study_instance_uids, moving_avg_by_calendar_day
+from utilities import Temp_DICOM_FileSet, get_roi_from_db_values, get_union,\
+    collapse_into_single_dates, moving_avg, calc_stats, get_study_instance_uid_condition, moving_avg_by_calendar_day
 import auth
 from sql_connector import DVH_SQL
 from sql_to_python import QuerySQL
+from async_sql import run_async
+from dicom_to_python import StudyBundle, calculate_study_dvhs
 import numpy as np
 import itertools
 from datetime import datetime
@@ -60,6 +62,11 @@ uids_1, uids_2 = [], []
 correlation_1, correlation_2 = {}, {}
 mlc_data = []
 bad_uid_1, bad_uid_2 = [], []
+study_roi_names, study_plan_files = {}, {}  # by study_instance_uid, loaded with the DVHs for the ROI viewer and MLC
+
+# Document of this session, needed to apply results of work done on worker threads
+bokeh_doc = curdoc()
+update_data_button_state = None  # label and type of the query button while a query is running
 
 temp_dvh_info = Temp_DICOM_FileSet()
 dvh_review_mrns = temp_dvh_info.mrn
@@ -683,8 +690,8 @@ def update_ep_row_on_selection(attr, old, new):
 # Query functions
 # !!!!!!!!!!!!!!!!!!!!!!!!!!!!
 
-# This function returns the list of information needed to execute QuerySQL from
-# SQL_to_Python.py (i.e., uids and dvh_condition)
+# This function returns the condition needed to execute QuerySQL from
+# SQL_to_Python.py (i.e., dvh_condition, which also applies the plan, rx, and beam criteria)
 # This function can be used for one group at a time, or both groups. Using both groups is useful so that duplicate
 # DVHs do not show up in the plot (i.e., if a DVH satisfies both group criteria)
 def get_query(group=None):
@@ -767,31 +774,112 @@ def get_query(group=None):
         queries[table] = ' AND '.join(temp_str)
         print(str(datetime.now()), '%s = %s' % (table, queries[table]), sep=' ')
 
-    # Get a list of UIDs that fit the plan, rx, and beam query criteria.  DVH query criteria will not alter the
-    # list of UIDs, therefore dvh_query is not needed to get the UID list
-    print(str(datetime.now()), 'getting uids', sep=' ')
-    uids = get_study_instance_uids(plans=queries['Plans'], rxs=queries['Rxs'], beams=queries['Beams'])['union']
+    # Plan, rx, and beam criteria are applied as semi-joins so that the DVHs are selected with a single query
+    uid_condition = get_study_instance_uid_condition(plans=queries['Plans'], rxs=queries['Rxs'],
+                                                     beams=queries['Beams'])
+    if queries['DVHs']:
+        dvh_condition = "(%s) AND %s" % (queries['DVHs'], uid_condition)
+    else:
+        dvh_condition = uid_condition
 
-    # uids: a unique list of all uids that satisfy the criteria
-    # queries['DVHs']: the dvh query string for SQL
-    return uids, queries['DVHs']
+    # dvh_condition: the dvh query string for SQL, including the plan, rx, and beam criteria
+    return dvh_condition
 
 
-# main update function
+# main update function, the DVH queries run on a worker thread so other sessions aren't blocked
 def update_data():
-    global current_dvh, current_dvh_group_1, current_dvh_group_2, bad_uid
-    bad_uid = []
-    old_update_button_label = query_button.label
-    old_update_button_type = query_button.button_type
+    global update_data_button_state
+    if update_data_button_state is not None:
+        return  # a query is already running for this session
+    update_data_button_state = (query_button.label, query_button.button_type)
     query_button.label = 'Updating...'
     query_button.button_type = 'warning'
+
+    # The query strings are read from the Bokeh models here, on the event loop
     print(str(datetime.now()), 'Constructing query for complete dataset', sep=' ')
-    uids, dvh_query_str = get_query()
-    print(str(datetime.now()), 'getting dvh data', sep=' ')
-    current_dvh = DVH(uid=uids, dvh_condition=dvh_query_str)
-    if current_dvh.count:
+    try:
+        group_1_constraint_count, group_2_constraint_count = group_constraint_count()
+        queries = {'all': get_query(),
+                   'group_1': get_query(group=1) if group_1_constraint_count else None,
+                   'group_2': get_query(group=2) if group_2_constraint_count else None}
+    except Exception:
+        restore_query_button()  # otherwise every later Query click would be ignored
+        raise
+    run_async(bokeh_doc, load_dvh_data, args=(queries,), callback=apply_dvh_data, errback=restore_query_button)
+
+
+class DVHQueryResults:
+    def __init__(self, queries):
+        """
+        All of the database work of update_data: the DVHs of the complete dataset and of each group, the beam,
+        plan, and rx data of their studies, and the ROI names and plan files used by the ROI viewer and MLC analyzer.
+        Loaded on a worker thread, so no Bokeh models may be read or modified here
+        :param queries: DVHs table conditions by 'all', 'group_1', and 'group_2', None for a group without constraints
+        :type queries: dict
+        """
+        print(str(datetime.now()), 'getting dvh data', sep=' ')
+        self.dvh = DVH(dvh_condition=queries['all'])
+        self.dvh_group_1, self.dvh_group_2 = [], []
+        self.beams, self.plans, self.rxs = None, None, None
+        self.roi_names, self.plan_files = {}, {}
+        if not self.dvh.count:
+            return
+
+        if queries['group_1'] is not None:
+            print(str(datetime.now()), 'getting group 1 dvh data', sep=' ')
+            self.dvh_group_1 = DVH(dvh_condition=queries['group_1'])
+        if queries['group_2'] is not None:
+            print(str(datetime.now()), 'getting group 2 dvh data', sep=' ')
+            self.dvh_group_2 = DVH(dvh_condition=queries['group_2'])
+
+        print(str(datetime.now()), 'getting beam, plan, rx data', sep=' ')
+        uids = list(set(self.dvh.study_instance_uid))
+        cond_str = "study_instance_uid in ('" + "', '".join(uids) + "')"
+        self.beams = QuerySQL('Beams', cond_str)
+        self.plans = QuerySQL('Plans', cond_str)
+        self.rxs = QuerySQL('Rxs', cond_str)
+
+        with DVH_SQL() as cnx:
+            for uid, roi_name in cnx.query('DVHs', 'study_instance_uid, roi_name', cond_str):
+                self.roi_names.setdefault(uid, set()).add(str(roi_name))
+            for uid, folder_path, plan_file in cnx.query('DICOM_Files', 'study_instance_uid, folder_path, plan_file',
+                                                         cond_str):
+                self.plan_files.setdefault(uid, (folder_path, plan_file))
+
+
+def load_dvh_data(queries):
+    # Runs on a worker thread, must not read or modify any Bokeh models
+    return DVHQueryResults(queries)
+
+
+def restore_query_button(*exception):
+    global update_data_button_state
+    query_button.label, query_button.button_type = update_data_button_state
+    update_data_button_state = None
+
+
+def apply_dvh_data(results):
+    # Runs on the event loop with the DVHQueryResults of load_dvh_data, only the Bokeh models are updated here
+    global current_dvh, current_dvh_group_1, current_dvh_group_2, bad_uid, study_roi_names, study_plan_files
+    bad_uid = []
+    current_dvh = results.dvh
+    if not current_dvh.count:
+        print(str(datetime.now()), 'empty dataset returned', sep=' ')
+        query_button.label = 'No Data'
+        query_button.button_type = 'danger'
+        bokeh_doc.add_timeout_callback(restore_query_button, 2500)
+        return
+
+    try:
         print(str(datetime.now()), 'initializing source data ', current_dvh.query, sep=' ')
-        current_dvh_group_1, current_dvh_group_2 = update_dvh_data(current_dvh)
+        current_dvh_group_1, current_dvh_group_2 = results.dvh_group_1, results.dvh_group_2
+        study_roi_names, study_plan_files = results.roi_names, results.plan_files
+        update_dvh_data(current_dvh, current_dvh_group_1, current_dvh_group_2)
+        print(str(datetime.now()), 'begin updating beam, plan, rx data sources', sep=' ')
+        update_beam_data(results.beams)
+        update_plan_data(results.plans)
+        update_rx_data(results.rxs)
+        print(str(datetime.now()), 'all sources set', sep=' ')
         print(str(datetime.now()), 'updating correlation data')
         update_correlation()
         print(str(datetime.now()), 'correlation data updated')
@@ -801,28 +889,20 @@ def update_data():
         control_chart_y.value = ''
         update_roi_viewer_mrn()
         update_mlc_analyzer_mrn()
-    else:
-        print(str(datetime.now()), 'empty dataset returned', sep=' ')
-        query_button.label = 'No Data'
-        query_button.button_type = 'danger'
-        time.sleep(2.5)
-
-    query_button.label = old_update_button_label
-    query_button.button_type = old_update_button_type
+    finally:
+        restore_query_button()
 
 
 # input is a DVH class from Analysis_Tools.py
 # This function creates a new ColumnSourceData and calls
 # the functions to update beam, rx, and plans ColumnSourceData variables
-def update_dvh_data(dvh):
+# dvh_group_1 and dvh_group_2 are [] if the group has no constraints, see DVHQueryResults
+def update_dvh_data(dvh, dvh_group_1, dvh_group_2):
     global uids_1, uids_2, anon_id_map
 
-    dvh_group_1, dvh_group_2 = [], []
-    group_1_constraint_count, group_2_constraint_count = group_constraint_count()
-
-    if group_1_constraint_count and group_2_constraint_count:
+    if dvh_group_1 and dvh_group_2:
         extra_rows = 12
-    elif group_1_constraint_count or group_2_constraint_count:
+    elif dvh_group_1 or dvh_group_2:
         extra_rows = 6
     else:
         extra_rows = 0
@@ -847,7 +927,7 @@ def update_dvh_data(dvh):
 
     print(str(datetime.now()), 'calculating patches', sep=' ')
 
-    if group_1_constraint_count == 0:
+    if not dvh_group_1:
         uids_1 = []
         source_patch_1.data = {'x_patch': [],
                                'y_patch': []}
@@ -859,9 +939,6 @@ def update_dvh_data(dvh):
                                'q3': [],
                                'max': []}
     else:
-        print(str(datetime.now()), 'Constructing Group 1 query', sep=' ')
-        uids_1, dvh_query_str = get_query(group=1)
-        dvh_group_1 = DVH(uid=uids_1, dvh_condition=dvh_query_str)
         uids_1 = dvh_group_1.study_instance_uid
         stat_dvhs_1 = dvh_group_1.get_standard_stat_dvh(dose_scale=stat_dose_scale, volume_scale=stat_volume_scale)
 
@@ -879,7 +956,7 @@ def update_dvh_data(dvh):
                                'median': stat_dvhs_1['median'].tolist(),
                                'q3': stat_dvhs_1['q3'].tolist(),
                                'max': stat_dvhs_1['max'].tolist()}
-    if group_2_constraint_count == 0:
+    if not dvh_group_2:
         uids_2 = []
         source_patch_2.data = {'x_patch': [],
                                'y_patch': []}
@@ -891,9 +968,6 @@ def update_dvh_data(dvh):
                                'q3': [],
                                'max': []}
     else:
-        print(str(datetime.now()), 'Constructing Group 2 query', sep=' ')
-        uids_2, dvh_query_str = get_query(group=2)
-        dvh_group_2 = DVH(uid=uids_2, dvh_condition=dvh_query_str)
         uids_2 = dvh_group_2.study_instance_uid
         stat_dvhs_2 = dvh_group_2.get_standard_stat_dvh(dose_scale=stat_dose_scale, volume_scale=stat_volume_scale)
 
@@ -968,14 +1042,14 @@ def update_dvh_data(dvh):
     dvh_groups.insert(0, 'Review')
 
     for n in range(6):
-        if group_1_constraint_count > 0:
+        if dvh_group_1:
             dvh.mrn.append(y_names[n])
             dvh.roi_name.append('N/A')
             x_data.append(x_axis_stat.tolist())
             current = stat_dvhs_1[y_names[n].lower()].tolist()
             y_data.append(current)
             dvh_groups.append('Group 1')
-        if group_2_constraint_count > 0:
+        if dvh_group_2:
             dvh.mrn.append(y_names[n])
             dvh.roi_name.append('N/A')
             x_data.append(x_axis_stat.tolist())
@@ -989,7 +1063,7 @@ def update_dvh_data(dvh):
         dvh.institutional_roi.extend(['N/A'] * extra_rows)
         dvh.physician_roi.extend(['N/A'] * extra_rows)
         dvh.roi_type.extend(['Stat'] * extra_rows)
-    if group_1_constraint_count > 0:
+    if dvh_group_1:
         dvh.rx_dose.extend(calc_stats(dvh_group_1.rx_dose))
         dvh.volume.extend(calc_stats(dvh_group_1.volume))
         dvh.surface_area.extend(calc_stats(dvh_group_1.surface_area))
@@ -1001,7 +1075,7 @@ def update_dvh_data(dvh):
         dvh.dist_to_ptv_mean.extend(calc_stats(dvh_group_1.dist_to_ptv_mean))
         dvh.dist_to_ptv_max.extend(calc_stats(dvh_group_1.dist_to_ptv_max))
         dvh.ptv_overlap.extend(calc_stats(dvh_group_1.ptv_overlap))
-    if group_2_constraint_count > 0:
+    if dvh_group_2:
         dvh.rx_dose.extend(calc_stats(dvh_group_2.rx_dose))
         dvh.volume.extend(calc_stats(dvh_group_2.volume))
         dvh.surface_area.extend(calc_stats(dvh_group_2.surface_area))
@@ -1068,20 +1142,9 @@ def update_dvh_data(dvh):
                    'x_scale': x_scale,
                    'y_scale': y_scale}
 
-    print(str(datetime.now()), 'begin updating beam, plan, rx data sources', sep=' ')
-    update_beam_data(dvh.study_instance_uid)
-    update_plan_data(dvh.study_instance_uid)
-    update_rx_data(dvh.study_instance_uid)
-    print(str(datetime.now()), 'all sources set', sep=' ')
 
-    return dvh_group_1, dvh_group_2
-
-
-# updates beam ColumnSourceData for a given list of uids
-def update_beam_data(uids):
-
-    cond_str = "study_instance_uid in ('" + "', '".join(uids) + "')"
-    beam_data = QuerySQL('Beams', cond_str)
+# updates beam ColumnSourceData with the Beams QuerySQL of a DVHQueryResults
+def update_beam_data(beam_data):
 
     groups = get_group_list(beam_data.study_instance_uid)
 
@@ -1129,11 +1192,8 @@ def update_beam_data(uids):
                          'treatment_machine': beam_data.treatment_machine}
 
 
-# updates plan ColumnSourceData for a given list of uids
-def update_plan_data(uids):
-
-    cond_str = "study_instance_uid in ('" + "', '".join(uids) + "')"
-    plan_data = QuerySQL('Plans', cond_str)
+# updates plan ColumnSourceData with the Plans QuerySQL of a DVHQueryResults
+def update_plan_data(plan_data):
 
     # Determine Groups
     groups = get_group_list(plan_data.study_instance_uid)
@@ -1160,11 +1220,8 @@ def update_plan_data(uids):
                          'baseline': plan_data.baseline}
 
 
-# updates rx ColumnSourceData for a given list of uids
-def update_rx_data(uids):
-
-    cond_str = "study_instance_uid in ('" + "', '".join(uids) + "')"
-    rx_data = QuerySQL('Rxs', cond_str)
+# updates rx ColumnSourceData with the Rxs QuerySQL of a DVHQueryResults
+def update_rx_data(rx_data):
 
     groups = get_group_list(rx_data.study_instance_uid)
 
@@ -1473,7 +1530,8 @@ def roi_viewer_go_to_next_slice():
 
 def update_roi_viewer_rois():
 
-    options = DVH_SQL().get_unique_values('DVHs', 'roi_name', "study_instance_uid = '%s'" % roi_viewer_uid_select.value)
+    # ROI names are loaded with the DVHs, see DVHQueryResults
+    options = list(study_roi_names.get(roi_viewer_uid_select.value, []))
     options.sort()
 
     roi_viewer_roi_select.options = options
@@ -1510,18 +1568,18 @@ def update_roi_viewer_data(roi_name):
 
     roi_data = {}
     uid = roi_viewer_uid_select.value
-    roi_coord_string = DVH_SQL().query('dvhs',
-                                       'roi_coord_string',
-                                       "study_instance_uid = '%s' and roi_name = '%s'" % (uid, roi_name))
-    roi_planes = get_planes_from_string(roi_coord_string[0][0])
+    roi_coordinates = DVH_SQL().query('dvhs',
+                                      'roi_coord_bytes, roi_coord_string',
+                                      "study_instance_uid = '%s' and roi_name = '%s'" % (uid, roi_name))
+    roi_planes = get_roi_from_db_values(*roi_coordinates[0]).slices()
     for z_plane in list(roi_planes):
         x, y, z = [], [], []
         for polygon in roi_planes[z_plane]:
             initial_polygon_index = len(x)
             for point in polygon:
-                x.append(point[0])
-                y.append(point[1])
-                z.append(point[2])
+                x.append(float(point[0]))
+                y.append(float(point[1]))
+                z.append(float(point[2]))
             x.append(x[initial_polygon_index])
             y.append(y[initial_polygon_index])
             z.append(z[initial_polygon_index])
@@ -1538,14 +1596,14 @@ def update_tv_data():
     tv_data = {}
 
     uid = roi_viewer_uid_select.value
-    ptv_coordinates_strings = DVH_SQL().query('dvhs',
-                                              'roi_coord_string',
-                                              "study_instance_uid = '%s' and roi_type like 'PTV%%'"
-                                              % uid)
+    ptv_coordinates = DVH_SQL().query('dvhs',
+                                      'roi_coord_bytes, roi_coord_string',
+                                      "study_instance_uid = '%s' and roi_type like 'PTV%%'"
+                                      % uid)
 
-    if ptv_coordinates_strings:
+    if ptv_coordinates:
 
-        ptvs = [get_planes_from_string(ptv[0]) for ptv in ptv_coordinates_strings]
+        ptvs = [get_roi_from_db_values(*ptv).slices() for ptv in ptv_coordinates]
         tv_planes = get_union(ptvs)
 
     for z_plane in list(tv_planes):
@@ -1553,9 +1611,9 @@ def update_tv_data():
         for polygon in tv_planes[z_plane]:
             initial_polygon_index = len(x)
             for point in polygon:
-                x.append(point[0])
-                y.append(point[1])
-                z.append(point[2])
+                x.append(float(point[0]))
+                y.append(float(point[1]))
+                z.append(float(point[2]))
             x.append(x[initial_polygon_index])
             y.append(y[initial_polygon_index])
             z.append(z[initial_polygon_index])
@@ -1686,7 +1744,7 @@ def update_mlc_analyzer_uid():
 
 
 def mlc_analyzer_uid_ticker(attr, old, new):
-    rt_plan = DVH_SQL().query('DICOM_Files', 'folder_path, plan_file', "study_instance_uid = '%s'" % new)[0]
+    rt_plan = study_plan_files[new]  # loaded with the DVHs, see DVHQueryResults
     folder_path = rt_plan[0]
     if not os.path.isdir(folder_path):
         folder_path = os.path.join(parse_settings_file(get_settings('import'))['imported'],
@@ -2878,7 +2936,11 @@ def calculate_review_dvh():
 
             rt_st = dicomparser.DicomParser(structure_file)
             rt_structures = rt_st.GetStructures()
-            review_dvh = dvhcalc.get_dvh(structure_file, dose_file, key)
+            if DVH_CALC_ENGINE == 'dicompyler':
+                review_dvh = dvhcalc.get_dvh(structure_file, dose_file, key)
+            else:
+                # the dose grid is memory mapped, only the planes of this ROI are read
+                review_dvh = calculate_study_dvhs(StudyBundle([], structure_file, dose_file), [key])[0]
             dicompyler_plan = dicomparser.DicomParser(plan_file).GetPlan()
 
             roi_name = rt_structures[key]['name']
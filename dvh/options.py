@@ -106,6 +106,42 @@ COMPLEXITY_SCORE_Y_WEIGHT = 1.
 # If set to false, all plan files will be processed and imported
 IMPORT_LATEST_PLAN_ONLY = False
 
+# DVH calculation during import:
+#   'numpy': every ROI of a study in one pass over the dose planes (see calculate_study_dvhs)
+#   'dicompyler': one ROI at a time with dicompyler's dvhcalc.get_dvh
+#   'validate': both, printing their differences per ROI, the dicompyler DVHs are stored
+DVH_CALC_ENGINE = 'numpy'
+
+# Number of processes calculating the DVHs of a study's ROIs with the 'dicompyler' engine, None uses one per CPU
+# Ignored when studies are imported in parallel (dvh import --workers N), each study then uses a single process
+DVH_CALC_WORKERS = None
+
+# Number of threads reading DICOM headers when scanning the inbox (or review directory) for files to import
+DICOM_SCAN_WORKERS = 8
+
+# Threads used by each nearest PTV point query of the PTV distance calculation, -1 uses one per CPU
+PTV_DISTANCE_WORKERS = 1
+
+# Number of ROI points per nearest PTV point query, limiting the memory used by each query
+PTV_DISTANCE_CHUNK_SIZE = 100000
+
+# Engine of each ROI geometry calculation of the post import calculations (dvh recalc or the admin view)
+#   'polygon': contour polygons, shapely for PTV unions and overlaps, nearest contour points for PTV distances
+#   'voxel': boolean masks of the contours on a grid of GEOMETRY_VOXEL_SIZE (mm) in-plane by the slice thickness,
+#            volumes and overlaps are voxel sums, PTV distances come from a Euclidean distance transform
+#   'validate': both, printing their differences, the 'polygon' results are stored
+GEOMETRY_ENGINES = {'volume': 'polygon',
+                    'overlap': 'polygon',
+                    'distance': 'polygon'}
+GEOMETRY_VOXEL_SIZE = 1.
+
+# Number of processes recalculating ROI geometry (dvh recalc and the admin Post Import Calculations),
+# each process calculates one study at a time, None uses one per CPU
+RECALC_WORKERS = None
+
+# Recalculated ROI values are written to the database once this many ROIs have been calculated
+RECALC_BATCH_SIZE = 500
+
 # The following tabs are not dependent on each other, therefore could be excluded from the user view
 # The layout for DVH Analytics is relatively large for Bokeh and can be relatively slow due to this
 # Therefore, if there are particular tabs a user does not want to render, they can be set to False
@@ -123,3 +159,26 @@ SETTINGS_PATHS = {'docker': {'import': "/import_settings.txt",
                   'default': {'import': "preferences/import_settings.txt",
                               'sql': "preferences/sql_connection.cnf"}}
 
+# Maximum number of open connections kept per process by the DVH_SQL connection pool
+# A DVH_SQL object waits up to SQL_POOL_TIMEOUT seconds for a connection if all are in use
+SQL_POOL_MAX_CONNECTIONS = 10
+SQL_POOL_TIMEOUT = 30
+
+# Number of rows fetched per round trip by DVH_SQL.query_stream, which large queries use to limit memory
+SQL_STREAM_ITERSIZE = 2000
+
+# Query results are cached in memory until a table they read is changed, up to this many bytes per database
+SQL_CACHE_MAX_BYTES = 512 * 1024 ** 2
+
+# Worker threads used by the Bokeh apps for database work, keep below SQL_POOL_MAX_CONNECTIONS
+SQL_ASYNC_WORKERS = 4
+
+# Statements taking longer than SQL_SLOW_QUERY_SECONDS are appended to SQL_SLOW_QUERY_LOG (relative to this directory)
+# SELECT statements are logged with their plan (EXPLAIN), SQL_EXPLAIN_ANALYZE runs them again on PostgreSQL with
+# EXPLAIN (ANALYZE, BUFFERS) for actual times, which doubles the cost of every slow query
+# The slowest SQL_SLOW_QUERY_COUNT statements are shown in the admin view and by the 'dvh slow_queries' command
+SQL_SLOW_QUERY_SECONDS = 2.
+SQL_SLOW_QUERY_LOG = "preferences/slow_queries.log"
+SQL_SLOW_QUERY_COUNT = 50
+SQL_EXPLAIN_SLOW_QUERIES = True
+SQL_EXPLAIN_ANALYZE = False
@@ -0,0 +1,10 @@
+CREATE INDEX IF NOT EXISTS dvhs_uid_roi_name_idx ON DVHs (study_instance_uid, roi_name);
+CREATE INDEX IF NOT EXISTS dvhs_physician_roi_idx ON DVHs (physician_roi);
+CREATE INDEX IF NOT EXISTS dvhs_institutional_roi_idx ON DVHs (institutional_roi);
+CREATE INDEX IF NOT EXISTS dvhs_roi_type_idx ON DVHs (roi_type);
+CREATE INDEX IF NOT EXISTS plans_uid_idx ON Plans (study_instance_uid);
+CREATE INDEX IF NOT EXISTS plans_sim_study_date_idx ON Plans (sim_study_date);
+CREATE INDEX IF NOT EXISTS plans_mrn_idx ON Plans (mrn);
+CREATE INDEX IF NOT EXISTS beams_uid_idx ON Beams (study_instance_uid);
+CREATE INDEX IF NOT EXISTS rxs_uid_idx ON Rxs (study_instance_uid);
+CREATE INDEX IF NOT EXISTS dicom_files_uid_idx ON DICOM_Files (study_instance_uid);
@@ -0,0 +1 @@
+ALTER TABLE DVHs ADD COLUMN IF NOT EXISTS dvh_bytes bytea;
@@ -0,0 +1 @@
+ALTER TABLE DVHs ADD COLUMN IF NOT EXISTS roi_coord_bytes bytea;
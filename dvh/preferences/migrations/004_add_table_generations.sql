@@ -0,0 +1,6 @@
+CREATE TABLE IF NOT EXISTS table_generations (table_name varchar(30) PRIMARY KEY, generation bigint NOT NULL);
+INSERT INTO table_generations SELECT 'dvhs', 0 WHERE NOT EXISTS (SELECT 1 FROM table_generations WHERE table_name = 'dvhs');
+INSERT INTO table_generations SELECT 'plans', 0 WHERE NOT EXISTS (SELECT 1 FROM table_generations WHERE table_name = 'plans');
+INSERT INTO table_generations SELECT 'rxs', 0 WHERE NOT EXISTS (SELECT 1 FROM table_generations WHERE table_name = 'rxs');
+INSERT INTO table_generations SELECT 'beams', 0 WHERE NOT EXISTS (SELECT 1 FROM table_generations WHERE table_name = 'beams');
+INSERT INTO table_generations SELECT 'dicom_files', 0 WHERE NOT EXISTS (SELECT 1 FROM table_generations WHERE table_name = 'dicom_files');
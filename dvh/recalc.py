@@ -0,0 +1,248 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Batch recalculation of ROI geometry (PTV distances, PTV overlap, volume, and surface area) from the contours
+stored in the DVHs table. Work is partitioned by study across a process pool, each study's contours are read with
+one query, and the results are written back with bulk updates every RECALC_BATCH_SIZE ROIs.
+Used by the 'dvh recalc' command and the Post Import Calculations of the admin view.
+"""
+
+from __future__ import print_function
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count
+from sql_connector import DVH_SQL
+from utilities import get_roi_from_db_values, get_study_contours, calculate_tv_metrics, write_roi_updates, \
+    calc_volume, surface_area_of_roi
+from options import RECALC_WORKERS, RECALC_BATCH_SIZE
+
+
+# Calculations available to recalculate_geometry, in the order they are listed by the 'dvh recalc' command
+RECALC_TYPES = ['distances', 'overlap', 'volume', 'surface']
+
+# ROIs whose PTV distances are not calculated, as roi_name or physician_roi
+DISTANCE_SKIPPED_ROIS = {'external', 'skin', 'uncategorized', 'ignored'}
+DISTANCE_ROI_TYPES = {'organ', 'ctv', 'gtv'}
+
+
+class RecalcProgress:
+    def __init__(self, total_studies, total_rois):
+        """
+        Progress, throughput, and estimated time remaining of a recalculate_geometry run
+        :param total_studies: number of studies to be recalculated
+        :param total_rois: number of ROIs to be recalculated
+        """
+        self.total_studies = total_studies
+        self.total_rois = total_rois
+        self.studies = 0
+        self.rois = 0
+        self.failed_studies = []
+        self.start_time = time.time()
+
+    def add_study(self, roi_count, failed_uid=None):
+        """
+        :param roi_count: number of ROIs of a completed study
+        :param failed_uid: study_instance_uid of the study if its calculations failed
+        """
+        self.studies += 1
+        self.rois += roi_count
+        if failed_uid is not None:
+            self.failed_studies.append(failed_uid)
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    @property
+    def percent(self):
+        if not self.total_rois:
+            return 100
+        return int(100. * self.rois / self.total_rois)
+
+    @property
+    def rois_per_second(self):
+        elapsed = self.elapsed
+        return self.rois / elapsed if elapsed else 0.
+
+    @property
+    def eta(self):
+        """
+        :return: estimated seconds remaining, None until a study is complete
+        """
+        rate = self.rois_per_second
+        if not rate:
+            return None
+        return (self.total_rois - self.rois) / rate
+
+    def get_label(self):
+        """
+        :return: a short summary for a button label, e.g., 42% (ETA 05:12)
+        :rtype: str
+        """
+        eta = self.eta
+        if eta is None:
+            return '%d%%' % self.percent
+        return '%d%% (ETA %s)' % (self.percent, format_seconds(eta))
+
+    def __str__(self):
+        eta = self.eta
+        return '%d%%: %d of %d studies, %d of %d ROIs, %0.1f ROIs/sec, elapsed %s, ETA %s' % \
+               (self.percent, self.studies, self.total_studies, self.rois, self.total_rois, self.rois_per_second,
+                format_seconds(self.elapsed), format_seconds(eta) if eta is not None else 'unknown')
+
+
+def format_seconds(seconds):
+    m, s = divmod(int(seconds), 60)
+    h, m = divmod(m, 60)
+    if h:
+        return '%d:%02d:%02d' % (h, m, s)
+    return '%02d:%02d' % (m, s)
+
+
+def recalculate_geometry(what, condition=None, workers=RECALC_WORKERS, batch_size=RECALC_BATCH_SIZE,
+                         report_progress=None):
+    """
+    Recalculate ROI geometry of every study with ROIs matching condition, writing the results in batches
+    :param what: a list of RECALC_TYPES
+    :param condition: SQL condition applied to the DVHs table, all ROIs by default
+    :param workers: number of worker processes, studies are calculated in this process if 1, None uses one per CPU
+    :param batch_size: results are written once this many ROIs are calculated
+    :param report_progress: called with a RecalcProgress after each study
+    :return: the progress of the completed run
+    :rtype: RecalcProgress
+    """
+    invalid = [calculation for calculation in what if calculation not in RECALC_TYPES]
+    if invalid:
+        raise ValueError("Invalid calculation(s): %s, select from %s" % (', '.join(invalid), ', '.join(RECALC_TYPES)))
+
+    jobs = get_recalc_jobs(what, condition)
+    progress = RecalcProgress(len(jobs), sum([get_roi_count(roi_names) for roi_names in jobs.values()]))
+    if workers is None:
+        workers = cpu_count()
+
+    batch, batch_rois = {}, 0
+    with DVH_SQL() as cnx:
+        for uid, updates, error in calculate_studies(jobs, workers):
+            if error:
+                print("Geometry recalculation failed for %s:\n%s" % (uid, error))
+            else:
+                for columns, rows in updates.items():
+                    batch.setdefault(columns, []).extend(rows)
+                batch_rois += get_roi_count(jobs[uid])
+            progress.add_study(get_roi_count(jobs[uid]), failed_uid=uid if error else None)
+
+            if batch_rois >= batch_size:
+                write_roi_updates(cnx, batch)
+                batch, batch_rois = {}, 0
+
+            if report_progress is not None:
+                report_progress(progress)
+
+        write_roi_updates(cnx, batch)
+
+    return progress
+
+
+def get_recalc_jobs(what, condition=None):
+    """
+    :param what: a list of RECALC_TYPES
+    :param condition: SQL condition applied to the DVHs table, all ROIs by default
+    :return: roi_names to recalculate by calculation (a dict), by study_instance_uid
+    :rtype: OrderedDict
+    """
+    jobs = OrderedDict()
+    with DVH_SQL() as cnx:
+        for rois in cnx.query_stream('dvhs', 'study_instance_uid, roi_name, roi_type, physician_roi', condition):
+            for uid, roi_name, roi_type, physician_roi in rois:
+                roi_names = jobs.setdefault(uid, OrderedDict([(calculation, []) for calculation in what]))
+                for calculation in what:
+                    if calculation != 'distances' or is_distance_calculated(roi_name, roi_type, physician_roi):
+                        roi_names[calculation].append(roi_name)
+    return jobs
+
+
+def is_distance_calculated(roi_name, roi_type, physician_roi):
+    """
+    :return: True if PTV distances are calculated for this ROI, i.e., an organ, CTV, or GTV that is not the
+    external or skin, and has a physician_roi
+    :rtype: bool
+    """
+    return str(roi_type).lower() in DISTANCE_ROI_TYPES and \
+        str(roi_name).lower() not in DISTANCE_SKIPPED_ROIS and \
+        str(physician_roi).lower() not in DISTANCE_SKIPPED_ROIS
+
+
+def get_roi_count(roi_names):
+    """
+    :param roi_names: roi_names by calculation, from get_recalc_jobs
+    :return: number of ROIs with at least one calculation
+    :rtype: int
+    """
+    return len(set([roi_name for names in roi_names.values() for roi_name in names]))
+
+
+def calculate_studies(jobs, workers=1):
+    """
+    Calculate the geometry of each study, in worker processes if workers > 1
+    :param jobs: from get_recalc_jobs
+    :param workers: number of worker processes
+    :return: a generator of (uid, updates, error) in order of completion, see calculate_study_geometry
+    """
+    uids = [uid for uid, roi_names in jobs.items() if get_roi_count(roi_names)]
+    if workers > 1 and len(uids) > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        try:
+            futures = [executor.submit(calculate_study_geometry_safely, uid, jobs[uid]) for uid in uids]
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()  # only studies not yet started, if the caller stopped early
+            executor.shutdown(wait=False)
+    else:
+        for uid in uids:
+            yield calculate_study_geometry_safely(uid, jobs[uid])
+
+
+def calculate_study_geometry_safely(uid, roi_names):
+    # tracebacks are formatted here, since they are lost when an exception is returned from a worker process
+    try:
+        return uid, calculate_study_geometry(uid, roi_names), None
+    except Exception:
+        return uid, None, traceback.format_exc()
+
+
+def calculate_study_geometry(uid, roi_names):
+    """
+    Calculate the geometry of a study's ROIs from the contours in the database, nothing is written
+    :param uid: study_instance_uid
+    :param roi_names: roi_names to recalculate by calculation, see RECALC_TYPES
+    :return: rows of (row identity, roi_name, values) by tuple of updated columns, see write_roi_updates
+    :rtype: dict
+    """
+    all_roi_names = set([roi_name for names in roi_names.values() for roi_name in names])
+    tv_metrics = bool(roi_names.get('distances') or roi_names.get('overlap'))
+
+    with DVH_SQL() as cnx:
+        contours = get_study_contours(cnx, uid, all_roi_names, ptvs=tv_metrics)
+
+    updates = {}
+    if tv_metrics:
+        updates = calculate_tv_metrics(contours,
+                                       min_distance_rois=roi_names.get('distances', []),
+                                       tv_overlap_rois=roi_names.get('overlap', []))
+
+    # every row of a roi_name is calculated, a study may have duplicate rows (e.g., after a Force Update import)
+    for row_id, roi_name, roi_type, roi_coord_bytes, roi_coord_string in contours:
+        if roi_name not in all_roi_names:
+            continue
+        roi = get_roi_from_db_values(roi_coord_bytes, roi_coord_string)
+        if roi_name in roi_names.get('volume', []):
+            updates.setdefault(('volume',), []).append((row_id, roi_name, [round(float(calc_volume(roi)), 2)]))
+        if roi_name in roi_names.get('surface', []):
+            surface_area = surface_area_of_roi(roi, coord_type="sets_of_points")
+            updates.setdefault(('surface_area',), []).append((row_id, roi_name, [round(float(surface_area), 2)]))
+
+    return updates
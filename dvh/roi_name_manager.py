@@ -499,7 +499,7 @@ def get_physician_from_uid(uid):
 def update_uncategorized_rois_in_database():
     roi_map = DatabaseROIs()
     dvh_data = QuerySQL('DVHs', "physician_roi = 'uncategorized'")
-    cnx = DVH_SQL()
+    new_values = {'study_instance_uid': [], 'roi_name': [], 'physician_roi': [], 'institutional_roi': []}
 
     for i in range(len(dvh_data.roi_name)):
         uid = dvh_data.study_instance_uid[i]
@@ -512,17 +512,19 @@ def update_uncategorized_rois_in_database():
 
         if new_physician_roi != 'uncategorized':
             print(mrn, physician, new_institutional_roi, new_physician_roi, roi_name, sep=' ')
-            condition = "study_instance_uid = '" + uid + "'" + "and roi_name = '" + roi_name + "'"
-            cnx.update('DVHs', 'physician_roi', new_physician_roi, condition)
-            cnx.update('DVHs', 'institutional_roi', new_institutional_roi, condition)
+            new_values['study_instance_uid'].append(uid)
+            new_values['roi_name'].append(roi_name)
+            new_values['physician_roi'].append(new_physician_roi)
+            new_values['institutional_roi'].append(new_institutional_roi)
 
-    cnx.close()
+    with DVH_SQL() as cnx:
+        cnx.bulk_update('DVHs', ['study_instance_uid', 'roi_name'], new_values)
 
 
 def reinitialize_roi_categories_in_database():
     roi_map = DatabaseROIs()
     dvh_data = QuerySQL('DVHs', "mrn != ''")
-    cnx = DVH_SQL()
+    new_values = {'study_instance_uid': [], 'roi_name': [], 'physician_roi': [], 'institutional_roi': []}
 
     for i in range(len(dvh_data.roi_name)):
         uid = dvh_data.study_instance_uid[i]
@@ -533,11 +535,13 @@ def reinitialize_roi_categories_in_database():
         new_institutional_roi = roi_map.get_institutional_roi(physician, roi_name)
 
         print(i, physician, new_institutional_roi, new_physician_roi, roi_name, sep=' ')
-        condition = "study_instance_uid = '" + uid + "'" + "and roi_name = '" + roi_name + "'"
-        cnx.update('DVHs', 'physician_roi', new_physician_roi, condition)
-        cnx.update('DVHs', 'institutional_roi', new_institutional_roi, condition)
+        new_values['study_instance_uid'].append(uid)
+        new_values['roi_name'].append(roi_name)
+        new_values['physician_roi'].append(new_physician_roi)
+        new_values['institutional_roi'].append(new_institutional_roi)
 
-    cnx.close()
+    with DVH_SQL() as cnx:
+        cnx.bulk_update('DVHs', ['study_instance_uid', 'roi_name'], new_values)
 
 
 def print_uncategorized_rois():
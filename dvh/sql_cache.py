@@ -0,0 +1,106 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+In-memory cache of query results used by DVH_SQL, QuerySQL and DVH
+Entries are invalidated by the generation counters in the table_generations table, which DVH_SQL increments
+whenever it inserts, updates, or deletes rows of a table
+"""
+
+from __future__ import print_function
+import re
+import sys
+import threading
+from collections import OrderedDict
+import numpy as np
+from options import SQL_CACHE_MAX_BYTES
+
+
+# Tables whose changes are tracked by table_generations
+TRACKED_TABLES = {'dvhs', 'plans', 'rxs', 'beams', 'dicom_files'}
+
+
+class QueryCache:
+    def __init__(self, max_bytes=SQL_CACHE_MAX_BYTES):
+        """
+        Thread-safe LRU cache of query results, limited by the estimated size of its contents
+        :param max_bytes: results are evicted, least recently used first, to keep the cache below this size
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key: (generations, result, size)
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, generations):
+        """
+        :param key: a hashable key, see normalize_sql
+        :param generations: current generation of each table the result depends on
+        :return: the cached result, or None if missing or any of its tables have changed since it was stored
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != generations:
+                self.discard(key)
+                return None
+            # move to the end, i.e., most recently used
+            del self.entries[key]
+            self.entries[key] = entry
+            return entry[1]
+
+    def set(self, key, generations, result):
+        size = estimate_size(result)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self.discard(key)
+            self.entries[key] = (generations, result, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.discard(next(iter(self.entries)))
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+def normalize_sql(query_str):
+    """
+    :param query_str: an SQL statement
+    :return: query_str with whitespace collapsed and without the trailing semicolon, for use as a cache key
+    :rtype: str
+    """
+    return ' '.join(query_str.split()).rstrip(';').strip()
+
+
+def get_query_tables(query_str):
+    """
+    :param query_str: an SQL query
+    :return: the tracked tables read by the query, or None if the query reads any other table
+    :rtype: tuple
+    """
+    tables = set([t.lower() for t in re.findall(r'\b(?:from|join)\s+(\w+)', query_str, re.IGNORECASE)])
+    if not tables or not tables.issubset(TRACKED_TABLES):
+        return None
+    return tuple(sorted(tables))
+
+
+def estimate_size(obj):
+    """
+    :param obj: a query result, typically a list of tuples, a dict of columns, or numpy arrays
+    :return: approximate memory used by obj in bytes
+    :rtype: int
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum([estimate_size(k) + estimate_size(v) for k, v in obj.items()])
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum([estimate_size(item) for item in obj])
+    return sys.getsizeof(obj)
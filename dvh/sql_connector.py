@@ -7,14 +7,166 @@ Created on Sat Mar  4 11:33:10 2017
 """
 
 from __future__ import print_function
-import psycopg2
+import psycopg2.pool
 import os
+import re
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 from get_settings import get_settings, parse_settings_file
+from options import SQL_POOL_MAX_CONNECTIONS, SQL_POOL_TIMEOUT, SQL_STREAM_ITERSIZE, SQL_SLOW_QUERY_SECONDS,\
+    SQL_EXPLAIN_SLOW_QUERIES, SQL_EXPLAIN_ANALYZE
+from sql_engines import get_sql_engine, BINARY_TYPES, ROW_ID
+from sql_cache import QueryCache, TRACKED_TABLES, normalize_sql, get_query_tables, estimate_size
+from sql_stats import QueryStats, InstrumentedCursor, write_slow_query
+
+
+class ConnectionPool:
+    def __init__(self, config, engine, max_connections=SQL_POOL_MAX_CONNECTIONS, timeout=SQL_POOL_TIMEOUT):
+        """
+        Thread-safe pool of connections sharing one configuration
+        :param config: connection settings passed to engine.connect
+        :param engine: a PostgreSQLEngine or SQLiteEngine from sql_engines
+        :param max_connections: maximum number of connections open at once
+        :param timeout: seconds to wait for a connection to be returned before raising an error
+        """
+        self.config = config
+        self.engine = engine
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.idle = []
+        self.unreset = []  # connections returned without a rollback, see putconn
+        self.open_count = 0
+        self.condition = threading.Condition()
+
+        # query results shared by connections of this pool, see DVH_SQL.cached
+        self.cache = QueryCache()
+        self.tracks_generations = None  # whether the database has a table_generations table, checked on first use
+
+        # timing of statements executed by connections of this pool, see DVH_SQL.on_statement
+        self.stats = QueryStats()
+
+    def getconn(self):
+        deadline = time.time() + self.timeout
+        while True:
+            with self.condition:
+                while not self.idle and not self.unreset and self.open_count >= self.max_connections:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise psycopg2.pool.PoolError("No SQL connection became available within %s seconds"
+                                                      % self.timeout)
+                    self.condition.wait(remaining)
+                unreset, self.unreset = self.unreset, []
+                if not unreset:
+                    if self.idle:
+                        return self.idle.pop()
+                    self.open_count += 1
+                    break
+            # connections returned by garbage collection are rolled back by the next caller, rather than left
+            # holding the locks of their open transactions
+            for cnx in unreset:
+                self.putconn(cnx)
+
+        try:
+            return self.engine.connect(self.config)
+        except Exception:
+            with self.condition:
+                self.open_count -= 1
+                self.condition.notify()
+            raise
+
+    def putconn(self, cnx, reset=True):
+        """
+        Discard broken connections, roll back anything left uncommitted
+        :param reset: False defers the rollback to the next getconn, nothing is executed on cnx now
+        """
+        if not reset:
+            with self.condition:
+                self.unreset.append(cnx)
+                self.condition.notify()
+            return
+
+        reusable = self.engine.reset(cnx)
+
+        with self.condition:
+            if reusable:
+                self.idle.append(cnx)
+            else:
+                self.open_count -= 1
+            self.condition.notify()
+
+    def closeall(self):
+        with self.condition:
+            for cnx in self.idle + self.unreset:
+                cnx.close()
+            self.open_count -= len(self.idle) + len(self.unreset)
+            self.idle = []
+            self.unreset = []
+
+
+# Column order of each table as created in preferences/create_tables.sql, used by COPY
+PLAN_COLUMNS = ['mrn', 'study_instance_uid', 'birth_date', 'age', 'patient_sex', 'sim_study_date', 'physician',
+                'tx_site', 'rx_dose', 'fxs', 'patient_orientation', 'plan_time_stamp', 'struct_time_stamp',
+                'dose_time_stamp', 'tps_manufacturer', 'tps_software_name', 'tps_software_version', 'tx_modality',
+                'tx_time', 'total_mu', 'dose_grid_res', 'heterogeneity_correction', 'baseline', 'import_time_stamp']
+DVH_COLUMNS = ['mrn', 'study_instance_uid', 'institutional_roi', 'physician_roi', 'roi_name', 'roi_type', 'volume',
+               'min_dose', 'mean_dose', 'max_dose', 'dvh_string', 'roi_coord_string', 'dist_to_ptv_min',
+               'dist_to_ptv_mean', 'dist_to_ptv_median', 'dist_to_ptv_max', 'surface_area', 'ptv_overlap',
+               'import_time_stamp', 'dvh_bytes', 'roi_coord_bytes']
+BEAM_COLUMNS = ['mrn', 'study_instance_uid', 'beam_number', 'beam_name', 'fx_grp_number', 'fx_count',
+                'fx_grp_beam_count', 'beam_dose', 'beam_mu', 'radiation_type', 'beam_energy_min', 'beam_energy_max',
+                'beam_type', 'control_point_count', 'gantry_start', 'gantry_end', 'gantry_rot_dir', 'gantry_range',
+                'gantry_min', 'gantry_max', 'collimator_start', 'collimator_end', 'collimator_rot_dir',
+                'collimator_range', 'collimator_min', 'collimator_max', 'couch_start', 'couch_end', 'couch_rot_dir',
+                'couch_range', 'couch_min', 'couch_max', 'beam_dose_pt', 'isocenter', 'ssd', 'treatment_machine',
+                'scan_mode', 'scan_spot_count', 'beam_mu_per_deg', 'beam_mu_per_cp', 'import_time_stamp']
+RX_COLUMNS = ['mrn', 'study_instance_uid', 'plan_name', 'fx_grp_name', 'fx_grp_number', 'fx_grp_count', 'fx_dose',
+              'fxs', 'rx_dose', 'rx_percent', 'normalization_method', 'normalization_object', 'import_time_stamp']
+
+
+# Pools are shared by every DVH_SQL object in a process, keyed by connection settings
+_pools = {}
+_pools_lock = threading.Lock()
+_pools_pid = os.getpid()
+
+# Pools inherited from a parent process are kept referenced but unused: closing (or garbage collecting) their
+# connections would also end the parent's session, whose socket the forked process shares
+_inherited_pools = []
+
+
+def get_connection_pool(config):
+    """
+    :param config: connection settings, the optional 'engine' key selects the SQL engine (postgresql by default)
+    :return: the process-wide pool for this configuration
+    :rtype: ConnectionPool
+    """
+    global _pools, _pools_pid
+    key = tuple(sorted((str(k), str(v)) for k, v in config.items()))
+    with _pools_lock:
+        # connections must not be shared with a parent process after a fork
+        if _pools_pid != os.getpid():
+            _inherited_pools.append(_pools)
+            _pools, _pools_pid = {}, os.getpid()
+        if key not in _pools:
+            config = dict(config)
+            engine = get_sql_engine(config.pop('engine', None))
+            _pools[key] = ConnectionPool(config, engine)
+        return _pools[key]
+
+
+def close_all_connections():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.closeall()
 
 
 class DVH_SQL:
     def __init__(self, *config):
+        """
+        Borrows a connection from the process-wide pool, call close() or use as a context manager to return it
+        :param config: optional dict of connection settings, sql_connection.cnf is used by default
+        """
         if config:
             config = config[0]
         else:
@@ -24,47 +176,200 @@ class DVH_SQL:
 
         self.dbname = config['dbname']
 
-        cnx = psycopg2.connect(**config)
+        self.pool = get_connection_pool(config)
+        self.engine = self.pool.engine
+        cnx = self.pool.getconn()
 
         self.cnx = cnx
-        self.cursor = cnx.cursor()
+        self.cursor = InstrumentedCursor(cnx.cursor(), self.on_statement)
         self.tables = ['DVHs', 'Plans', 'Rxs', 'Beams', 'DICOM_Files']
+        self.in_transaction = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        # Many callers use DVH_SQL() inline without close(), return the connection when garbage collected.
+        # Nothing is executed here: the last statement isn't reported (or explained) and the connection is rolled back
+        # by the pool's next getconn
+        if 'cnx' in self.__dict__:
+            self.cursor.close(report=False)
+            self.pool.putconn(self.__dict__.pop('cnx'), reset=False)
 
     def close(self):
-        self.cnx.close()
+        if 'cnx' in self.__dict__:
+            self.cursor.close()  # reports the last statement, which may need the connection for EXPLAIN
+            self.pool.putconn(self.__dict__.pop('cnx'))
 
     # Executes lines within text file named 'sql_file_name' to SQL
     def execute_file(self, sql_file_name):
 
         for line in open(sql_file_name):
-            self.cursor.execute(line)
-        self.cnx.commit()
+            if line.strip():
+                self.engine.execute_statement(self.cursor, line)
+        self.commit()
 
     def check_table_exists(self, table_name):
-
-        self.cursor.execute("""
-            SELECT COUNT(*)
-            FROM information_schema.tables
-            WHERE table_name = '{0}'
-            """.format(table_name.replace('\'', '\'\'')))
-        if self.cursor.fetchone()[0] == 1:
-            return True
-        else:
-            return False
+        return self.engine.table_exists(self.cursor, table_name)
 
     def query(self, table_name, return_col_str, *condition_str):
         query = "Select %s from %s;" % (return_col_str, table_name)
         if condition_str and condition_str[0]:
             query = "Select %s from %s where %s;" % (return_col_str, table_name, condition_str[0])
 
-        self.cursor.execute(query)
-        results = self.cursor.fetchall()
-
-        return results
+        return self.fetchall_cached(query, [table_name])
 
     def query_generic(self, query_str):
-        self.cursor.execute(query_str)
-        return self.cursor.fetchall()
+        return self.fetchall_cached(query_str, get_query_tables(query_str))
+
+    def fetchall_cached(self, query_str, tables):
+        """
+        :param query_str: an SQL query
+        :param tables: the tables read by query_str, None if unknown
+        :return: all rows returned by query_str, from the query cache if its tables have not changed
+        :rtype: list
+        """
+        def fetchall():
+            self.cursor.execute(query_str)
+            return self.cursor.fetchall()
+
+        # callers may modify the returned list, but not the cached one
+        return list(self.cached(('sql', normalize_sql(query_str)), tables, fetchall))
+
+    def cached(self, key, tables, compute):
+        """
+        Look up a result in the query cache of this connection pool, computing and storing it if needed.
+        Results are invalidated when any of tables is changed by DVH_SQL, in any process.
+        :param key: hashable identifier of the result, e.g., ('sql', normalized query)
+        :param tables: names of the tables the result is computed from
+        :param compute: function returning the result, called on a cache miss
+        :return: the result of compute, which must not be modified by the caller
+        """
+        generations = None
+        if tables and not self.in_transaction:
+            generations = self.get_table_generations(tables)
+        if generations is None:
+            return compute()
+
+        result = self.pool.cache.get(key, generations)
+        if result is None:
+            result = compute()
+            self.pool.cache.set(key, generations, result)
+        return result
+
+    def get_table_generations(self, tables):
+        """
+        :param tables: names of tables
+        :return: generation counter of each table, None if a table isn't tracked or table_generations doesn't exist
+        :rtype: tuple
+        """
+        tables = [t.lower() for t in tables]
+        if not set(tables).issubset(TRACKED_TABLES) or not self.tracks_generations():
+            return None
+        self.cursor.execute("SELECT table_name, generation FROM table_generations;")
+        generations = dict(self.cursor.fetchall())
+        return tuple([generations.get(t) for t in tables])
+
+    def tracks_generations(self):
+        if self.pool.tracks_generations is None:
+            self.pool.tracks_generations = self.check_table_exists('table_generations')
+        return self.pool.tracks_generations
+
+    def touch(self, *tables):
+        """
+        Increment the generation counter of tables, invalidating cached results computed from them.
+        Call before committing any insert, update, or delete.
+        :param tables: names of changed tables
+        """
+        tables = [t.lower() for t in tables if t.lower() in TRACKED_TABLES]
+        if tables and self.tracks_generations():
+            self.cursor.execute("UPDATE table_generations SET generation = generation + 1 WHERE table_name IN ('%s');"
+                                % "', '".join(tables))
+
+    def query_stream(self, table_name, return_col_str, *condition_str, **kwargs):
+        """
+        Same as query, but rows are read from a server-side cursor in batches rather than all at once
+        :param table_name: name of the SQL table
+        :param return_col_str: comma separated column names
+        :param condition_str: optional string in SQL syntax applied to the query
+        :param itersize: number of rows per batch, defaults to SQL_STREAM_ITERSIZE
+        :return: a generator of lists of rows
+        """
+        query = "Select %s from %s;" % (return_col_str, table_name)
+        if condition_str and condition_str[0]:
+            query = "Select %s from %s where %s;" % (return_col_str, table_name, condition_str[0])
+
+        return self.query_generic_stream(query, **kwargs)
+
+    def query_generic_stream(self, query_str, itersize=SQL_STREAM_ITERSIZE):
+        """
+        Iterate over the results of query_str with a server-side cursor, so at most itersize rows are held
+        in memory. A commit on this connection closes the cursor, so make updates with another DVH_SQL object
+        :param query_str: a complete SQL query
+        :param itersize: number of rows per batch
+        :return: a generator of lists of rows
+        """
+        return self.time_stream(query_str, self.engine.stream(self.cnx, query_str, itersize))
+
+    def time_stream(self, query_str, stream):
+        # only time spent fetching batches is counted, not the caller's work between them
+        seconds, rows, size = 0., 0, 0
+        while True:
+            started = time.time()
+            try:
+                batch = next(stream)
+            except StopIteration:
+                break
+            seconds += time.time() - started
+            rows += len(batch)
+            size += estimate_size(batch)
+            yield batch
+        seconds += time.time() - started
+        self.on_statement(query_str, seconds, rows, size)
+
+    def on_statement(self, statement, seconds, rows, size):
+        """
+        Called for every statement executed, records its timing and logs it if slower than SQL_SLOW_QUERY_SECONDS
+        :param statement: the SQL statement
+        :param seconds: time spent executing the statement and fetching its rows
+        :param rows: number of rows returned
+        :param size: approximate bytes returned
+        """
+        self.pool.stats.record(statement, seconds, rows, size)
+        if seconds < SQL_SLOW_QUERY_SECONDS:
+            return
+
+        plan = None
+        if SQL_EXPLAIN_SLOW_QUERIES and re.match(r'\s*select\b', statement, re.IGNORECASE):
+            try:
+                plan = self.explain(statement)
+            except self.engine.errors as error:
+                plan = "EXPLAIN failed: %s" % error
+        write_slow_query({'time_stamp': str(datetime.now()),
+                          'dbname': self.dbname,
+                          'seconds': seconds,
+                          'rows': rows,
+                          'bytes': size,
+                          'statement': normalize_sql(statement),
+                          'plan': plan})
+
+    def explain(self, query_str):
+        """
+        :param query_str: a SELECT statement, on PostgreSQL it is executed again if SQL_EXPLAIN_ANALYZE is set
+        :return: the query plan
+        :rtype: str
+        """
+        return self.engine.explain(self.cnx, query_str, analyze=SQL_EXPLAIN_ANALYZE)
+
+    def get_query_stats(self):
+        """
+        :return: timing of statements executed by this process on this database
+        :rtype: QueryStats
+        """
+        return self.pool.stats
 
     def update(self, table_name, column, value, condition_str):
 
@@ -75,7 +380,7 @@ class DVH_SQL:
             value_is_numeric = False
 
         if '::date' in str(value):
-            value = "'%s'::date" % value.strip('::date')  # augment value string for postgresql date formatting
+            value = self.engine.date_literal(value.strip('::date'))  # augment value string for date formatting
         elif value_is_numeric:
             value = str(value)
         else:
@@ -83,7 +388,31 @@ class DVH_SQL:
 
         update = "Update %s SET %s = %s WHERE %s" % (table_name, column, value, condition_str)
         self.cursor.execute(update)
-        self.cnx.commit()
+        self.touch(table_name)
+        self.commit()
+
+    def bulk_update(self, table_name, key_columns, values):
+        """
+        Update many rows with one statement, new values are loaded into a temporary table with COPY
+        :param table_name: name of the SQL table to update
+        :param key_columns: list of columns used to match rows, e.g., ['study_instance_uid', 'roi_name'], or [ROW_ID]
+        to match each row by its row identity (e.g., from QuerySQL.get_row_ids), for tables without a unique key
+        :param values: a dict of equal length lists keyed by column name, including each of the key_columns
+        :return: the number of rows updated
+        :rtype: int
+        """
+        update_columns = [c for c in values if c not in key_columns]
+        columns = list(key_columns) + update_columns
+        if not update_columns or not values[key_columns[0]]:
+            return 0
+
+        rows = list(zip(*[values[c] for c in columns]))
+
+        with self.transaction():
+            row_count = self.engine.bulk_update(self.cursor, table_name, key_columns, update_columns, rows)
+            self.touch(table_name)
+
+        return row_count
 
     def is_study_instance_uid_in_table(self, table_name, study_instance_uid):
         query = "Select study_instance_uid from %s where study_instance_uid = '%s';" % (table_name, study_instance_uid)
@@ -92,214 +421,215 @@ class DVH_SQL:
         return bool(results)
 
     def insert_dvhs(self, dvh_table):
-        file_path = 'insert_values_DVHs.sql'
 
-        if os.path.isfile(file_path):
-            os.remove(file_path)
-
-        # Import each ROI from ROI_PyTable, append to output text file
+        # Import each ROI from ROI_PyTable
         if max(dvh_table.ptv_number) > 1:
             multi_ptv = True
         else:
             multi_ptv = False
+
+        import_time_stamp = self.now()
+        rows = []
         for x in range(dvh_table.count):
             if multi_ptv and dvh_table.ptv_number[x] > 0:
                 dvh_table.roi_type[x] = 'PTV' + str(dvh_table.ptv_number[x])
-            sql_input = [str(dvh_table.mrn[x]),
-                         str(dvh_table.study_instance_uid[x]),
+            rows.append([dvh_table.mrn[x],
+                         dvh_table.study_instance_uid[x],
                          dvh_table.institutional_roi[x],
                          dvh_table.physician_roi[x],
                          dvh_table.roi_name[x].replace("'", "`"),
                          dvh_table.roi_type[x],
-                         str(round(dvh_table.volume[x], 3)),
-                         str(round(dvh_table.min_dose[x], 2)),
-                         str(round(dvh_table.mean_dose[x], 2)),
-                         str(round(dvh_table.max_dose[x], 2)),
+                         round_value(dvh_table.volume[x], 3),
+                         round_value(dvh_table.min_dose[x], 2),
+                         round_value(dvh_table.mean_dose[x], 2),
+                         round_value(dvh_table.max_dose[x], 2),
                          dvh_table.dvh_str[x],
                          dvh_table.roi_coord[x],
-                         '(NULL)',
-                         '(NULL)',
-                         '(NULL)',
-                         '(NULL)',
-                         str(round(dvh_table.surface_area[x], 2)),
-                         '(NULL)',
-                         'NOW()']
-            sql_input = '\',\''.join(sql_input)
-            sql_input += '\');'
-            sql_input = sql_input.replace("'(NULL)'", "(NULL)")
-            prepend = 'INSERT INTO DVHs VALUES (\''
-            sql_input = prepend + str(sql_input)
-            sql_input += '\n'
-            with open(file_path, "a") as text_file:
-                text_file.write(sql_input)
-
-        self.execute_file(file_path)
-        os.remove(file_path)
+                         None,
+                         None,
+                         None,
+                         None,
+                         round_value(dvh_table.surface_area[x], 2),
+                         None,
+                         import_time_stamp,
+                         dvh_table.dvh_bytes[x],
+                         dvh_table.roi_coord_bytes[x]])
+
+        self.copy_rows('DVHs', DVH_COLUMNS, rows)
         print('DVHs imported')
 
         write_import_errors(dvh_table)
 
     def insert_plan(self, plan):
-        file_path = 'insert_plan_' + plan.mrn + '.sql'
-
-        if os.path.isfile(file_path):
-            os.remove(file_path)
-
-        # Import each ROI from ROI_PyTable, append to output text file
-        sql_input = [str(plan.mrn),
-                     plan.study_instance_uid,
-                     str(plan.birth_date),
-                     str(plan.age),
-                     plan.patient_sex,
-                     str(plan.sim_study_date),
-                     plan.physician,
-                     plan.tx_site,
-                     str(plan.rx_dose),
-                     str(plan.fxs),
-                     plan.patient_orientation,
-                     str(plan.plan_time_stamp),
-                     str(plan.struct_time_stamp),
-                     str(plan.dose_time_stamp),
-                     plan.tps_manufacturer,
-                     plan.tps_software_name,
-                     str(plan.tps_software_version),
-                     plan.tx_modality,
-                     str(plan.tx_time),
-                     str(plan.total_mu),
-                     plan.dose_grid_resolution,
-                     plan.heterogeneity_correction,
-                     'false',
-                     'NOW()']
-        sql_input = '\',\''.join(sql_input)
-        sql_input += '\');'
-        sql_input = sql_input.replace("'(NULL)'", "(NULL)")
-        prepend = 'INSERT INTO Plans VALUES (\''
-        sql_input = prepend + str(sql_input)
-        sql_input += '\n'
-        with open(file_path, "a") as text_file:
-            text_file.write(sql_input)
-
-        self.execute_file(file_path)
-        os.remove(file_path)
+
+        row = [plan.mrn,
+               plan.study_instance_uid,
+               plan.birth_date,
+               plan.age,
+               plan.patient_sex,
+               plan.sim_study_date,
+               plan.physician,
+               plan.tx_site,
+               plan.rx_dose,
+               plan.fxs,
+               plan.patient_orientation,
+               plan.plan_time_stamp,
+               plan.struct_time_stamp,
+               plan.dose_time_stamp,
+               plan.tps_manufacturer,
+               plan.tps_software_name,
+               plan.tps_software_version,
+               plan.tx_modality,
+               plan.tx_time,
+               plan.total_mu,
+               plan.dose_grid_resolution,
+               plan.heterogeneity_correction,
+               'false',
+               self.now()]
+
+        self.copy_rows('Plans', PLAN_COLUMNS, [row])
         print('Plan imported')
 
         write_import_errors(plan)
 
     def insert_beams(self, beams):
 
-        file_path = 'insert_values_beams.sql'
-
-        if os.path.isfile(file_path):
-            os.remove(file_path)
-
-        # Import each ROI from ROI_PyTable, append to output text file
+        import_time_stamp = self.now()
+        rows = []
         for x in range(beams.count):
 
             if beams.beam_mu[x] > 0:
-                sql_input = [str(beams.mrn[x]),
-                             str(beams.study_instance_uid[x]),
-                             str(beams.beam_number[x]),
+                rows.append([beams.mrn[x],
+                             beams.study_instance_uid[x],
+                             beams.beam_number[x],
                              beams.beam_name[x].replace("'", "`"),
-                             str(beams.fx_group[x]),
-                             str(beams.fxs[x]),
-                             str(beams.fx_grp_beam_count[x]),
-                             str(round(beams.beam_dose[x], 3)),
-                             str(beams.beam_mu[x]),
+                             beams.fx_group[x],
+                             beams.fxs[x],
+                             beams.fx_grp_beam_count[x],
+                             round_value(beams.beam_dose[x], 3),
+                             beams.beam_mu[x],
                              beams.radiation_type[x],
-                             str(round(beams.beam_energy_min[x], 2)),
-                             str(round(beams.beam_energy_max[x], 2)),
+                             round_value(beams.beam_energy_min[x], 2),
+                             round_value(beams.beam_energy_max[x], 2),
                              beams.beam_type[x],
-                             str(beams.control_point_count[x]),
-                             str(beams.gantry_start[x]),
-                             str(beams.gantry_end[x]),
+                             beams.control_point_count[x],
+                             beams.gantry_start[x],
+                             beams.gantry_end[x],
                              beams.gantry_rot_dir[x],
-                             str(beams.gantry_range[x]),
-                             str(beams.gantry_min[x]),
-                             str(beams.gantry_max[x]),
-                             str(beams.collimator_start[x]),
-                             str(beams.collimator_end[x]),
+                             beams.gantry_range[x],
+                             beams.gantry_min[x],
+                             beams.gantry_max[x],
+                             beams.collimator_start[x],
+                             beams.collimator_end[x],
                              beams.collimator_rot_dir[x],
-                             str(beams.collimator_range[x]),
-                             str(beams.collimator_min[x]),
-                             str(beams.collimator_max[x]),
-                             str(beams.couch_start[x]),
-                             str(beams.couch_end[x]),
+                             beams.collimator_range[x],
+                             beams.collimator_min[x],
+                             beams.collimator_max[x],
+                             beams.couch_start[x],
+                             beams.couch_end[x],
                              beams.couch_rot_dir[x],
-                             str(beams.couch_range[x]),
-                             str(beams.couch_min[x]),
-                             str(beams.couch_max[x]),
+                             beams.couch_range[x],
+                             beams.couch_min[x],
+                             beams.couch_max[x],
                              beams.beam_dose_pt[x],
                              beams.isocenter[x],
-                             str(beams.ssd[x]),
+                             beams.ssd[x],
                              beams.treatment_machine[x],
                              beams.scan_mode[x],
-                             str(beams.scan_spot_count[x]),
-                             str(beams.beam_mu_per_deg[x]),
-                             str(beams.beam_mu_per_cp[x]),
-                             'NOW()']
-                sql_input = '\',\''.join(sql_input)
-                sql_input += '\');'
-                sql_input = sql_input.replace("'(NULL)'", "(NULL)")
-                prepend = 'INSERT INTO Beams VALUES (\''
-                sql_input = prepend + str(sql_input)
-                sql_input += '\n'
-                with open(file_path, "a") as text_file:
-                    text_file.write(sql_input)
-
-        self.execute_file(file_path)
-        os.remove(file_path)
+                             beams.scan_spot_count[x],
+                             beams.beam_mu_per_deg[x],
+                             beams.beam_mu_per_cp[x],
+                             import_time_stamp])
+
+        self.copy_rows('Beams', BEAM_COLUMNS, rows)
         print('Beams imported')
 
         write_import_errors(beams)
 
     def insert_rxs(self, rx_table):
 
-        file_path = 'insert_values_rxs.sql'
-
-        if os.path.isfile(file_path):
-            os.remove(file_path)
-
+        import_time_stamp = self.now()
+        rows = []
         for x in range(rx_table.count):
-            sql_input = [str(rx_table.mrn[x]),
-                         str(rx_table.study_instance_uid[x]),
+            rows.append([rx_table.mrn[x],
+                         rx_table.study_instance_uid[x],
                          str(rx_table.plan_name[x]).replace("'", "`"),
-                         str(rx_table.fx_grp_name[x]),
-                         str(rx_table.fx_grp_number[x]),
-                         str(rx_table.fx_grp_count[x]),
-                         str(round(rx_table.fx_dose[x], 2)),
-                         str(rx_table.fxs[x]),
-                         str(round(rx_table.rx_dose[x], 2)),
-                         str(round(rx_table.rx_percent[x], 1)),
-                         str(rx_table.normalization_method[x]),
+                         rx_table.fx_grp_name[x],
+                         rx_table.fx_grp_number[x],
+                         rx_table.fx_grp_count[x],
+                         round_value(rx_table.fx_dose[x], 2),
+                         rx_table.fxs[x],
+                         round_value(rx_table.rx_dose[x], 2),
+                         round_value(rx_table.rx_percent[x], 1),
+                         rx_table.normalization_method[x],
                          str(rx_table.normalization_object[x]).replace("'", "`"),
-                         'NOW()']
-            sql_input = '\',\''.join(sql_input)
-            sql_input += '\');'
-            prepend = 'INSERT INTO Rxs VALUES (\''
-            sql_input = prepend + str(sql_input)
-            sql_input += '\n'
-            with open(file_path, "a") as text_file:
-                text_file.write(sql_input)
-
-        self.execute_file(file_path)
-        os.remove(file_path)
+                         import_time_stamp])
+
+        self.copy_rows('Rxs', RX_COLUMNS, rows)
         print('Rxs imported')
 
         write_import_errors(rx_table)
 
+    def copy_rows(self, table_name, columns, rows):
+        """
+        Insert many rows at once, with COPY FROM STDIN for PostgreSQL
+        :param table_name: name of the SQL table
+        :param columns: list of column names, in the order of the values in each row
+        :param rows: list of rows, each a list of values, None or '(NULL)' is stored as NULL
+        """
+        if not rows:
+            return
+        self.engine.copy_rows(self.cursor, table_name, columns, rows)
+        self.touch(table_name)
+        self.commit()
+
+    def now(self):
+        """
+        :return: the SQL server's NOW(), which is constant within a transaction
+        """
+        self.cursor.execute(self.engine.now_query())
+        return self.cursor.fetchone()[0]
+
+    def commit(self):
+        # commits are deferred to the end of the block while inside transaction()
+        if not self.in_transaction:
+            self.cnx.commit()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group inserts, updates, and deletes into a single transaction, rolled back on error
+        """
+        if self.in_transaction:
+            yield self
+            return
+        self.in_transaction = True
+        try:
+            yield self
+        except Exception:
+            self.in_transaction = False
+            self.cnx.rollback()
+            # generation counters roll back too, so results cached during the transaction could look current
+            self.pool.cache.clear()
+            raise
+        self.in_transaction = False
+        self.cnx.commit()
+
     def insert_dicom_file_row(self, mrn, uid, dir_name, plan_file, struct_file, dose_file):
 
         sql_cmd = "INSERT INTO DICOM_Files VALUES ('%s', '%s', '%s', '%s', '%s', '%s', NOW());\n" % \
                   (mrn, uid, dir_name, plan_file, struct_file, dose_file)
         sql_cmd.replace("'(NULL)'", "(NULL)")
         self.cursor.execute(sql_cmd)
-        self.cnx.commit()
+        self.touch('DICOM_Files')
+        self.commit()
 
     def delete_rows(self, condition_str, ignore_table=[]):
         tables = [t for t in self.tables if t not in ignore_table]
         for table in tables:
             self.cursor.execute("DELETE FROM %s WHERE %s;" % (table, condition_str))
-            self.cnx.commit()
+            self.touch(table)
+            self.commit()
 
     def change_mrn(self, old, new):
         condition = "mrn = '%s'" % old
@@ -314,24 +644,74 @@ class DVH_SQL:
     def delete_dvh(self, roi_name, study_instance_uid):
         self.cursor.execute("DELETE FROM DVHs WHERE roi_name = '%s' and study_instance_uid = '%s';"
                             % (roi_name, study_instance_uid))
-        self.cnx.commit()
+        self.touch('DVHs')
+        self.commit()
 
     def drop_tables(self):
         print('Dropping tables')
-        for table in self.tables:
+        for table in self.tables + ['schema_version', 'table_generations']:
             self.cursor.execute("DROP TABLE IF EXISTS %s;" % table)
             self.cnx.commit()
+        self.pool.cache.clear()
+        self.pool.tracks_generations = None
 
     def drop_table(self, table):
         print("Dropping table: %s" % table)
+        self.touch(table)
         self.cursor.execute("DROP TABLE IF EXISTS %s;" % table)
         self.cnx.commit()
+        self.pool.cache.clear()
+        self.pool.tracks_generations = None
 
     def initialize_database(self):
         script_dir = os.path.dirname(__file__)
         rel_path = "preferences/create_tables.sql"
         abs_file_path = os.path.join(script_dir, rel_path)
         self.execute_file(abs_file_path)
+        self.migrate()
+
+    def get_schema_version(self):
+        """
+        :return: the highest migration version applied to this database, 0 if none
+        :rtype: int
+        """
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS schema_version "
+                            "(version int, description text, applied timestamp);")
+        self.commit()
+        self.cursor.execute("SELECT MAX(version) FROM schema_version;")
+        version = self.cursor.fetchone()[0]
+        return version or 0
+
+    def migrate(self):
+        """
+        Apply each migration in preferences/migrations newer than the current schema version, in order.
+        Each migration is applied in its own transaction along with its schema_version record.
+        :return: list of versions applied
+        :rtype: list
+        """
+        current_version = self.get_schema_version()
+        applied = []
+        for version, description, abs_file_path in get_migrations():
+            if version > current_version:
+                print("Applying schema migration %03d: %s" % (version, description))
+                with self.transaction():
+                    self.execute_file(abs_file_path)
+                    self.cursor.execute("INSERT INTO schema_version VALUES ({0}, {0}, NOW());"
+                                        .format(self.engine.param), (version, description))
+                applied.append(version)
+        if applied:
+            self.pool.cache.clear()
+            self.pool.tracks_generations = None
+        return applied
+
+    def analyze(self, tables=None):
+        """
+        Update planner statistics, should be run after bulk imports or updates
+        :param tables: list of table names, defaults to all DVH Analytics tables
+        """
+        for table in tables or self.tables:
+            self.cursor.execute("ANALYZE %s;" % table)
+        self.commit()
 
     def reinitialize_database(self):
         self.drop_tables()
@@ -339,10 +719,7 @@ class DVH_SQL:
 
     def does_db_exist(self):
         # Check if database exists
-        line = "SELECT datname FROM pg_catalog.pg_database WHERE lower(datname) = lower('%s');" % self.dbname
-        self.cursor.execute(line)
-
-        return bool(len(self.cursor.fetchone()))
+        return self.engine.database_exists(self.cursor, self.dbname)
 
     def is_sql_table_empty(self, table):
         line = "SELECT COUNT(*) FROM %s;" % table
@@ -355,31 +732,25 @@ class DVH_SQL:
             query = "select distinct %s from %s where %s;" % (column, table, str(condition[0]))
         else:
             query = "select distinct %s from %s;" % (column, table)
-        self.cursor.execute(query)
-        cursor_return = self.cursor.fetchall()
+        cursor_return = self.fetchall_cached(query, [table])
         unique_values = [str(uv[0]) for uv in cursor_return]
         unique_values.sort()
         return unique_values
 
     def get_column_names(self, table_name):
-        query = "select column_name from information_schema.columns where table_name = '%s';" % table_name.lower()
-        self.cursor.execute(query)
-        cursor_return = self.cursor.fetchall()
-        columns = [str(c[0]) for c in cursor_return]
+        columns = self.engine.get_column_names(self.cursor, table_name)
         columns.sort()
         return columns
 
     def get_min_value(self, table, column):
         query = "SELECT MIN(%s) FROM %s;" % (column, table)
-        self.cursor.execute(query)
-        cursor_return = self.cursor.fetchone()
-        return cursor_return[0]
+        cursor_return = self.fetchall_cached(query, [table])
+        return cursor_return[0][0]
 
     def get_max_value(self, table, column):
         query = "SELECT MAX(%s) FROM %s;" % (column, table)
-        self.cursor.execute(query)
-        cursor_return = self.cursor.fetchone()
-        return cursor_return[0]
+        cursor_return = self.fetchall_cached(query, [table])
+        return cursor_return[0][0]
 
     def get_roi_count_from_query(self, uid=None, dvh_condition=None):
         if uid:
@@ -395,6 +766,35 @@ class DVH_SQL:
         return len(self.query('DVHs', 'mrn', condition))
 
 
+def get_migrations():
+    """
+    Migrations are sql files in preferences/migrations named <version>_<description>.sql, e.g., 001_add_indexes.sql
+    :return: list of (version, description, absolute file path) sorted by version
+    :rtype: list
+    """
+    migrations_dir = os.path.join(os.path.dirname(__file__), 'preferences', 'migrations')
+    migrations = []
+    for file_name in os.listdir(migrations_dir):
+        name, ext = os.path.splitext(file_name)
+        version = name.split('_')[0]
+        if ext == '.sql' and version.isdigit():
+            description = ' '.join(name.split('_')[1:])
+            migrations.append((int(version), description, os.path.join(migrations_dir, file_name)))
+    migrations.sort()
+    return migrations
+
+
+def round_value(value, digits):
+    """
+    :param value: a number, or '(NULL)' if the value could not be determined
+    :return: rounded value, non-numerical values are returned unchanged
+    """
+    try:
+        return round(value, digits)
+    except TypeError:
+        return value
+
+
 def write_import_errors(obj):
     detail_col = [c for c in ['beam_name', 'roi_name', 'plan_name'] if hasattr(obj, c)]
     with open("import_warning_log.txt", "a") as warning_log:
@@ -0,0 +1,376 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Database engines used by DVH_SQL, selected with the 'engine' line of sql_connection.cnf
+postgresql (default) connects to a PostgreSQL server, sqlite stores the database in the file named by dbname
+"""
+
+from __future__ import print_function
+import psycopg2
+import psycopg2.extensions
+import sqlite3
+import itertools
+import os
+import re
+from datetime import date, datetime
+from dateutil.parser import parse as parse_date
+from six import StringIO
+from binascii import hexlify
+
+
+# Python types returned by psycopg2 for bytea, and written to bytea by COPY
+try:
+    BINARY_TYPES = (bytearray, memoryview, buffer)
+except NameError:  # python 3
+    BINARY_TYPES = (bytearray, memoryview)
+
+# Server-side cursors need a name that is unique within their connection
+_stream_ids = itertools.count()
+
+# Key column of bulk_update matched to each engine's row identity (row_id), for tables without a unique key
+ROW_ID = 'row_id'
+
+
+class PostgreSQLEngine:
+    name = 'postgresql'
+    param = '%s'  # query parameter placeholder
+    errors = (psycopg2.Error,)
+    row_id = 'ctid'  # identifies a row until it is updated, see row_id_condition
+
+    def connect(self, config):
+        """
+        :param config: settings from sql_connection.cnf, passed to psycopg2.connect
+        :return: a new connection
+        """
+        return psycopg2.connect(**config)
+
+    def reset(self, cnx):
+        """
+        Roll back anything left uncommitted before a connection is reused
+        :return: False if the connection is broken and should be discarded
+        :rtype: bool
+        """
+        if cnx.closed:
+            return False
+        try:
+            if cnx.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                cnx.rollback()
+        except psycopg2.Error:
+            cnx.close()
+            return False
+        return True
+
+    def execute_statement(self, cursor, statement):
+        cursor.execute(statement)
+
+    def stream(self, cnx, query_str, itersize):
+        """
+        Yield batches of rows from a named (server-side) cursor
+        """
+        cursor = cnx.cursor(name='dvh_sql_stream_%s' % next(_stream_ids))
+        cursor.itersize = itersize
+        try:
+            cursor.execute(query_str)
+            rows = cursor.fetchmany(itersize)
+            while rows:
+                yield rows
+                rows = cursor.fetchmany(itersize)
+        finally:
+            try:
+                cursor.close()
+            except psycopg2.Error:
+                pass  # the cursor is already gone if its transaction ended
+
+    def copy_rows(self, cursor, table_name, columns, rows):
+        buffer = StringIO()
+        for row in rows:
+            buffer.write('\t'.join([copy_text(value) for value in row]))
+            buffer.write('\n')
+        buffer.seek(0)
+        cursor.copy_expert("COPY %s (%s) FROM STDIN" % (table_name, ', '.join(columns)), buffer)
+
+    def bulk_update(self, cursor, table_name, key_columns, update_columns, rows):
+        """
+        Load rows into a temporary table with COPY, then update table_name with a single UPDATE ... FROM
+        :return: the number of rows updated
+        :rtype: int
+        """
+        columns = list(key_columns) + list(update_columns)
+        temp_table = 'bulk_update_%s' % table_name.lower()
+        cursor.execute("DROP TABLE IF EXISTS %s;" % temp_table)
+        # ctid is a system column name, so the row identity is copied as ROW_ID
+        select = ["%s AS %s" % (self.row_id, c) if c == ROW_ID else c for c in columns]
+        cursor.execute("CREATE TEMP TABLE %s ON COMMIT DROP AS SELECT %s FROM %s WITH NO DATA;"
+                       % (temp_table, ', '.join(select), table_name))
+        self.copy_rows(cursor, temp_table, columns, rows)
+        cursor.execute("UPDATE %s SET %s FROM %s WHERE %s;"
+                       % (table_name,
+                          ', '.join(["%s = %s.%s" % (c, temp_table, c) for c in update_columns]),
+                          temp_table,
+                          ' AND '.join(["%s.%s = %s.%s" % (table_name, self.row_id if c == ROW_ID else c, temp_table, c)
+                                        for c in key_columns])))
+        return cursor.rowcount
+
+    def explain(self, cnx, query_str, analyze=False):
+        """
+        Report the plan of query_str, within a savepoint so a failure doesn't abort the open transaction
+        :param analyze: run query_str again with EXPLAIN (ANALYZE, BUFFERS) for actual times and buffer usage
+        :return: the query plan
+        :rtype: str
+        """
+        cursor = cnx.cursor()
+        try:
+            cursor.execute("SAVEPOINT dvh_sql_explain;")
+            try:
+                explain = "EXPLAIN (ANALYZE, BUFFERS)" if analyze else "EXPLAIN"
+                cursor.execute("%s %s" % (explain, query_str))
+                plan = '\n'.join([str(row[0]) for row in cursor.fetchall()])
+            except psycopg2.Error:
+                cursor.execute("ROLLBACK TO SAVEPOINT dvh_sql_explain;")
+                raise
+            cursor.execute("RELEASE SAVEPOINT dvh_sql_explain;")
+            return plan
+        finally:
+            cursor.close()
+
+    def row_id_condition(self, row_ids):
+        """
+        :param row_ids: values of the ctid column, as returned by psycopg2 (e.g., '(0,1)')
+        :return: a condition selecting these rows with a TID scan
+        :rtype: str
+        """
+        return "ctid = ANY('{%s}'::tid[])" % ','.join(['"%s"' % row_id for row_id in row_ids])
+
+    def date_literal(self, value):
+        return "'%s'::date" % value
+
+    def now_query(self):
+        return "SELECT NOW();"
+
+    def table_exists(self, cursor, table_name):
+        cursor.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_name = '%s';"
+                       % table_name.replace('\'', '\'\''))
+        return cursor.fetchone()[0] == 1
+
+    def database_exists(self, cursor, dbname):
+        cursor.execute("SELECT datname FROM pg_catalog.pg_database WHERE lower(datname) = lower('%s');" % dbname)
+        return bool(cursor.fetchone())
+
+    def get_column_names(self, cursor, table_name):
+        cursor.execute("select column_name from information_schema.columns where table_name = '%s';"
+                       % table_name.lower())
+        return [str(c[0]) for c in cursor.fetchall()]
+
+
+class SQLiteEngine:
+    name = 'sqlite'
+    param = '?'
+    errors = (sqlite3.Error,)
+    row_id = 'rowid'
+
+    def connect(self, config):
+        """
+        :param config: settings from sql_connection.cnf, dbname is the database file,
+        relative paths are relative to the preferences directory
+        :return: a new connection
+        """
+        db_file = get_sqlite_file_path(config['dbname'])
+        # a pooled connection is only used by one thread at a time, but not always the thread that opened it
+        cnx = sqlite3.connect(db_file, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+                              check_same_thread=False)
+        cnx.create_function('NOW', 0, sqlite_now)
+        return cnx
+
+    def reset(self, cnx):
+        try:
+            cnx.rollback()
+        except sqlite3.Error:
+            cnx.close()
+            return False
+        return True
+
+    def execute_statement(self, cursor, statement):
+        # SQLite has no ADD COLUMN IF NOT EXISTS, which the migrations use
+        match = re.match(r'\s*ALTER TABLE (\w+) ADD COLUMN IF NOT EXISTS (\w+) (.*)', statement, re.IGNORECASE)
+        if match:
+            table_name, column, definition = match.groups()
+            if column.lower() in self.get_column_names(cursor, table_name):
+                return
+            statement = "ALTER TABLE %s ADD COLUMN %s %s" % (table_name, column, definition)
+        cursor.execute(statement)
+
+    def stream(self, cnx, query_str, itersize):
+        # rows of an SQLite cursor are produced as they are fetched, no server-side cursor is needed
+        cursor = cnx.cursor()
+        try:
+            cursor.execute(query_str)
+            rows = cursor.fetchmany(itersize)
+            while rows:
+                yield rows
+                rows = cursor.fetchmany(itersize)
+        finally:
+            cursor.close()
+
+    def copy_rows(self, cursor, table_name, columns, rows):
+        column_types = self.get_column_types(cursor, table_name)
+        types = [column_types.get(c.lower(), '') for c in columns]
+        cursor.executemany("INSERT INTO %s (%s) VALUES (%s);"
+                           % (table_name, ', '.join(columns), ', '.join([self.param] * len(columns))),
+                           [[sqlite_value(value, types[i]) for i, value in enumerate(row)] for row in rows])
+
+    def bulk_update(self, cursor, table_name, key_columns, update_columns, rows):
+        """
+        Update table_name with one prepared UPDATE executed for every row
+        :return: the number of rows updated
+        :rtype: int
+        """
+        column_types = self.get_column_types(cursor, table_name)
+        columns = list(update_columns) + list(key_columns)
+        types = [column_types.get(c.lower(), '') for c in columns]
+        key_count = len(key_columns)
+        cursor.executemany("UPDATE %s SET %s WHERE %s;"
+                           % (table_name,
+                              ', '.join(["%s = ?" % c for c in update_columns]),
+                              ' AND '.join(["%s = ?" % (self.row_id if c == ROW_ID else c) for c in key_columns])),
+                           [[sqlite_value(value, types[i])
+                             for i, value in enumerate(list(row[key_count:]) + list(row[:key_count]))]
+                            for row in rows])
+        return cursor.rowcount
+
+    def explain(self, cnx, query_str, analyze=False):
+        """
+        SQLite only reports the plan, EXPLAIN QUERY PLAN doesn't run the query, analyze is ignored
+        :return: the query plan
+        :rtype: str
+        """
+        cursor = cnx.cursor()
+        try:
+            cursor.execute("EXPLAIN QUERY PLAN %s" % query_str)
+            return '\n'.join([str(row[-1]) for row in cursor.fetchall()])
+        finally:
+            cursor.close()
+
+    def row_id_condition(self, row_ids):
+        """
+        :param row_ids: values of the rowid column
+        :return: a condition selecting these rows by primary key
+        :rtype: str
+        """
+        return "rowid IN (%s)" % ', '.join([str(int(row_id)) for row_id in row_ids])
+
+    def date_literal(self, value):
+        return "'%s'" % sqlite_value(value, 'date')
+
+    def now_query(self):
+        return 'SELECT NOW() AS "now [timestamp]";'
+
+    def table_exists(self, cursor, table_name):
+        cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND lower(name) = lower('%s');"
+                       % table_name.replace('\'', '\'\''))
+        return cursor.fetchone()[0] == 1
+
+    def database_exists(self, cursor, dbname):
+        return os.path.isfile(get_sqlite_file_path(dbname))
+
+    def get_column_names(self, cursor, table_name):
+        return list(self.get_column_types(cursor, table_name))
+
+    def get_column_types(self, cursor, table_name):
+        """
+        Declared types are used to store dates and booleans in a form SQLite can compare
+        :return: declared type of each column of table_name, keyed by lower case column name
+        :rtype: dict
+        """
+        cursor.execute("PRAGMA table_info(%s);" % table_name)
+        return {str(row[1]).lower(): str(row[2]).lower() for row in cursor.fetchall()}
+
+
+SQL_ENGINES = {'postgresql': PostgreSQLEngine,
+               'sqlite': SQLiteEngine}
+
+_engines = {}
+
+
+def get_sql_engine(name=None):
+    """
+    :param name: a key of SQL_ENGINES, defaults to postgresql
+    :return: the shared engine object
+    """
+    name = (name or 'postgresql').lower()
+    if name not in SQL_ENGINES:
+        raise ValueError("Unknown SQL engine '%s', please select from %s" % (name, ', '.join(sorted(SQL_ENGINES))))
+    if name not in _engines:
+        _engines[name] = SQL_ENGINES[name]()
+    return _engines[name]
+
+
+def get_sqlite_file_path(dbname):
+    if os.path.isabs(dbname):
+        return dbname
+    return os.path.join(os.path.dirname(__file__), 'preferences', dbname)
+
+
+def copy_text(value):
+    """
+    :param value: a python value to be written to COPY FROM STDIN in text format
+    :return: the escaped text representation, \\N for NULL and hex format for bytea
+    :rtype: str
+    """
+    if value is None or value == '(NULL)':
+        return '\\N'
+    if isinstance(value, BINARY_TYPES):
+        return '\\\\x' + hexlify(value).decode('ascii')
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def sqlite_value(value, column_type):
+    """
+    PostgreSQL parses dates like DICOM's YYYYMMDD and booleans like 'false', SQLite stores them as given,
+    so they are converted here to ISO 8601 text and 1/0, which sort and compare correctly
+    :param value: a python value to be inserted
+    :param column_type: declared type of the column, e.g., 'date'
+    :return: the value to pass to sqlite3
+    """
+    if value is None or value == '(NULL)':
+        return None
+    if isinstance(value, BINARY_TYPES):
+        return sqlite3.Binary(value)
+    if column_type == 'date':
+        if isinstance(value, datetime):
+            return value.date().isoformat()
+        if isinstance(value, date):
+            return value.isoformat()
+        return parse_date(str(value)).date().isoformat()
+    if column_type == 'timestamp':
+        if isinstance(value, (date, datetime)):
+            return str(value)
+        return str(parse_date(str(value)))
+    if column_type == 'boolean':
+        return int(str(value).lower() in {'1', 't', 'true'})
+    return value
+
+
+def sqlite_now():
+    return str(datetime.now())
+
+
+def convert_sqlite_date(value):
+    try:
+        return parse_date(value.decode('ascii')).date()
+    except (ValueError, OverflowError):
+        return value.decode('ascii')
+
+
+def convert_sqlite_timestamp(value):
+    try:
+        return parse_date(value.decode('ascii'))
+    except (ValueError, OverflowError):
+        return value.decode('ascii')
+
+
+# Return dates, timestamps, booleans and bytea as the same python types psycopg2 does
+sqlite3.register_adapter(bytearray, sqlite3.Binary)
+sqlite3.register_converter('date', convert_sqlite_date)
+sqlite3.register_converter('timestamp', convert_sqlite_timestamp)
+sqlite3.register_converter('boolean', lambda value: value in {b'1', b't', b'true'})
+sqlite3.register_converter('bytea', bytearray)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Timing of the statements executed by DVH_SQL
+Every statement is timed and its rows and bytes counted per process, statements slower than
+SQL_SLOW_QUERY_SECONDS are also appended with their EXPLAIN output to SQL_SLOW_QUERY_LOG,
+which the admin view and the 'dvh slow_queries' command read
+"""
+
+from __future__ import print_function
+import heapq
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from options import SQL_SLOW_QUERY_LOG, SQL_SLOW_QUERY_COUNT
+from sql_cache import normalize_sql, estimate_size
+
+
+# Statements are summarized individually, least recently executed statements are dropped beyond this count
+MAX_SUMMARIZED_STATEMENTS = 1000
+
+# The slow query log is rewritten with only the slowest SQL_SLOW_QUERY_COUNT statements beyond this size
+MAX_SLOW_QUERY_LOG_BYTES = 10 * 1024 ** 2
+
+_log_lock = threading.Lock()
+
+
+class QueryStats:
+    def __init__(self, slowest_count=SQL_SLOW_QUERY_COUNT):
+        """
+        Thread-safe timing totals of each statement, and the slowest statements executed
+        :param slowest_count: number of slowest statements kept
+        """
+        self.slowest_count = slowest_count
+        self.statements = OrderedDict()  # normalized statement: dict of totals
+        self.slowest = []  # heap of (seconds, time_stamp, statement, rows, bytes)
+        self.lock = threading.Lock()
+
+    def record(self, statement, seconds, rows, size):
+        """
+        :param statement: the executed SQL statement
+        :param seconds: time spent executing the statement and fetching its rows
+        :param rows: number of rows returned
+        :param size: approximate bytes returned
+        """
+        key = normalize_sql(statement)
+        with self.lock:
+            totals = self.statements.pop(key, None)
+            if totals is None:
+                totals = {'count': 0, 'seconds': 0., 'max_seconds': 0., 'rows': 0, 'bytes': 0}
+                while len(self.statements) >= MAX_SUMMARIZED_STATEMENTS:
+                    self.statements.popitem(last=False)
+            self.statements[key] = totals
+            totals['count'] += 1
+            totals['seconds'] += seconds
+            totals['max_seconds'] = max(totals['max_seconds'], seconds)
+            totals['rows'] += rows
+            totals['bytes'] += size
+
+            entry = (seconds, str(datetime.now()), key, rows, size)
+            if len(self.slowest) < self.slowest_count:
+                heapq.heappush(self.slowest, entry)
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def get_summary(self):
+        """
+        :return: totals of each statement, with the most total time first
+        :rtype: list of dict
+        """
+        with self.lock:
+            summary = [dict(totals, statement=statement) for statement, totals in self.statements.items()]
+        return sorted(summary, key=lambda totals: totals['seconds'], reverse=True)
+
+    def get_slowest(self):
+        """
+        :return: the slowest statements executed, slowest first
+        :rtype: list of dict
+        """
+        with self.lock:
+            slowest = sorted(self.slowest, reverse=True)
+        return [{'seconds': seconds, 'time_stamp': time_stamp, 'statement': statement, 'rows': rows, 'bytes': size}
+                for seconds, time_stamp, statement, rows, size in slowest]
+
+    def clear(self):
+        with self.lock:
+            self.statements.clear()
+            self.slowest = []
+
+
+class InstrumentedCursor:
+    def __init__(self, cursor, on_statement):
+        """
+        Wraps a DB-API cursor, timing each statement and counting the rows fetched.
+        Attributes not defined here (e.g., rowcount) are those of cursor.
+        :param cursor: a psycopg2 or sqlite3 cursor
+        :param on_statement: called with (statement, seconds, rows, bytes) once a statement is complete
+        """
+        self._cursor = cursor
+        self._on_statement = on_statement
+        self._statement = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def execute(self, statement, *args):
+        return self._execute(self._cursor.execute, statement, *args)
+
+    def executemany(self, statement, *args):
+        return self._execute(self._cursor.executemany, statement, *args)
+
+    def copy_expert(self, statement, *args):
+        return self._execute(self._cursor.copy_expert, statement, *args)
+
+    def fetchone(self):
+        return self._fetch(self._cursor.fetchone, single=True)
+
+    def fetchmany(self, *size):
+        return self._fetch(self._cursor.fetchmany, *size)
+
+    def fetchall(self):
+        rows = self._fetch(self._cursor.fetchall)
+        self.finish()
+        return rows
+
+    def close(self, report=True):
+        """
+        :param report: False drops the current statement instead of reporting it
+        """
+        if report:
+            self.finish()
+        self._statement = None
+        self._cursor.close()
+
+    def _execute(self, execute, statement, *args):
+        self.finish()
+        started = time.time()
+        result = execute(statement, *args)  # failed statements are not reported
+        self._statement = statement
+        self._seconds = time.time() - started
+        self._rows = 0
+        self._bytes = 0
+        return result
+
+    def _fetch(self, fetch, *args, **kwargs):
+        started = time.time()
+        result = fetch(*args)
+        if self._statement is not None:
+            self._seconds += time.time() - started
+            if result is not None:
+                rows = [result] if kwargs.get('single') else result
+                self._rows += len(rows)
+                self._bytes += estimate_size(rows)
+        return result
+
+    def finish(self):
+        """
+        Report the current statement, called once all rows are fetched, by the next execute, or by close
+        """
+        if self._statement is not None:
+            statement, self._statement = self._statement, None
+            self._on_statement(statement, self._seconds, self._rows, self._bytes)
+
+
+def get_slow_query_log_path():
+    if os.path.isabs(SQL_SLOW_QUERY_LOG):
+        return SQL_SLOW_QUERY_LOG
+    return os.path.join(os.path.dirname(__file__), SQL_SLOW_QUERY_LOG)
+
+
+def write_slow_query(entry):
+    """
+    Append a slow statement to the slow query log, shared by every process using this installation
+    :param entry: dict with time_stamp, dbname, seconds, rows, bytes, statement, and plan (EXPLAIN output or None)
+    """
+    abs_file_path = get_slow_query_log_path()
+    with _log_lock:
+        try:
+            with open(abs_file_path, 'a') as document:
+                document.write(json.dumps(entry) + '\n')
+            if os.path.getsize(abs_file_path) > MAX_SLOW_QUERY_LOG_BYTES:
+                entries = read_slow_queries()
+                with open(abs_file_path, 'w') as document:
+                    for slow_query in reversed(entries):
+                        document.write(json.dumps(slow_query) + '\n')
+        except (IOError, OSError) as error:
+            print(str(datetime.now()), 'could not write slow query log: %s' % error, sep=' ')
+
+
+def read_slow_queries(count=SQL_SLOW_QUERY_COUNT):
+    """
+    :param count: maximum number of statements returned
+    :return: the slowest statements in the slow query log, slowest first
+    :rtype: list of dict
+    """
+    abs_file_path = get_slow_query_log_path()
+    if not os.path.isfile(abs_file_path):
+        return []
+    entries = []
+    with open(abs_file_path, 'r') as document:
+        for line in document:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                pass  # a partially written line
+    return heapq.nlargest(count, entries, key=lambda entry: entry.get('seconds', 0))
+
+
+def clear_slow_queries():
+    abs_file_path = get_slow_query_log_path()
+    with _log_lock:
+        if os.path.isfile(abs_file_path):
+            os.remove(abs_file_path)
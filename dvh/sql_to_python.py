@@ -2,50 +2,258 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
-from sql_connector import DVH_SQL
+from sql_connector import DVH_SQL, BINARY_TYPES
+from sql_cache import get_query_tables
+from options import SQL_STREAM_ITERSIZE
+from datetime import date, datetime
+import numpy as np
+
+
+# Columns too large to fetch by default, loaded on first access with a second batched query of the same rows,
+# selected by the row identity of the SQL engine (e.g., ctid), since no set of columns is unique (e.g., Force Update)
+LAZY_COLUMNS = {'dvhs': ['dvh_string', 'dvh_bytes', 'roi_coord_string', 'roi_coord_bytes']}
+
+# Columns of another table that may be requested as if they were columns of this table, matched by study
+RELATED_COLUMNS = {'dvhs': {'rx_dose': 'Plans',
+                            'fxs': 'Plans',
+                            'physician': 'Plans',
+                            'tx_site': 'Plans',
+                            'sim_study_date': 'Plans'}}
 
 
 class QuerySQL:
-    def __init__(self, table_name, condition_str, unique=False):
+    def __init__(self, table_name, condition_str, unique=False, columns=None):
+        """
+        :param table_name: Beams, DVHs, Plans, or Rxs
+        :param condition_str: a string in SQL syntax applied to the query
+        :param unique: return unique values for each column rather than one value per row
+        :param columns: a list of columns to fetch, defaults to all columns except LAZY_COLUMNS,
+        any column not fetched can still be accessed as an attribute and will be fetched at that time.
+        RELATED_COLUMNS of table_name may also be requested, they are selected in the same query
+        """
 
         table_name = table_name.lower()
 
         if table_name in {'beams', 'dvhs', 'plans', 'rxs'}:
             self.table_name = table_name
             self.condition_str = condition_str
+            self.unique = unique
             self.cnx = DVH_SQL()
+            self.row_id = "%s.%s" % (table_name, self.cnx.engine.row_id)
+            self._row_ids = None
 
             # column names, use as property names
-            column_cursor = self.cnx.get_column_names(table_name)
-
-            for row in column_cursor:
-                column = str(row).strip()
-                if column not in {'roi_coord_string, distances_to_ptv'}:
-                    self.cursor = self.cnx.query(self.table_name,
-                                                 column,
-                                                 self.condition_str)
-                if unique:
-                    rtn_list = get_unique_list(self.cursor_to_list())
-                else:
-                    rtn_list = self.cursor_to_list()
-                setattr(self, column, rtn_list)
+            self.table_columns = self.cnx.get_column_names(table_name)
+            self.cnx.close()
+            self.related_columns = [c for c in RELATED_COLUMNS.get(table_name, {}) if c not in self.table_columns]
+
+            lazy_columns = LAZY_COLUMNS.get(table_name, [])
+            if columns is None:
+                columns = [c for c in self.table_columns if c not in lazy_columns]
+            else:
+                invalid = [c for c in columns if c not in self.table_columns and c not in self.related_columns]
+                if invalid:
+                    raise ValueError("Invalid column(s) for %s: %s" % (table_name, ', '.join(invalid)))
+                columns = list(columns)
+
+            self.columns = []
+            self._columns = {}
+
+            # Fetch every requested column with a single query, transposing rows into columns batch by batch
+            # row identities are needed to fetch any lazily loaded column for these same rows
+            self.fetch_columns(columns, condition_str=condition_str, row_ids=table_name in LAZY_COLUMNS)
         else:
             print('Table name in valid. Please select from Beams, DVHs, Plans, or Rxs.')
 
-    def cursor_to_list(self):
+    def __getattr__(self, name):
+        # Only called when normal attribute lookup fails, i.e., a column not yet fetched
+        if not name.startswith('_') and (name in self.__dict__.get('table_columns', []) or
+                                         name in self.__dict__.get('related_columns', [])):
+            if self.unique or self.__dict__.get('_row_ids') is None:
+                self.fetch_columns([name], condition_str=self.condition_str)
+            else:
+                self.fetch_columns_by_row_id([name])
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def fetch_columns(self, columns, condition_str=None, row_ids=False):
+        """
+        Query columns with a single statement and set each as an attribute
+        :param columns: a list of column names
+        :param condition_str: a string in SQL syntax applied to the query
+        :param row_ids: also select the row identity of each row, see fetch_columns_by_row_id
+        """
+        select_str = self.get_select_str(columns)
+        if row_ids:
+            select_str = "%s, %s" % (self.row_id, select_str)
+
+        def stream_columns():
+            values = [[] for _ in range(len(columns) + int(row_ids))]
+            for rows in cnx.query_stream(self.table_name, select_str, condition_str):
+                for column_values, batch_values in zip(values, zip(*rows)):
+                    column_values.extend(batch_values)
+            # tuples, since the cached columns are shared with other QuerySQL objects
+            return [tuple(column_values) for column_values in values]
+
+        # the condition and related columns may read other tables (e.g., a semi-join on Plans)
+        tables = get_query_tables("Select %s from %s where %s" % (select_str, self.table_name, condition_str))
+        with DVH_SQL() as cnx:
+            values = cnx.cached(('columns', self.table_name, tuple(columns), condition_str, row_ids), tables,
+                                stream_columns)
+        if row_ids:
+            self._row_ids, values = values[0], values[1:]
+
+        self._columns.update(dict(zip(columns, values)))
+        self.set_column_attributes(columns)
+
+    def fetch_columns_by_row_id(self, columns):
+        """
+        Query columns for the rows already fetched, selected and matched by their row identity
+        :param columns: a list of column names
+        """
+        row_indices = {row_id: i for i, row_id in enumerate(self._row_ids)}
+        values = {column: [None] * len(self._row_ids) for column in columns}
+
+        with DVH_SQL() as cnx:
+            for rows in self.stream_by_row_id(cnx, self.get_select_str(columns)):
+                for row in rows:
+                    i = row_indices[row[0]]
+                    for j, column in enumerate(columns):
+                        values[column][i] = row[j + 1]
+
+        self._columns.update(values)
+        self.set_column_attributes(columns)
+
+    def stream_by_row_id(self, cnx, select_str, batch_size=SQL_STREAM_ITERSIZE):
+        """
+        Select values of the rows already fetched by their row identity, so condition_str isn't run again and only
+        these rows are read. With PostgreSQL, rows updated since they were fetched have a new identity and are missed
+        :param cnx: a DVH_SQL object
+        :param select_str: columns or expressions in SQL syntax
+        :param batch_size: number of rows selected per statement
+        :return: a generator of lists of rows, the first value of each row is its row identity
+        """
+        for start in range(0, len(self._row_ids or []), batch_size):
+            condition = cnx.engine.row_id_condition(self._row_ids[start:start + batch_size])
+            for rows in cnx.query_stream(self.table_name, "%s, %s" % (self.row_id, select_str), condition):
+                yield rows
+
+    def get_row_ids(self):
+        """
+        :return: the row identity of each row, see stream_by_row_id
+        :rtype: tuple
+        """
+        return self._row_ids or ()
+
+    def get_select_str(self, columns):
+        """
+        :param columns: a list of column names, which may include RELATED_COLUMNS
+        :return: the select list for columns, related columns are correlated sub-queries
+        :rtype: str
+        """
+        related = RELATED_COLUMNS.get(self.table_name, {})
+        select = []
+        for column in columns:
+            if column in self.related_columns:
+                select.append("(SELECT {1}.{0} FROM {1} WHERE {1}.study_instance_uid = {2}.study_instance_uid "
+                              "AND {1}.mrn = {2}.mrn LIMIT 1)".format(column, related[column], self.table_name))
+            else:
+                select.append(column)
+        return ', '.join(select)
+
+    def set_column_attributes(self, columns):
+        for column in columns:
+            if self.unique:
+                rtn_list = get_unique_list(self.column_to_list(column))
+            else:
+                rtn_list = self.column_to_list(column)
+            setattr(self, column, rtn_list)
+            if column not in self.columns:
+                self.columns.append(column)
+
+    def column_to_list(self, column):
         rtn_list = []
-        for row in self.cursor:
-            if isinstance(row[0], (int, long, float)):
-                rtn_list.append(row[0])
+        for value in self._columns[column]:
+            if isinstance(value, (int, long, float)) or isinstance(value, BINARY_TYPES):
+                rtn_list.append(value)
             else:
-                rtn_list.append(str(row[0]))
+                rtn_list.append(str(value))
         return rtn_list
 
+    def get_raw_column(self, column):
+        """
+        :param column: name of a column returned by this query
+        :return: values as returned by psycopg2 (e.g., NULL is None rather than 'None')
+        :rtype: tuple
+        """
+        if column not in self._columns:
+            getattr(self, column)
+        return self._columns[column]
 
-def get_unique_list(input_list):
-    rtn_list_unique = []
-    for value in input_list:
-        if value not in rtn_list_unique:
-            rtn_list_unique.append(value)
+    def get_typed_column(self, column):
+        """
+        :param column: name of a column returned by this query
+        :return: numbers as a numpy array (NULL -> nan), dates as datetime64 (NULL -> NaT),
+        binary values as an object array, and anything else as a DictionaryColumn
+        """
+        return typed_column(self._columns[column])
+
+    def get_typed_columns(self):
+        """
+        :return: every column of this query, typed per get_typed_column
+        :rtype: dict
+        """
+        return {column: self.get_typed_column(column) for column in self.columns}
+
+
+class DictionaryColumn:
+    def __init__(self, values):
+        """
+        Dictionary encoded string column, each distinct value is stored once in categories
+        :param values: a list of strings, None is stored as 'None' to match QuerySQL lists
+        """
+        values = [str(value) for value in values]
+        self.categories, self.codes = np.unique(np.array(values, dtype=object), return_inverse=True)
+        self.codes = self.codes.astype(np.int32)
+
+    def __len__(self):
+        return len(self.codes)
 
-    return rtn_list_unique
+    def __getitem__(self, index):
+        return self.categories[self.codes[index]]
+
+    def tolist(self):
+        return self.categories[self.codes].tolist()
+
+
+def typed_column(values):
+    """
+    :param values: a list of python values from a single SQL column
+    :return: a numpy array or DictionaryColumn based on the first non-NULL value
+    """
+    sample = next((value for value in values if value is not None), None)
+
+    if isinstance(sample, bool) or isinstance(sample, BINARY_TYPES):
+        return np.array(values, dtype=object)
+    if isinstance(sample, (int, long)):
+        if None in values:
+            return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+        return np.array(values, dtype=np.int64)
+    if isinstance(sample, float):
+        return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+    if isinstance(sample, datetime):
+        return np.array(['NaT' if value is None else value for value in values], dtype='datetime64[s]')
+    if isinstance(sample, date):
+        return np.array(['NaT' if value is None else value for value in values], dtype='datetime64[D]')
+
+    return DictionaryColumn(values)
+
+
+def get_unique_list(input_list):
+    """
+    :param input_list: a list of hashable values
+    :return: the unique values of input_list, in order of first appearance
+    :rtype: list
+    """
+    seen = set()
+    return [value for value in input_list if not (value in seen or seen.add(value))]
@@ -2,17 +2,22 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
-from future.utils import listitems
+from future.utils import listitems, listvalues
 from sql_to_python import QuerySQL
-from sql_connector import DVH_SQL
+from sql_connector import DVH_SQL, ROW_ID
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from dicompylercore import dicomparser
 import os
 import sys
 from shapely.geometry import Polygon, Point
+from shapely.prepared import prep
 import numpy as np
-from scipy.spatial.distance import cdist
+from scipy.spatial import cKDTree
+from concurrent.futures import ThreadPoolExecutor
+from options import DICOM_SCAN_WORKERS, PTV_DISTANCE_WORKERS, PTV_DISTANCE_CHUNK_SIZE, GEOMETRY_ENGINES, \
+    GEOMETRY_VOXEL_SIZE
+import voxel_geometry
 try:
     import pydicom as dicom  # for pydicom >= 1.0
 except:
@@ -22,6 +27,9 @@ from get_settings import get_settings
 PREFERENCE_PATHS = {''}
 MIN_SLICE_THICKNESS = 2  # Update method to pull from DICOM
 
+# The only elements read when scanning for DICOM files, see scan_dicom_headers
+DICOM_HEADER_TAGS = ['PatientID', 'StudyInstanceUID', 'Modality']
+
 
 class Temp_DICOM_FileSet:
     def __init__(self, start_path=None):
@@ -55,32 +63,31 @@ class Temp_DICOM_FileSet:
 
         plan_files = []
         study_uid_plan = []
+        mrn_plan = []
         structure_files = []
         study_uid_structure = []
         dose_files = []
         study_uid_dose = []
 
-        for x in range(len(f)):
-            try:
-                dicom_file = dicom.read_file(f[x])
-                if dicom_file.Modality.lower() == 'rtplan':
-                    plan_files.append(f[x])
-                    study_uid_plan.append(dicom_file.StudyInstanceUID)
-                elif dicom_file.Modality.lower() == 'rtstruct':
-                    structure_files.append(f[x])
-                    study_uid_structure.append(dicom_file.StudyInstanceUID)
-                elif dicom_file.Modality.lower() == 'rtdose':
-                    dose_files.append(f[x])
-                    study_uid_dose.append(dicom_file.StudyInstanceUID)
-            except Exception:
-                pass
+        for file_path, header in zip(f, scan_dicom_headers(f)):
+            if header:
+                if header['modality'] == 'rtplan':
+                    plan_files.append(file_path)
+                    study_uid_plan.append(header['study_instance_uid'])
+                    mrn_plan.append(header['mrn'])
+                elif header['modality'] == 'rtstruct':
+                    structure_files.append(file_path)
+                    study_uid_structure.append(header['study_instance_uid'])
+                elif header['modality'] == 'rtdose':
+                    dose_files.append(file_path)
+                    study_uid_dose.append(header['study_instance_uid'])
 
         self.count = len(plan_files)
 
         for a in range(self.count):
             self.plan.append(plan_files[a])
-            self.mrn.append(dicom.read_file(plan_files[a]).PatientID)
-            self.study_instance_uid.append(dicom.read_file(plan_files[a]).StudyInstanceUID)
+            self.mrn.append(mrn_plan[a])
+            self.study_instance_uid.append(study_uid_plan[a])
             for b in range(len(structure_files)):
                 if study_uid_plan[a] == study_uid_structure[b]:
                     self.structure.append(structure_files[b])
@@ -108,6 +115,46 @@ class Temp_DICOM_FileSet:
         return roi
 
 
+def scan_dicom_headers(file_paths, workers=DICOM_SCAN_WORKERS):
+    """
+    Identify DICOM files by reading only the elements in DICOM_HEADER_TAGS, on a pool of threads since
+    the time is spent waiting on the file system
+    :param file_paths: a list of absolute file paths
+    :param workers: number of threads
+    :return: the result of read_dicom_header for each file, in the order of file_paths
+    :rtype: list
+    """
+    if workers <= 1 or len(file_paths) <= 1:
+        return [read_dicom_header(file_path) for file_path in file_paths]
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        return list(executor.map(read_dicom_header, file_paths))
+    finally:
+        executor.shutdown()
+
+
+def read_dicom_header(file_path):
+    """
+    :param file_path: absolute file path
+    :return: mrn, study_instance_uid, and modality (lower case) of a DICOM file, None if not a DICOM file
+    :rtype: dict
+    """
+    try:
+        # DICOM files start with a 128 byte preamble followed by 'DICM', anything else is skipped unread
+        with open(file_path, 'rb') as document:
+            if document.read(132)[128:] != b'DICM':
+                return None
+        try:
+            dicom_file = dicom.read_file(file_path, stop_before_pixels=True, specific_tags=DICOM_HEADER_TAGS)
+        except TypeError:  # pydicom < 1.0 has no specific_tags
+            dicom_file = dicom.read_file(file_path, stop_before_pixels=True)
+        return {'mrn': dicom_file.PatientID,
+                'study_instance_uid': dicom_file.StudyInstanceUID,
+                'modality': dicom_file.Modality.lower()}
+    except Exception:
+        return None
+
+
 def recalculate_ages(*custom_condition):
 
     if custom_condition:
@@ -115,14 +162,15 @@ def recalculate_ages(*custom_condition):
     else:
         custom_condition = ''
 
-    dvh_data = QuerySQL('Plans', "mrn != ''" + custom_condition)
-    cnx = DVH_SQL()
+    with DVH_SQL() as cnx:
+        # a study may have more than one plan, so ages are written back by row identity
+        plans = cnx.query('Plans', '%s, mrn, sim_study_date, birth_date' % cnx.engine.row_id,
+                          "mrn != ''" + custom_condition)
+    new_ages = {ROW_ID: [], 'age': []}
 
-    for i in range(len(dvh_data.mrn)):
-        mrn = dvh_data.mrn[i]
-        uid = dvh_data.study_instance_uid[i]
-        sim_study_date = dvh_data.sim_study_date[i].split('-')
-        birth_date = dvh_data.birth_date[i].split('-')
+    for row_id, mrn, sim_study_date, birth_date in plans:
+        sim_study_date = str(sim_study_date).split('-')
+        birth_date = str(birth_date).split('-')
 
         try:
             birth_year = int(birth_date[0])
@@ -140,12 +188,13 @@ def recalculate_ages(*custom_condition):
             else:
                 age = relativedelta(sim_study_date_obj, birth_date_obj).years
 
-            condition = "study_instance_uid = '" + uid + "'"
-            cnx.update('Plans', 'age', str(age), condition)
+            new_ages[ROW_ID].append(row_id)
+            new_ages['age'].append(age)
         except:
             print("Update Failed for", mrn, "sim date:", sim_study_date, "birthdate", birth_date, sep=' ')
 
-    cnx.close()
+    with DVH_SQL() as cnx:
+        cnx.bulk_update('Plans', [ROW_ID], new_ages)
 
 
 def recalculate_total_mu(*custom_condition):
@@ -157,7 +206,6 @@ def recalculate_total_mu(*custom_condition):
 
     # Get entire table
     beam_data = QuerySQL('Beams', "mrn != ''" + custom_condition)
-    cnx = DVH_SQL()
 
     plan_mus = {}
     for i in range(len(beam_data.study_instance_uid)):
@@ -169,10 +217,11 @@ def recalculate_total_mu(*custom_condition):
 
         plan_mus[uid] += beam_mu * fxs
 
-    for uid in list(plan_mus):
-        cnx.update('Plans', 'total_mu', str(round(plan_mus[uid], 1)), "study_instance_uid = '%s'" % uid)
-
-    cnx.close()
+    uids = list(plan_mus)
+    with DVH_SQL() as cnx:
+        cnx.bulk_update('Plans', ['study_instance_uid'],
+                        {'study_instance_uid': uids,
+                         'total_mu': [round(plan_mus[uid], 1) for uid in uids]})
 
 
 def datetime_str_to_obj(datetime_str):
@@ -367,8 +416,8 @@ def dicompyler_roi_coord_to_db_string(coord):
 
 def surface_area_of_roi(coord, coord_type='dicompyler'):
     """
-    :param coord: dicompyler structure coordinates from GetStructureCoordinates() or sets_of_points
-    :param coord_type: either 'dicompyler' or 'sets_of_points'
+    :param coord: dicompyler structure coordinates from GetStructureCoordinates(), sets_of_points, or a PackedROI
+    :param coord_type: either 'dicompyler' or 'sets_of_points' (also used for a PackedROI)
     :return: surface_area in cm^2
     :rtype: float
     """
@@ -377,59 +426,56 @@ def surface_area_of_roi(coord, coord_type='dicompyler'):
         sets_of_points = coord
     else:
         sets_of_points = dicompyler_roi_to_sets_of_points(coord)
+    roi = sets_of_points if isinstance(sets_of_points, PackedROI) else sets_of_points_to_packed_roi(sets_of_points)
 
-    shapely_roi = get_shapely_from_sets_of_points(sets_of_points)
-
-    slice_count = len(shapely_roi['z'])
-
-    area = 0.
-    polygon = shapely_roi['polygon']
-    z = shapely_roi['z']
-    thickness = min(shapely_roi['thickness'])
+    # thickness is taken from the slices with area, so stray contours (e.g., a single point between two slices, which
+    # are dropped by dicompyler_roi_to_sets_of_points at import) do not change the result
+    z, areas, perimeters, slice_index = get_slice_geometry(roi)
+    slice_count = len(z)
+    thickness = np.min(np.diff(z)) if slice_count > 1 else MIN_SLICE_THICKNESS
 
+    # the sides, then the top and bottom of each slice not covered by the adjacent slice
+    area = np.sum(perimeters) * thickness
+    shapes = {}
     for i in range(slice_count):
         for j in [-1, 1]:  # -1 for bottom area and 1 for top area
             # ensure bottom of first slice and top of last slice are fully added
             # if prev/next slice is not adjacent, assume non-contiguous ROI
             if (i == 0 and j == -1) or (i == slice_count-1 and j == 1) or abs(z[i] - z[i+j]) > 2*thickness:
-                area += polygon[i].area
+                area += areas[i]
             else:
-                area += polygon[i].difference(polygon[i+j]).area
+                area += get_slice_difference_area(roi, slice_index, i, i+j, areas[i], shapes)
 
-        area += polygon[i].length * thickness
+    return round(float(area) / 100, 3)
 
-    return round(area/100, 3)
 
-
-def get_shapely_from_sets_of_points(sets_of_points):
+def get_slice_difference_area(roi, slice_index, i, j, area_i, shapes):
     """
-    :param sets_of_points: a dictionary of slices with key being a str representation of z value, value is a list
-    of points defining a polygon in the slice.  point[0] is x and point[1] is y
-    :return: roi_slice which is a dictionary of lists of z, thickness, and a Shapely Polygon class object
-    :rtype: list
+    Area of slice i not covered by slice j, the only term of surface_area_of_roi calculated with shapely
+    :param roi: a PackedROI
+    :param slice_index: slice of each polygon of roi, see get_slice_geometry
+    :param i: index of a slice
+    :param j: index of the adjacent slice
+    :param area_i: area of slice i
+    :param shapes: shapely polygons of slices and intersections of slice pairs already calculated, which are
+    shared by the difference of i and j and the difference of j and i
+    :return: area in mm^2
+    :rtype: float
     """
-
-    roi_slice = {'z': [], 'thickness': [], 'polygon': []}
-
-    sets_of_points_keys = list(sets_of_points)
-    sets_of_points_keys.sort()
-
-    all_z_values = [round(float(z), 2) for z in sets_of_points_keys]
-    thicknesses = np.abs(np.diff(all_z_values))
-    if len(thicknesses):
-        thicknesses = np.append(thicknesses, np.min(thicknesses))
-    else:
-        thicknesses = np.array([MIN_SLICE_THICKNESS])
-
-    for z in sets_of_points:
-        thickness = thicknesses[all_z_values.index(round(float(z), 2))]
-        shapely_roi = points_to_shapely_polygon(sets_of_points[z])
-        if shapely_roi:
-            roi_slice['z'].append(round(float(z), 2))
-            roi_slice['thickness'].append(thickness)
-            roi_slice['polygon'].append(shapely_roi)
-
-    return roi_slice
+    bounds = []
+    for k in [i, j]:
+        points = np.concatenate([roi.polygon(p) for p in np.flatnonzero(slice_index == k)])
+        bounds.append((np.min(points[:, 0:2], axis=0), np.max(points[:, 0:2], axis=0)))
+    if np.any(bounds[0][1] < bounds[1][0]) or np.any(bounds[1][1] < bounds[0][0]):
+        return area_i  # bounding boxes do not overlap
+
+    for k in [i, j]:
+        if k not in shapes:
+            shapes[k] = points_to_shapely_polygon([roi.polygon(p) for p in np.flatnonzero(slice_index == k)])
+    pair = (min(i, j), max(i, j))
+    if pair not in shapes:
+        shapes[pair] = shapes[i].intersection(shapes[j]).area
+    return shapes[i].area - shapes[pair]
 
 
 def dicompyler_roi_to_sets_of_points(coord):
@@ -443,8 +489,6 @@ def dicompyler_roi_to_sets_of_points(coord):
         all_points[z] = []
         for plane in coord[z]:
             plane_points = [[float(point[0]), float(point[1])] for point in plane['data']]
-            for point in plane['data']:
-                plane_points.append([float(point[0]), float(point[1])])
             if len(plane_points) > 2:
                 all_points[z].append(plane_points)
     return all_points
@@ -464,8 +508,8 @@ def points_to_shapely_polygon(sets_of_points):
     composite_polygon = []
     for set_of_points in sets_of_points:
         if len(set_of_points) > 3:
-            points = [(point[0], point[1]) for point in set_of_points]
-            points.append(points[0])  # Explicitly connect the final point to the first
+            points = np.asarray(set_of_points, dtype=np.float64)[:, 0:2]
+            points = np.vstack((points, points[0:1]))  # Explicitly connect the final point to the first
 
             # if there are multiple sets of points in a slice, each set is a polygon,
             # interior polygons are subtractions, exterior are addition
@@ -482,33 +526,47 @@ def points_to_shapely_polygon(sets_of_points):
     return composite_polygon
 
 
-def calc_roi_overlap(oar, tv):
+def calc_roi_overlap(oar, tv, tv_slices=None):
     """
     :param oar: dict representing organ-at-risk, follows format of "sets of points" in dicompyler_roi_to_sets_of_points
     :param tv: dict representing tumor volume
+    :param tv_slices: get_slice_polygons(tv), to reuse the polygons of tv for several OARs
     :return: volume of overlap between ROIs
     :rtype: float
     """
+    if tv_slices is None:
+        tv_slices = get_slice_polygons(tv)
 
     intersection_volume = 0.
-    all_z_values = [round(float(z), 2) for z in list(tv)]
+    for z, (thickness, shapely_tv, prepared_tv) in tv_slices.items():
+        if z in oar:
+            shapely_oar = points_to_shapely_polygon(oar[z])
+            if shapely_oar and prepared_tv.intersects(shapely_oar):
+                intersection_volume += shapely_tv.intersection(shapely_oar).area * thickness
+
+    return round(intersection_volume / 1000., 2)
+
+
+def get_slice_polygons(roi):
+    """
+    :param roi: a "sets of points" formatted dict
+    :return: thickness, shapely polygon, and prepared polygon (for fast intersects tests) of each slice with
+    a polygon, keyed by the keys of roi
+    :rtype: dict
+    """
+    # z in roi will not necessarily go in order of z, convert z to float to lookup thickness
+    all_z_values = [round(float(z), 2) for z in list(roi)]
     all_z_values = np.sort(all_z_values)
     thicknesses = np.abs(np.diff(all_z_values))
     thicknesses = np.append(thicknesses, np.min(thicknesses))
     all_z_values = all_z_values.tolist()
 
-    for z in list(tv):
-        # z in coord will not necessarily go in order of z, convert z to float to lookup thickness
-        # also used to check for top and bottom slices, to add area of those contours
-
-        if z in list(oar):
-            thickness = thicknesses[all_z_values.index(round(float(z), 2))]
-            shapely_tv = points_to_shapely_polygon(tv[z])
-            shapely_oar = points_to_shapely_polygon(oar[z])
-            if shapely_oar and shapely_tv:
-                intersection_volume += shapely_tv.intersection(shapely_oar).area * thickness
-
-    return round(intersection_volume / 1000., 2)
+    slices = {}
+    for z in list(roi):
+        polygon = points_to_shapely_polygon(roi[z])
+        if polygon:
+            slices[z] = (thicknesses[all_z_values.index(round(float(z), 2))], polygon, prep(polygon))
+    return slices
 
 
 def get_union(rois):
@@ -566,36 +624,385 @@ def get_union(rois):
     return new_roi
 
 
-def calc_volume(roi):
+def calc_volume(roi, engine=GEOMETRY_ENGINES['volume']):
     """
-    :param roi: a "sets of points" formatted list
+    :param roi: a "sets of points" formatted list, or a PackedROI
+    :param engine: 'polygon', 'voxel', or 'validate', see GEOMETRY_ENGINES
     :return: volume in cm^3 of roi
     :rtype: float
     """
+    if not isinstance(roi, PackedROI):
+        roi = sets_of_points_to_packed_roi(roi)
 
-    # oar and ptv are lists using str(z) as keys
-    # each item is an ordered list of points representing a polygon
-    # polygon n is inside polygon n-1, then the current accumulated polygon is
-    #    polygon n subtracted from the accumulated polygon up to and including polygon n-1
-    #    Same method DICOM uses to handle rings and islands
+    if engine == 'voxel':
+        return voxel_geometry.calc_volume(roi, voxel_size=GEOMETRY_VOXEL_SIZE, default_thickness=MIN_SLICE_THICKNESS)
+    volume = calc_polygon_volume(roi)
+    if engine == 'validate':
+        print_geometry_difference('volume', volume, voxel_geometry.calc_volume(
+            roi, voxel_size=GEOMETRY_VOXEL_SIZE, default_thickness=MIN_SLICE_THICKNESS))
+    return volume
 
-    volume = 0.
-    all_z_values = [round(float(z), 2) for z in list(roi)]
-    all_z_values = np.sort(all_z_values)
-    thicknesses = np.abs(np.diff(all_z_values))
-    thicknesses = np.append(thicknesses, np.min(thicknesses))
-    all_z_values = all_z_values.tolist()
 
-    for z in list(roi):
-        # z in coord will not necessarily go in order of z, convert z to float to lookup thickness
-        # also used to check for top and bottom slices, to add area of those contours
+def calc_polygon_volume(roi):
+    """
+    :param roi: a PackedROI
+    :return: volume in cm^3 of roi, from the area of each slice
+    :rtype: float
+    """
+    z, areas = get_slice_geometry(roi, perimeters=False)[0:2]
+    if not len(z):
+        return 0.
+
+    # each slice extends to the next contour, the last by the smallest spacing. As in the original shapely calculation,
+    # contours without area still count as slices here, so the volume matches values calculated before PackedROI
+    all_z_values = np.unique(np.round(np.asarray(roi.z, dtype=np.float64), 2))
+    thicknesses = np.diff(all_z_values)
+    thicknesses = np.append(thicknesses, np.min(thicknesses) if len(thicknesses) else MIN_SLICE_THICKNESS)
+
+    return round(float(np.sum(areas * thicknesses[np.searchsorted(all_z_values, z)])) / 1000., 2)
+
+
+def dvh_to_bytes(counts):
+    """
+    :param counts: a DVH with 1 cGy bins (e.g., dicompyler's DVH.counts)
+    :return: the DVH as little-endian float32 values, as stored in the dvh_bytes column
+    :rtype: bytearray
+    """
+    return bytearray(np.asarray(counts, dtype='<f4').tobytes())
+
+
+def bytes_to_dvh(dvh_bytes):
+    """
+    :param dvh_bytes: value of the dvh_bytes column
+    :return: the DVH as a read-only view of dvh_bytes, no copy is made
+    :rtype: numpy 1D array
+    """
+    return np.frombuffer(dvh_bytes, dtype='<f4')
+
+
+def dvh_string_to_array(dvh_string):
+    """
+    :param dvh_string: value of the dvh_string column
+    :return: the DVH
+    :rtype: numpy 1D array
+    """
+    return np.array(dvh_string.split(','), dtype=np.float64)
+
+
+def convert_dvh_strings_to_bytes(*condition, **kwargs):
+    """
+    Populate dvh_bytes from dvh_string for DVHs imported before dvh_bytes existed
+    :param condition: optional SQL condition to limit which DVHs are converted
+    :param batch_size: number of DVHs converted per query/update, defaults to 1000
+    :return: number of DVHs converted
+    :rtype: int
+    """
+    return convert_text_column_to_bytes('dvh_string', 'dvh_bytes',
+                                        lambda dvh_string: dvh_to_bytes(dvh_string_to_array(dvh_string)),
+                                        *condition, **kwargs)
+
+
+def convert_roi_coord_strings_to_bytes(*condition, **kwargs):
+    """
+    Populate roi_coord_bytes from roi_coord_string for ROIs imported before roi_coord_bytes existed
+    :param condition: optional SQL condition to limit which ROIs are converted
+    :param batch_size: number of ROIs converted per query/update, defaults to 1000
+    :return: number of ROIs converted
+    :rtype: int
+    """
+    return convert_text_column_to_bytes('roi_coord_string', 'roi_coord_bytes', roi_coord_string_to_bytes,
+                                        *condition, **kwargs)
+
+
+def convert_text_column_to_bytes(text_column, bytes_column, converter, *condition, **kwargs):
+    """
+    Populate a bytea column of the DVHs table from its text counterpart, in batches
+    :param text_column: name of the text column, e.g., dvh_string
+    :param bytes_column: name of the bytea column, e.g., dvh_bytes
+    :param converter: function converting a text_column value into a bytes_column value
+    :param condition: optional SQL condition to limit which rows are converted
+    :param batch_size: number of rows converted per query/update, defaults to 1000
+    :return: number of rows converted
+    :rtype: int
+    """
+    batch_size = kwargs.get('batch_size', 1000)
+    condition_str = "%s IS NULL AND %s IS NOT NULL" % (bytes_column, text_column)
+    if condition:
+        condition_str = "%s AND (%s)" % (condition_str, condition[0])
+
+    converted = 0
+    with DVH_SQL() as cnx:
+        # the row identities are collected before anything is written, since no read may be open during a commit
+        # (a commit closes a PostgreSQL stream, and SQLite can't commit while another connection is reading)
+        row_ids = [row[0] for rows in cnx.query_stream('DVHs', cnx.engine.row_id, condition_str) for row in rows]
+        for start in range(0, len(row_ids), batch_size):
+            condition = cnx.engine.row_id_condition(row_ids[start:start + batch_size])
+            rows = [row for rows in cnx.query_stream('DVHs', '%s, %s' % (cnx.engine.row_id, text_column), condition)
+                    for row in rows]
+            # matched by row identity, study_instance_uid and roi_name may not be unique (e.g., after a Force Update)
+            new_values = {ROW_ID: [row[0] for row in rows],
+                          bytes_column: [converter(row[1]) for row in rows]}
+            converted += cnx.bulk_update('DVHs', [ROW_ID], new_values)
+            print("%s of %s %s values converted" % (converted, len(row_ids), text_column))
+
+    return converted
+
+
+class PackedROI:
+    def __init__(self, points, offsets, z):
+        """
+        Contours of an ROI packed into contiguous arrays, as stored in the roi_coord_bytes column
+        :param points: Nx3 numpy array of x, y, z for every point of every polygon
+        :param offsets: numpy array, polygon i is points[offsets[i]:offsets[i+1]]
+        :param z: numpy array of the z value of each polygon
+        """
+        self.points = points
+        self.offsets = offsets
+        self.z = z
+        self.polygon_count = len(z)
+
+    def polygon(self, index):
+        """
+        :return: Nx3 view of the points of a polygon, no copy is made
+        :rtype: numpy 2D array
+        """
+        return self.points[self.offsets[index]:self.offsets[index + 1]]
+
+    def slices(self):
+        """
+        :return: polygon views keyed by str(round(z, 2)), same keys as get_planes_from_string
+        :rtype: dict
+        """
+        slices = {}
+        for i in range(self.polygon_count):
+            z_str = str(round(float(self.z[i]), 2))
+            if z_str not in slices:
+                slices[z_str] = []
+            slices[z_str].append(self.polygon(i))
+        return slices
+
+
+def pack_roi(polygons):
+    """
+    :param polygons: a list of Nx3 point arrays (or lists), one per polygon, all points of a polygon share one z
+    :return: packed representation stored in the roi_coord_bytes column
+    little-endian: uint32 polygon count, uint32 point count, float32 z per polygon,
+    uint32 offsets (polygon count + 1), float32 x, y, z per point
+    :rtype: bytearray
+    """
+    polygons = [np.asarray(polygon, dtype='<f4').reshape(-1, 3) for polygon in polygons]
+    lengths = [len(polygon) for polygon in polygons]
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype('<u4')
+    z = np.array([polygon[0, 2] if len(polygon) else 0 for polygon in polygons], dtype='<f4')
+    if polygons:
+        points = np.concatenate(polygons)
+    else:
+        points = np.zeros((0, 3), dtype='<f4')
+    header = np.array([len(polygons), len(points)], dtype='<u4')
+    return bytearray(header.tobytes() + z.tobytes() + offsets.tobytes() + points.tobytes())
+
+
+def unpack_roi(roi_bytes):
+    """
+    :param roi_bytes: value of the roi_coord_bytes column
+    :return: ROI with arrays that are read-only views of roi_bytes, no copy is made
+    :rtype: PackedROI
+    """
+    polygon_count, point_count = [int(v) for v in np.frombuffer(roi_bytes, dtype='<u4', count=2)]
+    offset = 8
+    z = np.frombuffer(roi_bytes, dtype='<f4', count=polygon_count, offset=offset)
+    offset += 4 * polygon_count
+    offsets = np.frombuffer(roi_bytes, dtype='<u4', count=polygon_count + 1, offset=offset)
+    offset += 4 * (polygon_count + 1)
+    points = np.frombuffer(roi_bytes, dtype='<f4', count=3 * point_count, offset=offset).reshape(-1, 3)
+    return PackedROI(points, offsets, z)
+
 
-        thickness = thicknesses[all_z_values.index(round(float(z), 2))]
-        shapely_roi = points_to_shapely_polygon(roi[z])
-        if shapely_roi:
-            volume += shapely_roi.area * thickness
+def sets_of_points_to_packed_roi(sets_of_points):
+    """
+    :param sets_of_points: a "sets of points" formatted dict, points may be x, y or x, y, z
+    :return: the polygons of at least 3 points, with z taken from the keys of sets_of_points
+    :rtype: PackedROI
+    """
+    polygons = []
+    for z in sets_of_points:
+        for polygon in sets_of_points[z]:
+            if len(polygon) > 2:
+                xy = np.asarray(polygon, dtype=np.float64)[:, 0:2]
+                polygons.append(np.column_stack((xy, np.full(len(xy), float(z)))))
+    lengths = [len(polygon) for polygon in polygons]
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.intp)
+    points = np.concatenate(polygons) if polygons else np.zeros((0, 3))
+    return PackedROI(points, offsets, np.array([polygon[0, 2] for polygon in polygons]))
 
-    return round(volume / 1000., 2)
+
+def get_polygon_geometry(points, offsets):
+    """
+    Shoelace formula vectorised over every polygon of packed point arrays
+    :param points: Nx2 or Nx3 array of every point of every polygon, polygons are implicitly closed
+    :param offsets: polygon i is points[offsets[i]:offsets[i+1]]
+    :return: signed area (positive if counter-clockwise) and perimeter of each polygon, 0 for less than 3 points
+    :rtype: tuple
+    """
+    offsets = np.asarray(offsets, dtype=np.intp)
+    lengths = np.diff(offsets)
+    areas, perimeters = np.zeros(len(lengths)), np.zeros(len(lengths))
+    polygons = lengths > 2
+    if not np.any(polygons):
+        return areas, perimeters
+
+    # only polygons of at least 3 points, which remain contiguous
+    starts, ends = offsets[:-1][polygons], offsets[1:][polygons]
+    point_index = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+    x, y = [np.asarray(points[point_index, axis], dtype=np.float64) for axis in [0, 1]]
+    local_starts = np.concatenate(([0], np.cumsum(ends - starts)[:-1]))
+
+    # next point of each point, the last point of a polygon is followed by its first
+    next_index = np.arange(1, len(x) + 1)
+    next_index[local_starts + ends - starts - 1] = local_starts
+    # relative to the first point of each polygon, limiting round-off error far from the origin
+    x0, y0 = np.repeat(x[local_starts], ends - starts), np.repeat(y[local_starts], ends - starts)
+    x, y = x - x0, y - y0
+    x_next, y_next = x[next_index], y[next_index]
+
+    areas[polygons] = 0.5 * np.add.reduceat(x * y_next - x_next * y, local_starts)
+    perimeters[polygons] = np.add.reduceat(np.hypot(x_next - x, y_next - y), local_starts)
+    return areas, perimeters
+
+
+def remove_spikes(points, offsets):
+    """
+    Remove repeated points and spikes (a point whose two edges are collinear and opposite) from packed polygons,
+    these add to the perimeter of a contour but not to its area, and shapely's buffer(0) removes them as well
+    :param points: Nx2 or Nx3 array of every point of every polygon
+    :param offsets: polygon i is points[offsets[i]:offsets[i+1]]
+    :return: x, y of the remaining points and their offsets, the polygon count is unchanged
+    :rtype: tuple
+    """
+    xy = np.asarray(points, dtype=np.float64)[:, 0:2]
+    offsets = np.asarray(offsets, dtype=np.intp)
+    polygon_count = len(offsets) - 1
+    polygon = np.repeat(np.arange(polygon_count), np.diff(offsets))
+
+    # a spike several points long is removed one point per iteration, from its tip,
+    # only polygons that had points removed are checked again
+    checked = np.ones(polygon_count, dtype=bool)
+    while len(xy):
+        lengths = np.bincount(polygon, minlength=polygon_count)
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        index = np.flatnonzero(checked[polygon])
+        first, last = starts[polygon[index]], starts[polygon[index]] + lengths[polygon[index]] - 1
+        previous_edge = xy[index] - xy[np.where(index == first, last, index - 1)]
+        next_edge = xy[np.where(index == last, first, index + 1)] - xy[index]
+
+        repeated = np.all(previous_edge == 0, axis=1)
+        cross = previous_edge[:, 0] * next_edge[:, 1] - previous_edge[:, 1] * next_edge[:, 0]
+        dot = np.sum(previous_edge * next_edge, axis=1)
+        scale = np.hypot(*previous_edge.T) * np.hypot(*next_edge.T)
+        removed = index[(repeated | ((np.abs(cross) <= 1e-6 * scale) & (dot < 0))) & (lengths[polygon[index]] > 1)]
+        if not len(removed):
+            break
+        checked = np.zeros(polygon_count, dtype=bool)
+        checked[polygon[removed]] = True
+        xy, polygon = np.delete(xy, removed, axis=0), np.delete(polygon, removed)
+
+    lengths = np.bincount(polygon, minlength=polygon_count)
+    return xy, np.concatenate(([0], np.cumsum(lengths))).astype(np.intp)
+
+
+def get_polygon_signs(roi, slice_index):
+    """
+    DICOM rings and islands: a polygon inside an odd number of the other polygons of its slice is a hole
+    :param roi: a PackedROI
+    :param slice_index: slice of each polygon of roi, polygons with a negative index are ignored
+    :return: 1 for each island, -1 for each hole
+    :rtype: numpy array
+    """
+    signs = np.ones(roi.polygon_count)
+    for k in np.flatnonzero(np.bincount(slice_index[slice_index >= 0]) > 1):
+        polygons = np.flatnonzero(slice_index == k)
+        first_points = np.array([roi.polygon(p)[0, 0:2] for p in polygons], dtype=np.float64)
+
+        # every edge of the slice
+        edges = [roi.polygon(p)[:, 0:2].astype(np.float64) for p in polygons]
+        starts = np.concatenate(([0], np.cumsum([len(edge) for edge in edges])[:-1]))
+        x1, y1 = np.concatenate(edges).T
+        x2, y2 = np.concatenate([np.roll(edge, -1, axis=0) for edge in edges]).T
+
+        # crossings of a ray from each first point in the +x direction, counted per polygon
+        px, py = first_points[:, 0:1], first_points[:, 1:2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            crosses = ((y1 > py) != (y2 > py)) & (px < x1 + (py - y1) * (x2 - x1) / (y2 - y1))
+        inside = np.add.reduceat(crosses.astype(np.intp), starts, axis=1) % 2 == 1
+        np.fill_diagonal(inside, False)
+        signs[polygons] = np.where(np.sum(inside, axis=1) % 2 == 1, -1., 1.)
+    return signs
+
+
+def get_slice_geometry(roi, perimeters=True):
+    """
+    Area and perimeter of each slice of an ROI, with holes subtracted, without building shapely polygons
+    :param roi: a PackedROI
+    :param perimeters: False if only areas are needed, spikes are then not removed (see remove_spikes)
+    :return: z of each slice rounded to 0.01 mm in increasing order, area (mm^2) and perimeter (mm) of each slice,
+    and the index of the slice of each polygon (-1 for polygons of less than 3 points or without area)
+    :rtype: tuple
+    """
+    if perimeters:
+        points, offsets = remove_spikes(roi.points, roi.offsets)
+    else:
+        points, offsets = roi.points, np.asarray(roi.offsets, dtype=np.intp)
+    polygon_areas, polygon_perimeters = get_polygon_geometry(points, offsets)
+    # polygons without area (e.g., contours of collinear points) are ignored, as shapely's buffer(0) removes them
+    polygons = (np.diff(offsets) > 2) & (np.abs(polygon_areas) > 1e-6)
+
+    z, slice_index = np.unique(np.round(np.asarray(roi.z, dtype=np.float64)[polygons], 2), return_inverse=True)
+    all_slice_index = np.full(roi.polygon_count, -1, dtype=np.intp)
+    all_slice_index[polygons] = slice_index
+
+    signed_areas = get_polygon_signs(roi, all_slice_index) * np.abs(polygon_areas)
+    areas = np.bincount(slice_index, weights=signed_areas[polygons], minlength=len(z))
+    slice_perimeters = np.bincount(slice_index, weights=polygon_perimeters[polygons], minlength=len(z))
+    return z, areas, slice_perimeters, all_slice_index
+
+
+def dicompyler_roi_coord_to_bytes(coord):
+    """
+    :param coord: dicompyler structure coordinates from GetStructureCoordinates()
+    :return: packed representation stored in the roi_coord_bytes column
+    :rtype: bytearray
+    """
+    polygons = []
+    for z in coord:
+        for plane in coord[z]:
+            polygons.append([[point[0], point[1], float(z)] for point in plane['data']])
+    return pack_roi(polygons)
+
+
+def roi_coord_string_to_bytes(roi_coord_string):
+    """
+    :param roi_coord_string: value of the roi_coord_string column
+    :return: packed representation stored in the roi_coord_bytes column
+    :rtype: bytearray
+    """
+    polygons = []
+    for contour in roi_coord_string.split(':'):
+        values = np.array(contour.split(','), dtype=np.float64)
+        xy = values[1:].reshape(-1, 2)
+        polygons.append(np.column_stack((xy, np.full(len(xy), values[0]))))
+    return pack_roi(polygons)
+
+
+def get_roi_from_db_values(roi_coord_bytes, roi_coord_string):
+    """
+    :param roi_coord_bytes: value of the roi_coord_bytes column, may be None for ROIs not yet converted
+    :param roi_coord_string: value of the roi_coord_string column
+    :return: the ROI
+    :rtype: PackedROI
+    """
+    if roi_coord_bytes is None:
+        roi_coord_bytes = roi_coord_string_to_bytes(roi_coord_string)
+    return unpack_roi(roi_coord_bytes)
 
 
 def get_roi_coordinates_from_string(roi_coord_string):
@@ -662,19 +1069,58 @@ def get_planes_from_string(roi_coord_string):
     return planes
 
 
-def get_min_distances_to_target(oar_coordinates, target_coordinates):
+def get_min_distances_to_target(oar_coordinates, target_coordinates, workers=PTV_DISTANCE_WORKERS):
+    """
+    Nearest target point of each OAR point, queried in chunks of PTV_DISTANCE_CHUNK_SIZE points from a k-d tree of
+    the target, so memory is proportional to the number of points rather than their product
+    :param oar_coordinates: list of numpy arrays (or an Nx3 array) of 3D points defining the surface of the OAR
+    :param target_coordinates: list of numpy arrays (or an Nx3 array) of 3D points defining the surface of the PTV,
+    or a cKDTree of these points to reuse it for several OARs
+    :param workers: threads used by each query, -1 uses one per CPU
+    :return: min_distances: distance in cm from each OAR point to the closest target point
+    :rtype: numpy 1D array
+    """
+    oar_coordinates = np.asarray(oar_coordinates, dtype=np.float64).reshape(-1, 3)
+    if isinstance(target_coordinates, cKDTree):
+        tree = target_coordinates
+    else:
+        tree = cKDTree(np.asarray(target_coordinates, dtype=np.float64).reshape(-1, 3))
+
+    min_distances = np.empty(len(oar_coordinates))
+    for start in range(0, len(oar_coordinates), PTV_DISTANCE_CHUNK_SIZE):
+        chunk = oar_coordinates[start:start + PTV_DISTANCE_CHUNK_SIZE]
+        try:
+            min_distances[start:start + len(chunk)] = tree.query(chunk, workers=workers)[0]
+        except TypeError:  # scipy < 1.6
+            min_distances[start:start + len(chunk)] = tree.query(chunk, n_jobs=workers)[0]
+
+    return min_distances / 10.
+
+
+def get_distance_stats(oar_coordinates, target_coordinates, workers=PTV_DISTANCE_WORKERS):
     """
-    :param oar_coordinates: list of numpy arrays of 3D points defining the surface of the OAR
-    :param target_coordinates: list of numpy arrays of 3D points defining the surface of the PTV
-    :return: min_distances: list of numpy arrays of 3D points defining the surface of the OAR
-    :rtype: [float]
+    :param oar_coordinates: list of numpy arrays (or an Nx3 array) of 3D points defining the surface of the OAR
+    :param target_coordinates: list of numpy arrays (or an Nx3 array) of 3D points defining the surface of the PTV,
+    or a cKDTree of these points
+    :param workers: threads used by each nearest point query, -1 uses one per CPU
+    :return: min, mean, median, and max of the distances (cm) from the OAR points to the target,
+    and the distances themselves
+    :rtype: dict
     """
-    min_distances = []
-    all_distances = cdist(oar_coordinates, target_coordinates, 'euclidean')
-    for oar_point in all_distances:
-        min_distances.append(float(np.min(oar_point)/10.))
+    return get_distance_summary(get_min_distances_to_target(oar_coordinates, target_coordinates, workers=workers))
+
 
-    return min_distances
+def get_distance_summary(distances):
+    """
+    :param distances: distances (cm) of the OAR points to the target
+    :return: min, mean, median, and max of distances, and distances
+    :rtype: dict
+    """
+    return {'min': float(np.min(distances)),
+            'mean': float(np.mean(distances)),
+            'median': float(np.median(distances)),
+            'max': float(np.max(distances)),
+            'distances': distances}
 
 
 def update_min_distances_in_db(study_instance_uid, roi_name):
@@ -683,84 +1129,193 @@ def update_min_distances_in_db(study_instance_uid, roi_name):
     :param study_instance_uid: uid as specified in SQL DB
     :param roi_name: roi_name as specified in SQL DB
     """
+    update_tv_metrics_in_db(study_instance_uid, min_distance_rois=[roi_name])
 
-    oar_coordinates_string = DVH_SQL().query('dvhs',
-                                             'roi_coord_string',
-                                             "study_instance_uid = '%s' and roi_name = '%s'"
-                                             % (study_instance_uid, roi_name))
 
-    ptv_coordinates_strings = DVH_SQL().query('dvhs',
-                                              'roi_coord_string',
-                                              "study_instance_uid = '%s' and roi_type like 'PTV%%'"
-                                              % study_instance_uid)
+def update_treatment_volume_overlap_in_db(study_instance_uid, roi_name):
+    """
+    This function will recalculate the PTV overlap of an roi based on data in the SQL DB.
+    :param study_instance_uid: uid as specified in SQL DB
+    :param roi_name: roi_name as specified in SQL DB
+    """
+    update_tv_metrics_in_db(study_instance_uid, tv_overlap_rois=[roi_name])
 
-    if ptv_coordinates_strings:
 
-        oar_coordinates = get_roi_coordinates_from_string(oar_coordinates_string[0][0])
+def update_tv_metrics_in_db(study_instance_uid, min_distance_rois=(), tv_overlap_rois=()):
+    """
+    This function will recalculate the PTV distances and PTV overlap of ROIs of a study based on data in the SQL DB.
+    The contours are fetched with one query and every result is written in one transaction.
+    :param study_instance_uid: uid as specified in SQL DB
+    :param min_distance_rois: roi_names of the ROIs whose dist_to_ptv columns are updated
+    :param tv_overlap_rois: roi_names of the ROIs whose ptv_overlap is updated
+    :return: number of ROIs updated
+    :rtype: int
+    """
+    roi_names = set(min_distance_rois) | set(tv_overlap_rois)
+    if not roi_names:
+        return 0
 
-        ptvs = [get_planes_from_string(ptv[0]) for ptv in ptv_coordinates_strings]
-        tv_coordinates = get_roi_coordinates_from_planes(get_union(ptvs))
+    with DVH_SQL() as cnx:
+        contours = get_study_contours(cnx, study_instance_uid, roi_names, ptvs=True)
+        updates = calculate_tv_metrics(contours, min_distance_rois, tv_overlap_rois)
+        write_roi_updates(cnx, updates)
 
-        try:
-            min_distances = get_min_distances_to_target(oar_coordinates, tv_coordinates)
-
-            DVH_SQL().update('dvhs',
-                             'dist_to_ptv_min',
-                             round(float(np.min(min_distances)), 2),
-                             "study_instance_uid = '%s' and roi_name = '%s'"
-                             % (study_instance_uid, roi_name))
-
-            DVH_SQL().update('dvhs',
-                             'dist_to_ptv_mean',
-                             round(float(np.mean(min_distances)), 2),
-                             "study_instance_uid = '%s' and roi_name = '%s'"
-                             % (study_instance_uid, roi_name))
-
-            DVH_SQL().update('dvhs',
-                             'dist_to_ptv_median',
-                             round(float(np.median(min_distances)), 2),
-                             "study_instance_uid = '%s' and roi_name = '%s'"
-                             % (study_instance_uid, roi_name))
-
-            DVH_SQL().update('dvhs',
-                             'dist_to_ptv_max',
-                             round(float(np.max(min_distances)), 2),
-                             "study_instance_uid = '%s' and roi_name = '%s'"
-                             % (study_instance_uid, roi_name))
-        except:
-            print('dist_to_ptv calculation failure, skipping')
+    return len(set([row[1] for rows in updates.values() for row in rows]))
 
 
-def update_treatment_volume_overlap_in_db(study_instance_uid, roi_name):
+def get_study_contours(cnx, study_instance_uid, roi_names, ptvs=False):
     """
-    This function will recalculate the PTV overlap of an roi based on data in the SQL DB.
+    :param cnx: a DVH_SQL object
     :param study_instance_uid: uid as specified in SQL DB
-    :param roi_name: roi_name as specified in SQL DB
+    :param roi_names: roi_names as specified in SQL DB
+    :param ptvs: also select the ROIs of the study with a roi_type starting with PTV
+    :return: rows of row identity, roi_name, roi_type, roi_coord_bytes, roi_coord_string of these ROIs of the study,
+    the row identity is used to write results back to the same row, since study_instance_uid and roi_name may not be
+    unique (e.g., after a Force Update import)
+    :rtype: list
     """
+    return cnx.query('dvhs', '%s, roi_name, roi_type, roi_coord_bytes, roi_coord_string' % cnx.engine.row_id,
+                     get_study_contours_condition(study_instance_uid, roi_names, ptvs=ptvs))
 
-    oar_coordinates_string = DVH_SQL().query('dvhs',
-                                             'roi_coord_string',
-                                             "study_instance_uid = '%s' and roi_name = '%s'"
-                                             % (study_instance_uid, roi_name))
 
-    ptv_coordinates_strings = DVH_SQL().query('dvhs',
-                                              'roi_coord_string',
-                                              "study_instance_uid = '%s' and roi_type like 'PTV%%'"
-                                              % study_instance_uid)
+def get_study_contours_condition(study_instance_uid, roi_names, ptvs=False):
+    """
+    :param study_instance_uid: uid as specified in SQL DB
+    :param roi_names: roi_names as specified in SQL DB
+    :param ptvs: also select the ROIs of the study with a roi_type starting with PTV
+    :return: a condition selecting these ROIs of the study from the DVHs table
+    :rtype: str
+    """
+    condition = "roi_name in ('%s')" % "', '".join([name.replace("'", "''") for name in roi_names])
+    if ptvs:
+        condition = "(roi_type like 'PTV%%' or %s)" % condition
+    return "study_instance_uid = '%s' and %s" % (study_instance_uid, condition)
 
-    if ptv_coordinates_strings:
-        oar = get_planes_from_string(oar_coordinates_string[0][0])
 
-        ptvs = [get_planes_from_string(ptv[0]) for ptv in ptv_coordinates_strings]
+def calculate_tv_metrics(contours, min_distance_rois=(), tv_overlap_rois=(),
+                         distance_engine=GEOMETRY_ENGINES['distance'], overlap_engine=GEOMETRY_ENGINES['overlap']):
+    """
+    Calculate the PTV distances and PTV overlap of ROIs of a study. With the 'polygon' engine, the union of the
+    study's PTVs is built once, as a k-d tree for distances and as prepared polygons for overlaps.
+    :param contours: rows of the study's PTVs and ROIs, see get_study_contours
+    :param min_distance_rois: roi_names of the ROIs whose dist_to_ptv columns are calculated
+    :param tv_overlap_rois: roi_names of the ROIs whose ptv_overlap is calculated
+    :param distance_engine: 'polygon', 'voxel', or 'validate', see GEOMETRY_ENGINES
+    :param overlap_engine: 'polygon', 'voxel', or 'validate', see GEOMETRY_ENGINES
+    :return: rows of (row identity, roi_name, values) by tuple of updated columns, see write_roi_updates
+    :rtype: dict
+    """
+    ptvs = [get_roi_from_db_values(*contour[3:]) for contour in contours
+            if contour[2] and contour[2].startswith('PTV')]
+    if not ptvs:
+        return {}
+    roi_names = set(min_distance_rois) | set(tv_overlap_rois)
+    # keyed by row identity, since a study may have more than one row with the same roi_name
+    oar_names = {contour[0]: contour[1] for contour in contours if contour[1] in roi_names}
+    oars = {contour[0]: get_roi_from_db_values(*contour[3:]) for contour in contours if contour[0] in oar_names}
+
+    engines = set()
+    if min_distance_rois:
+        engines.add(distance_engine)
+    if tv_overlap_rois:
+        engines.add(overlap_engine)
+    tv, voxel_target = None, None
+    if engines != {'voxel'}:
+        tv = get_union([ptv.slices() for ptv in ptvs])
+    if engines & {'voxel', 'validate'}:
+        voxel_target = voxel_geometry.VoxelTarget(ptvs, listvalues(oars), voxel_size=GEOMETRY_VOXEL_SIZE,
+                                                  default_thickness=MIN_SLICE_THICKNESS)
+
+    updates = {}
+    if min_distance_rois:
+        tv_tree = None
+        if distance_engine != 'voxel':
+            tv_tree = cKDTree(np.array(get_roi_coordinates_from_planes(tv)))
+        columns = ('dist_to_ptv_min', 'dist_to_ptv_mean', 'dist_to_ptv_median', 'dist_to_ptv_max')
+        for row_id, roi_name in oar_names.items():
+            if roi_name in min_distance_rois:
+                try:
+                    stats = get_ptv_distance_stats(oars[row_id], tv_tree, voxel_target, engine=distance_engine)
+                    values = [round(stats[key], 2) for key in ['min', 'mean', 'median', 'max']]
+                    updates.setdefault(columns, []).append((row_id, roi_name, values))
+                except:
+                    print('dist_to_ptv calculation failure, skipping')
+    if tv_overlap_rois:
+        tv_slices = None
+        if overlap_engine != 'voxel':
+            tv_slices = get_slice_polygons(tv)
+        for row_id, roi_name in oar_names.items():
+            if roi_name in tv_overlap_rois:
+                overlap = get_ptv_overlap(oars[row_id], tv, tv_slices, voxel_target, engine=overlap_engine)
+                values = [round(float(overlap), 2)]
+                updates.setdefault(('ptv_overlap',), []).append((row_id, roi_name, values))
+
+    return updates
+
+
+def get_ptv_distance_stats(oar, tv_tree, voxel_target, engine=GEOMETRY_ENGINES['distance']):
+    """
+    :param oar: a PackedROI
+    :param tv_tree: cKDTree of the points of the union of the PTVs, used by the polygon engine
+    :param voxel_target: a VoxelTarget of the PTVs covering oar, used by the voxel engine
+    :param engine: 'polygon', 'voxel', or 'validate', see GEOMETRY_ENGINES
+    :return: min, mean, median, and max of the distances (cm) from the OAR points to the PTVs, see get_distance_stats
+    :rtype: dict
+    """
+    if engine == 'voxel':
+        return get_distance_summary(voxel_target.get_min_distances(oar))
+    stats = get_distance_stats(oar.points, tv_tree)
+    if engine == 'validate':
+        voxel_stats = get_distance_summary(voxel_target.get_min_distances(oar))
+        for key in ['min', 'mean', 'median', 'max']:
+            print_geometry_difference('dist_to_ptv_%s' % key, stats[key], voxel_stats[key])
+    return stats
+
+
+def get_ptv_overlap(oar, tv, tv_slices, voxel_target, engine=GEOMETRY_ENGINES['overlap']):
+    """
+    :param oar: a PackedROI
+    :param tv: "sets of points" of the union of the PTVs, used by the polygon engine
+    :param tv_slices: get_slice_polygons(tv), used by the polygon engine
+    :param voxel_target: a VoxelTarget of the PTVs covering oar, used by the voxel engine
+    :param engine: 'polygon', 'voxel', or 'validate', see GEOMETRY_ENGINES
+    :return: volume of overlap (cm^3) between oar and the PTVs
+    :rtype: float
+    """
+    if engine == 'voxel':
+        return voxel_target.calc_overlap(oar)
+    overlap = calc_roi_overlap(oar.slices(), tv, tv_slices=tv_slices)
+    if engine == 'validate':
+        print_geometry_difference('ptv_overlap', overlap, voxel_target.calc_overlap(oar))
+    return overlap
+
+
+def print_geometry_difference(column, polygon_value, voxel_value):
+    """
+    Print the results of the polygon and voxel engines, for GEOMETRY_ENGINES set to 'validate'
+    """
+    difference = voxel_value - polygon_value
+    if polygon_value:
+        print('%s: polygon %0.2f, voxel %0.2f, difference %0.2f (%0.1f%%)' %
+              (column, polygon_value, voxel_value, difference, 100. * difference / abs(polygon_value)))
+    else:
+        print('%s: polygon %0.2f, voxel %0.2f, difference %0.2f' % (column, polygon_value, voxel_value, difference))
 
-        tv = get_union(ptvs)
-        overlap = calc_roi_overlap(oar, tv)
 
-        DVH_SQL().update('dvhs',
-                         'ptv_overlap',
-                         round(float(overlap), 2),
-                         "study_instance_uid = '%s' and roi_name = '%s'"
-                         % (study_instance_uid, roi_name))
+def write_roi_updates(cnx, updates):
+    """
+    Write calculated ROI values to the DVHs table in one transaction, with one bulk update per set of columns
+    :param cnx: a DVH_SQL object
+    :param updates: lists of (row identity, roi_name, values) by tuple of the columns of values, rows are matched by
+    row identity (see get_study_contours)
+    """
+    with cnx.transaction():
+        for columns, rows in updates.items():
+            if rows:
+                values = {ROW_ID: [row[0] for row in rows]}
+                for i, column in enumerate(columns):
+                    values[column] = [row[2][i] for row in rows]
+                cnx.bulk_update('dvhs', [ROW_ID], values)
 
 
 def update_volumes_in_db(study_instance_uid, roi_name):
@@ -770,12 +1325,12 @@ def update_volumes_in_db(study_instance_uid, roi_name):
     :param roi_name: roi_name as specified in SQL DB
     """
 
-    coordinates_string = DVH_SQL().query('dvhs',
-                                         'roi_coord_string',
-                                         "study_instance_uid = '%s' and roi_name = '%s'"
-                                         % (study_instance_uid, roi_name))
+    coordinates = DVH_SQL().query('dvhs',
+                                  'roi_coord_bytes, roi_coord_string',
+                                  "study_instance_uid = '%s' and roi_name = '%s'"
+                                  % (study_instance_uid, roi_name))
 
-    roi = get_planes_from_string(coordinates_string[0][0])
+    roi = get_roi_from_db_values(*coordinates[0])
 
     volume = calc_volume(roi)
 
@@ -793,12 +1348,12 @@ def update_surface_area_in_db(study_instance_uid, roi_name):
     :param roi_name: roi_name as specified in SQL DB
     """
 
-    coordinates_string = DVH_SQL().query('dvhs',
-                                         'roi_coord_string',
-                                         "study_instance_uid = '%s' and roi_name = '%s'"
-                                         % (study_instance_uid, roi_name))
+    coordinates = DVH_SQL().query('dvhs',
+                                  'roi_coord_bytes, roi_coord_string',
+                                  "study_instance_uid = '%s' and roi_name = '%s'"
+                                  % (study_instance_uid, roi_name))
 
-    roi = get_planes_from_string(coordinates_string[0][0])
+    roi = get_roi_from_db_values(*coordinates[0])
 
     surface_area = surface_area_of_roi(roi, coord_type="sets_of_points")
 
@@ -897,35 +1452,21 @@ def calc_stats(data):
     return rtn_data
 
 
-def get_study_instance_uids(**kwargs):
-    uids = {}
-    complete_list = []
-    for key, value in listitems(kwargs):
-        uids[key] = QuerySQL(key, value).study_instance_uid
-        complete_list.extend(uids[key])
-
-    uids['unique'] = list(set(complete_list))
-    uids['union'] = [uid for uid in uids['unique'] if is_uid_in_all_keys(uid, uids)]
-
-    return uids
-
-
-def is_uid_in_all_keys(uid, uids):
-    key_answer = {}
-    # Initialize a False value for each key
-    for key in list(uids):
-        key_answer[key] = False
-    # search for uid in each keyword fof uid_kwlist
-    for key, value in listitems(uids):
-        if uid in value:
-            key_answer[key] = True
-
-    final_answer = True
-    # Product of all answer[key] values (except 'unique')
-    for key, value in listitems(key_answer):
-        if key not in 'unique':
-            final_answer *= value
-    return final_answer
+def get_study_instance_uid_condition(**kwargs):
+    """
+    Compile criteria of other tables into a condition for any table with a study_instance_uid column,
+    e.g., get_study_instance_uid_condition(plans="tx_site = 'Prostate'", rxs='', beams="beam_energy_max > 10")
+    :param kwargs: table names as keywords, each with a condition string in SQL syntax (may be empty)
+    :return: a condition selecting only study_instance_uids that satisfy every table's condition
+    :rtype: str
+    """
+    conditions = []
+    for table, condition in sorted(listitems(kwargs)):
+        sub_query = "SELECT study_instance_uid FROM %s" % table
+        if condition:
+            sub_query += " WHERE %s" % condition
+        conditions.append("study_instance_uid IN (%s)" % sub_query)
+    return ' AND '.join(conditions)
 
 
 def flatten_list_of_lists(some_list):
@@ -0,0 +1,282 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Voxel based ROI geometry, used by the 'voxel' engine of GEOMETRY_ENGINES
+Contours are filled onto a grid of GEOMETRY_VOXEL_SIZE (mm) in-plane by the slice thickness with the even-odd rule,
+so volumes and overlaps are sums of boolean masks, and distances come from a Euclidean distance transform.
+ROIs are PackedROIs (see utilities.unpack_roi)
+"""
+
+from __future__ import print_function
+import numpy as np
+from scipy import ndimage
+from options import GEOMETRY_VOXEL_SIZE
+
+
+# Slice thickness (mm) of an ROI with a single slice
+DEFAULT_SLICE_THICKNESS = 2.
+
+
+class VoxelGrid:
+    def __init__(self, rois, voxel_size=GEOMETRY_VOXEL_SIZE, bounds=None, default_thickness=DEFAULT_SLICE_THICKNESS,
+                 uniform=False):
+        """
+        Planes at every slice of rois, each extending to the next slice, the last by the smallest slice spacing
+        :param rois: PackedROIs whose slices define the planes of the grid
+        :param voxel_size: in-plane size of the voxels (mm)
+        :param bounds: x_min, y_min, x_max, y_max (mm) covered by the grid, defaults to get_bounds(rois)
+        :param default_thickness: slice thickness (mm) if rois have a single slice
+        :param uniform: evenly spaced planes from the first to the last slice of rois, by their median spacing,
+        slices are then assigned to the nearest plane (e.g., for distances across slices without contours)
+        """
+        self.voxel_size = float(voxel_size)
+        self.uniform = uniform
+        z = [np.round(np.asarray(roi.z, dtype=np.float64), 2) for roi in rois]
+        self.z = np.unique(np.concatenate(z)) if z else np.zeros(0)
+
+        self.thicknesses = np.diff(self.z)
+        if uniform:
+            spacing = float(np.median(self.thicknesses)) if len(self.thicknesses) else default_thickness
+            plane_count = int(np.rint((self.z[-1] - self.z[0]) / spacing)) + 1 if len(self.z) else 0
+            self.z = self.z[0] + spacing * np.arange(plane_count)
+            self.thicknesses = np.full(plane_count, spacing)
+        else:
+            self.thicknesses = np.append(self.thicknesses,
+                                         np.min(self.thicknesses) if len(self.thicknesses) else default_thickness)
+
+        if bounds is None:
+            bounds = get_bounds(rois)
+        x_min, y_min, x_max, y_max = bounds
+        # voxel centers, the first half a voxel inside the bounds
+        self.x = np.arange(x_min + self.voxel_size / 2., x_max + self.voxel_size / 2., self.voxel_size)
+        self.y = np.arange(y_min + self.voxel_size / 2., y_max + self.voxel_size / 2., self.voxel_size)
+
+    @property
+    def shape(self):
+        return len(self.z), len(self.y), len(self.x)
+
+    @property
+    def voxel_volumes(self):
+        """
+        :return: volume (mm^3) of a voxel of each plane
+        :rtype: np.ndarray
+        """
+        return self.thicknesses * self.voxel_size ** 2
+
+    def get_plane_indices(self, z):
+        """
+        :param z: z values (mm)
+        :return: index of the plane of each z, -1 if z is not a plane of this grid (or outside a uniform grid)
+        :rtype: np.ndarray
+        """
+        z = np.round(np.asarray(z, dtype=np.float64), 2)
+        if not len(self.z):
+            return np.full(len(z), -1, dtype=np.intp)
+        if self.uniform:
+            indices = np.rint((z - self.z[0]) / self.thicknesses[0]).astype(np.intp)
+            return np.where((indices >= 0) & (indices < len(self.z)), indices, -1)
+        indices = np.clip(np.searchsorted(self.z, z), 0, len(self.z) - 1)
+        return np.where(self.z[indices] == z, indices, -1)
+
+    def get_window(self, roi):
+        """
+        :param roi: a PackedROI
+        :return: slices of the planes, rows, and columns of this grid around roi, to limit get_mask to them
+        :rtype: tuple
+        """
+        planes = self.get_plane_indices(roi.z)
+        planes = planes[planes >= 0]
+        bounds = get_bounds([roi])
+        if not len(planes) or bounds is None:
+            return slice(0, 0), slice(0, 0), slice(0, 0)
+        x_min, y_min, x_max, y_max = bounds
+        return slice(np.min(planes), np.max(planes) + 1), \
+            slice(np.searchsorted(self.y, y_min), np.searchsorted(self.y, y_max, side='right')), \
+            slice(np.searchsorted(self.x, x_min), np.searchsorted(self.x, x_max, side='right'))
+
+    def get_mask(self, roi, window=None):
+        """
+        :param roi: a PackedROI, polygons on slices that are not planes of this grid are ignored
+        :param window: optional slices of planes, rows, and columns from get_window, the mask then only covers them
+        :return: voxels whose center is inside roi, shape (planes, rows, columns)
+        :rtype: np.ndarray
+        """
+        z, y, x = self.z, self.y, self.x
+        if window is not None:
+            z, y, x = z[window[0]], y[window[1]], x[window[2]]
+        shape = (len(z), len(y), len(x))
+
+        offsets = np.asarray(roi.offsets, dtype=np.intp)
+        lengths = np.diff(offsets)
+        planes = self.get_plane_indices(roi.z)
+        if window is not None:
+            planes = np.where((planes >= window[0].start) & (planes < window[0].stop), planes - window[0].start, -1)
+        polygons = (lengths > 2) & (planes >= 0)
+        if not np.any(polygons) or not len(x) or not len(y):
+            return np.zeros(shape, dtype=bool)
+
+        # each point and the next point of its polygon, the last point of each polygon is joined to its first
+        point_polygons = np.repeat(np.arange(len(lengths)), lengths)
+        next_points = np.arange(len(point_polygons)) + 1
+        next_points[offsets[1:][lengths > 0] - 1] = offsets[:-1][lengths > 0]
+        points = polygons[point_polygons]
+
+        xy = np.asarray(roi.points, dtype=np.float64)[:, 0:2]
+        edges = np.hstack((xy[points], xy[next_points[points]]))
+        return fill_polygon_edges(edges, planes[point_polygons[points]], len(z), x, y)
+
+    def get_union_mask(self, rois):
+        """
+        :param rois: PackedROIs
+        :return: voxels inside any of rois
+        :rtype: np.ndarray
+        """
+        mask = np.zeros(self.shape, dtype=bool)
+        for roi in rois:
+            window = self.get_window(roi)
+            mask[window] |= self.get_mask(roi, window=window)
+        return mask
+
+    def get_point_indices(self, points):
+        """
+        :param points: Nx3 array of x, y, z (mm) inside the grid
+        :return: plane, row, and column indices of the voxel containing each point
+        :rtype: tuple
+        """
+        points = np.asarray(points, dtype=np.float64)
+        rows = np.rint((points[:, 1] - self.y[0]) / self.voxel_size).astype(np.intp)
+        cols = np.rint((points[:, 0] - self.x[0]) / self.voxel_size).astype(np.intp)
+        return self.get_plane_indices(points[:, 2]), np.clip(rows, 0, len(self.y) - 1), \
+            np.clip(cols, 0, len(self.x) - 1)
+
+
+class VoxelTarget:
+    def __init__(self, targets, rois=(), voxel_size=GEOMETRY_VOXEL_SIZE, default_thickness=DEFAULT_SLICE_THICKNESS):
+        """
+        The union of target volumes on a uniform grid covering the targets and rois, built once to calculate the
+        overlap and distances of each of rois
+        :param targets: PackedROIs of the target volumes
+        :param rois: PackedROIs that will be compared to the targets
+        :param voxel_size: in-plane size of the voxels (mm)
+        :param default_thickness: slice spacing (mm) if the ROIs have a single slice
+        """
+        all_rois = list(targets) + list(rois)
+        self.grid = VoxelGrid(all_rois, voxel_size=voxel_size, bounds=get_bounds(all_rois, pad=voxel_size),
+                              default_thickness=default_thickness, uniform=True)
+        self.mask = self.grid.get_union_mask(targets)
+        self._distances = None
+
+    @property
+    def distances(self):
+        """
+        :return: distance (mm) of each voxel to the nearest target contour, calculated on first access
+        :rtype: np.ndarray
+        """
+        if self._distances is None:
+            # the contours of the target are the voxels of its mask next to an outside voxel of the same plane
+            in_plane = np.zeros((3, 3, 3), dtype=bool)
+            in_plane[1] = ndimage.generate_binary_structure(2, 1)
+            contours = self.mask & ~ndimage.binary_erosion(self.mask, structure=in_plane)
+            if not np.any(contours):
+                raise ValueError('The targets have no contours on the voxel grid')
+            sampling = (self.grid.thicknesses[0], self.grid.voxel_size, self.grid.voxel_size)
+            self._distances = ndimage.distance_transform_edt(~contours, sampling=sampling)
+        return self._distances
+
+    def get_min_distances(self, roi):
+        """
+        :param roi: a PackedROI within the grid
+        :return: distance (cm) of each point of roi to the nearest target contour, accurate to about half a voxel
+        :rtype: np.ndarray
+        """
+        return self.distances[self.grid.get_point_indices(roi.points)] / 10.
+
+    def calc_overlap(self, roi):
+        """
+        :param roi: a PackedROI within the grid
+        :return: volume (cm^3) of roi inside the targets
+        :rtype: float
+        """
+        window = self.grid.get_window(roi)
+        voxel_counts = np.sum(self.grid.get_mask(roi, window=window) & self.mask[window], axis=(1, 2))
+        return round(float(np.dot(voxel_counts, self.grid.voxel_volumes[window[0]])) / 1000., 2)
+
+
+def fill_polygon_edges(edges, labels, label_count, col_lut, row_lut):
+    """
+    Rasterise polygons with the even-odd rule, so that polygons inside another polygon with the same label are holes.
+    A grid point is inside if an odd number of edges cross the grid row to its left: the column after each crossing
+    is toggled, and a cumulative sum along each row gives the parity.
+    :param edges: Nx4 array of u1, v1, u2, v2 of every polygon edge, u is along the columns and v along the rows
+    :param labels: index of the mask of each edge, e.g., an ROI or a plane
+    :param label_count: number of masks
+    :param col_lut: coordinates of the grid columns
+    :param row_lut: coordinates of the grid rows
+    :return: boolean masks of the grid points inside the polygons of each label, shape (label_count, rows, columns)
+    :rtype: np.ndarray
+    """
+    row_count, col_count = len(row_lut), len(col_lut)
+    if not len(edges):
+        return np.zeros((label_count, row_count, col_count), dtype=bool)
+
+    # searchsorted below needs increasing coordinates
+    flip_cols, flip_rows = col_lut[0] > col_lut[-1], row_lut[0] > row_lut[-1]
+    if flip_cols:
+        col_lut = col_lut[::-1]
+    if flip_rows:
+        row_lut = row_lut[::-1]
+
+    u1, v1, u2, v2 = np.asarray(edges, dtype=np.float64).T
+    labels = np.asarray(labels, dtype=np.intp)
+
+    # rows crossed by each edge, half-open so a vertex on a row is counted once
+    first_row = np.searchsorted(row_lut, np.minimum(v1, v2), side='right')
+    crossed_rows = np.searchsorted(row_lut, np.maximum(v1, v2), side='right') - first_row
+    edge_index = np.repeat(np.arange(len(u1)), crossed_rows)
+    rows = np.repeat(first_row - np.cumsum(crossed_rows) + crossed_rows, crossed_rows) + np.arange(len(edge_index))
+
+    # first column to the right of each crossing, toggles are counted in an extra column past the last
+    u1, v1, u2, v2 = u1[edge_index], v1[edge_index], u2[edge_index], v2[edge_index]
+    crossings = u1 + (row_lut[rows] - v1) * (u2 - u1) / (v2 - v1)
+    cols = np.searchsorted(col_lut, crossings, side='right')
+
+    toggles = np.bincount((labels[edge_index] * row_count + rows) * (col_count + 1) + cols,
+                          minlength=label_count * row_count * (col_count + 1))
+    masks = np.cumsum(toggles.reshape(label_count, row_count, col_count + 1), axis=2)[:, :, :col_count] % 2 == 1
+
+    if flip_cols:
+        masks = masks[:, :, ::-1]
+    if flip_rows:
+        masks = masks[:, ::-1, :]
+    return masks
+
+
+def get_bounds(rois, pad=0.):
+    """
+    :param rois: PackedROIs
+    :param pad: distance (mm) added on each side
+    :return: x_min, y_min, x_max, y_max of the points of rois, None if they have no points
+    :rtype: tuple
+    """
+    points = [np.asarray(roi.points, dtype=np.float64)[:, 0:2] for roi in rois if len(roi.points)]
+    if not points:
+        return None
+    points = np.vstack(points)
+    x_min, y_min = np.min(points, axis=0) - pad
+    x_max, y_max = np.max(points, axis=0) + pad
+    return x_min, y_min, x_max, y_max
+
+
+def calc_volume(roi, voxel_size=GEOMETRY_VOXEL_SIZE, default_thickness=DEFAULT_SLICE_THICKNESS):
+    """
+    :param roi: a PackedROI
+    :param voxel_size: in-plane size of the voxels (mm)
+    :param default_thickness: slice thickness (mm) of an ROI with a single slice
+    :return: volume in cm^3 of roi
+    :rtype: float
+    """
+    if get_bounds([roi]) is None:
+        return 0.
+    grid = VoxelGrid([roi], voxel_size=voxel_size, default_thickness=default_thickness)
+    voxel_counts = np.sum(grid.get_mask(roi), axis=(1, 2))
+    return round(float(np.dot(voxel_counts, grid.voxel_volumes)) / 1000., 2)
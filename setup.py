@@ -18,6 +18,7 @@ requires = [
     'freetype-py',
     'statsmodels',
     'future',
+    'futures; python_version < "3"',
 ]
 
 setup(
@@ -0,0 +1,67 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Conversion of dvh_string and roi_coord_string to their bytea columns on the SQLite engine, in several batches
+Every study_instance_uid and roi_name is used by two rows, as after a Force Update import
+Run from the repository root with: python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dvh'))
+
+import sql_connector
+from sql_connector import DVH_SQL
+from utilities import convert_dvh_strings_to_bytes, convert_roi_coord_strings_to_bytes, bytes_to_dvh, unpack_roi
+
+
+ROW_COUNT = 25
+BATCH_SIZE = 10
+
+
+class SQLiteConversionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        settings_path = os.path.join(self.directory, 'sql_connection.cnf')
+        with open(settings_path, 'w') as document:
+            document.write("engine sqlite\ndbname %s\n" % os.path.join(self.directory, 'dvh.db'))
+        self.get_settings = sql_connector.get_settings
+        sql_connector.get_settings = lambda settings_type: settings_path
+
+        with DVH_SQL() as cnx:
+            cnx.initialize_database()
+            for i in range(ROW_COUNT):
+                cnx.cursor.execute("INSERT INTO DVHs (mrn, study_instance_uid, roi_name, dvh_string, roi_coord_string) "
+                                   "VALUES ('%s', 'uid_%s', 'roi', '%s,%s,1', '%s,0,0,10,0,10,10');"
+                                   % (i, i // 2, 3 * i, 2 * i, i))
+            cnx.commit()
+
+    def tearDown(self):
+        sql_connector.get_settings = self.get_settings
+        sql_connector.close_all_connections()
+        shutil.rmtree(self.directory)
+
+    def test_convert_dvhs_in_batches(self):
+        self.assertEqual(convert_dvh_strings_to_bytes(batch_size=BATCH_SIZE), ROW_COUNT)
+        with DVH_SQL() as cnx:
+            rows = cnx.query('DVHs', 'mrn, dvh_bytes')
+        self.assertEqual(len(rows), ROW_COUNT)
+        for mrn, dvh_bytes in rows:
+            i = int(mrn)
+            self.assertTrue(np.array_equal(bytes_to_dvh(dvh_bytes), [3 * i, 2 * i, 1]))
+
+    def test_convert_rois_in_batches(self):
+        self.assertEqual(convert_roi_coord_strings_to_bytes(batch_size=BATCH_SIZE), ROW_COUNT)
+        with DVH_SQL() as cnx:
+            rows = cnx.query('DVHs', 'mrn, roi_coord_bytes')
+        for mrn, roi_coord_bytes in rows:
+            self.assertEqual(unpack_roi(roi_coord_bytes).z[0], int(mrn))
+
+
+if __name__ == '__main__':
+    unittest.main()